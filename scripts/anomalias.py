@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Detección de anomalías en el coste diario por Name (--anomalias)
+================================================================
+Para avisar de recursos desbocados antes del cierre de mes, cada Name se ve
+como una serie de coste diario y cada día se compara con los VENTANA días
+anteriores:
+
+  referencia = mediana de la ventana
+  dispersión = 1,4826 × MAD (desviación absoluta mediana), con un mínimo
+  puntuación = (coste - referencia) / dispersión
+
+Un día es anómalo si la puntuación supera el umbral Y el exceso sobre la
+referencia supera un mínimo en dólares (para no avisar de céntimos).
+
+Todo se calcula con NumPy sobre la matriz Name × día completa (ventanas
+deslizantes sin bucles por Name), por bloques de filas para acotar la
+memoria: decenas de miles de Names se procesan en segundos.
+
+La serie empieza HISTORIA_DIAS antes del periodo para que los primeros días
+del mes tengan referencia (Cost Explorer: una consulta DAILY por Name;
+cubo: su matriz diaria; CUR: los días del periodo).
+"""
+
+import json
+from datetime import date, timedelta
+
+import numpy as np
+
+from aws_cost_report import METRICA_PRINCIPAL, name_de_etiqueta
+from dinero import ESCALA, a_dolares, desde_dolares
+from planificador_consultas import Necesidad, ejecutar_plan
+
+VENTANA = 14              # días de referencia antes de cada día
+HISTORIA_DIAS = 14        # días anteriores al periodo que se piden como referencia
+UMBRAL_PUNTUACION = 5.0   # puntuación robusta mínima
+EXCESO_MINIMO = 5.0       # US$ por día sobre la referencia
+DISPERSION_RELATIVA = 0.1   # dispersión mínima: 10 % de la referencia (series planas)
+BLOQUE_FILAS = 8192
+
+NECESIDAD_DIARIA = Necesidad('diario', ('TAG:Name',), None)
+
+
+def inicio_con_historia(fecha_inicio, dias=HISTORIA_DIAS):
+    return (date.fromisoformat(fecha_inicio) - timedelta(days=dias)).isoformat()
+
+
+def _fechas(desde, hasta):
+    inicio, fin = date.fromisoformat(desde), date.fromisoformat(hasta)
+    return [(inicio + timedelta(days=i)).isoformat() for i in range((fin - inicio).days)]
+
+
+def matriz_desde_filas(filas, desde, hasta, metrica=METRICA_PRINCIPAL):
+    """Filas diarias del planificador (Name en la última clave) -> (names, dias, matriz int64)"""
+    dias = _fechas(desde, hasta)
+    posicion_dia = {d: i for i, d in enumerate(dias)}
+    etiquetas, columnas, valores = [], [], []
+    for periodo, claves, importes in filas:
+        if periodo in posicion_dia:
+            etiquetas.append(name_de_etiqueta(claves[-1]))
+            columnas.append(posicion_dia[periodo])
+            valores.append(importes[metrica])
+    if not etiquetas:
+        return [], dias, np.zeros((0, len(dias)), dtype=np.int64)
+    names, fila = np.unique(np.array(etiquetas, dtype=object), return_inverse=True)
+    matriz = np.zeros((len(names), len(dias)), dtype=np.int64)
+    np.add.at(matriz, (fila, np.array(columnas)), np.array(valores, dtype=np.int64))
+    return list(names), dias, matriz
+
+
+def serie_diaria_ce(cliente_ce, fecha_inicio, fecha_fin):
+    """Coste diario por Name desde HISTORIA_DIAS antes del periodo (una consulta DAILY)"""
+    desde = inicio_con_historia(fecha_inicio)
+    print(f"📉 Serie diaria por Name ({desde} a {fecha_fin}) para detectar anomalías...")
+    filas = ejecutar_plan(cliente_ce, [NECESIDAD_DIARIA], desde, fecha_fin, [METRICA_PRINCIPAL], 'DAILY')
+    return matriz_desde_filas(filas['diario'] or [], desde, fecha_fin)
+
+
+def serie_diaria_cubo(directorio, fecha_inicio, fecha_fin):
+    from cubo_costes import CuboCostes
+    cubo = CuboCostes(directorio)
+    desde = max(inicio_con_historia(fecha_inicio), cubo.primer_dia() or fecha_inicio)
+    etiquetas, dias, matriz = cubo.matriz_diaria(desde, fecha_fin, METRICA_PRINCIPAL)
+    return [name_de_etiqueta(e) for e in etiquetas], dias, matriz
+
+
+def serie_diaria_cur(directorio, fecha_inicio, fecha_fin, procesos=None):
+    from fuente_cur import filas_cur
+    filas = filas_cur(directorio, fecha_inicio, fecha_fin, [METRICA_PRINCIPAL], por_dia=True, procesos=procesos)
+    return matriz_desde_filas(filas['base'], fecha_inicio, fecha_fin)
+
+
+def _bloque(matriz, ventana, umbral, exceso_minimo):
+    """Puntuaciones y máscara de anomalías de un bloque de filas (días >= ventana)"""
+    x = matriz.astype(np.float64)
+    ventanas = np.lib.stride_tricks.sliding_window_view(x, ventana, axis=1)[:, :-1]
+    referencia = np.median(ventanas, axis=2)
+    mad = np.median(np.abs(ventanas - referencia[:, :, None]), axis=2)
+    dispersion = np.maximum.reduce([1.4826 * mad, DISPERSION_RELATIVA * np.abs(referencia),
+                                    np.full_like(mad, ESCALA / 100)])  # mínimo 1 céntimo
+    actual = x[:, ventana:]
+    exceso = actual - referencia
+    puntuacion = exceso / dispersion
+    return referencia, exceso, puntuacion, (puntuacion > umbral) & (exceso > exceso_minimo)
+
+
+def detectar(names, dias, matriz, desde_dia=None, ventana=VENTANA, umbral=UMBRAL_PUNTUACION,
+             exceso_minimo=EXCESO_MINIMO):
+    """Anomalías [{name, dia, costo, referencia, exceso, puntuacion}] ordenadas por exceso
+
+    Solo se informan los días >= desde_dia (el periodo del informe); los
+    anteriores solo sirven de referencia.
+    """
+    if matriz.shape[1] <= ventana or not len(names):
+        return []
+    primera = ventana
+    if desde_dia is not None and desde_dia in dias:
+        primera = max(ventana, dias.index(desde_dia))
+    minimo = desde_dolares(exceso_minimo)
+
+    anomalias = []
+    for inicio in range(0, matriz.shape[0], BLOQUE_FILAS):
+        bloque = matriz[inicio:inicio + BLOQUE_FILAS]
+        referencia, exceso, puntuacion, mascara = _bloque(bloque, ventana, umbral, minimo)
+        mascara[:, :primera - ventana] = False
+        for fila, columna in zip(*np.nonzero(mascara)):
+            anomalias.append({
+                'name': names[inicio + fila],
+                'dia': dias[columna + ventana],
+                'costo': int(bloque[fila, columna + ventana]),
+                'referencia': int(round(referencia[fila, columna])),
+                'exceso': int(round(exceso[fila, columna])),
+                'puntuacion': round(float(puntuacion[fila, columna]), 1),
+            })
+    anomalias.sort(key=lambda a: a['exceso'], reverse=True)
+    return anomalias
+
+
+def analizar(cliente_ce, fecha_inicio, fecha_fin, cur=None, cubo=None, procesos=None,
+             umbral=UMBRAL_PUNTUACION, ruta_json=None):
+    """Serie diaria de la fuente del informe -> anomalías (impresas y, si se pide, en JSON)"""
+    if cubo:
+        names, dias, matriz = serie_diaria_cubo(cubo, fecha_inicio, fecha_fin)
+    elif cur:
+        names, dias, matriz = serie_diaria_cur(cur, fecha_inicio, fecha_fin, procesos)
+    else:
+        names, dias, matriz = serie_diaria_ce(cliente_ce, fecha_inicio, fecha_fin)
+    anomalias = detectar(names, dias, matriz, desde_dia=fecha_inicio, umbral=umbral)
+    print(f"   → {len(names)} Names × {len(dias)} días analizados")
+    imprimir(anomalias)
+    if ruta_json:
+        guardar_json(ruta_json, anomalias, fecha_inicio, fecha_fin, umbral)
+    return anomalias
+
+
+def imprimir(anomalias, maximo=10):
+    if not anomalias:
+        print("✅ Sin anomalías en el coste diario")
+        return
+    print(f"🚨 {len(anomalias)} días anómalos en {len({a['name'] for a in anomalias})} Names:")
+    for a in anomalias[:maximo]:
+        print(f"   {a['dia']} {a['name']}: ${a_dolares(a['costo']):,.2f} "
+              f"(habitual ${a_dolares(a['referencia']):,.2f}, puntuación {a['puntuacion']})")
+
+
+def guardar_json(ruta, anomalias, fecha_inicio, fecha_fin, umbral=UMBRAL_PUNTUACION):
+    with open(ruta, 'w', encoding='utf-8') as f:
+        json.dump({
+            'periodo': [fecha_inicio, fecha_fin],
+            'parametros': {'ventana': VENTANA, 'umbral': umbral, 'exceso_minimo_usd': EXCESO_MINIMO},
+            'anomalias': [dict(a, costo=a_dolares(a['costo']), referencia=a_dolares(a['referencia']),
+                               exceso=a_dolares(a['exceso'])) for a in anomalias],
+        }, f, indent=2, ensure_ascii=False)
+    print(f"💾 Anomalías guardadas en {ruta}")
+
+
+def escribir_hoja_anomalias(wb, anomalias):
+    """Hoja 'Anomalías' (openpyxl), de mayor a menor exceso"""
+    from openpyxl.styles import Font, PatternFill
+
+    fill_cabecera = PatternFill(start_color='C00000', end_color='C00000', fill_type='solid')
+    ws = wb.create_sheet('Anomalías')
+    cabeceras = ['Día', 'Name', 'Costo (US$)', 'Habitual (US$)', 'Exceso (US$)', 'Puntuación']
+    for c, texto in enumerate(cabeceras, start=1):
+        cell = ws.cell(1, c, texto)
+        cell.fill = fill_cabecera
+        cell.font = Font(bold=True, color='FFFFFF')
+    for r, a in enumerate(anomalias, start=2):
+        fila = [a['dia'], a['name'], a_dolares(a['costo']), a_dolares(a['referencia']),
+                a_dolares(a['exceso']), a['puntuacion']]
+        for c, valor in enumerate(fila, start=1):
+            cell = ws.cell(r, c, valor)
+            if c in (3, 4, 5):
+                cell.number_format = '#,##0.00'
+    for columna, ancho in zip('ABCDEF', [12, 40, 14, 15, 14, 12]):
+        ws.column_dimensions[columna].width = ancho
+    ws.freeze_panes = 'A2'
+    if anomalias:
+        ws.auto_filter.ref = f'A1:F{len(anomalias) + 1}'
+    return ws
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Atribución de costes EC2 sin etiqueta por recurso (--atribuir-recursos)
+=======================================================================
+Los costes EC2 de recursos sin etiqueta Name acaban en "Sin etiqueta". Muchos
+sí se pueden asignar: volúmenes EBS conectados a una instancia con Name,
+instancias etiquetadas después de facturar o antes de activar la etiqueta
+de asignación de costes...
+
+1. Costes por recurso: get_cost_and_usage_with_resources agrupando por
+   RESOURCE_ID × USAGE_TYPE, solo para líneas SIN etiqueta Name (filtro
+   MatchOptions ABSENT). Cost Explorer solo tiene datos por recurso de los
+   últimos 14 días (y hay que activarlos en la consola); se usa la parte del
+   periodo que cae en esa ventana. Una consulta paginada por servicio EC2,
+   las tres en paralelo; si fallan (datos por recurso sin activar, que es lo
+   habitual) se avisa y el informe sigue sin atribuir.
+2. Índice recurso -> Name en disco (.aws_recursos_name.json): solo se
+   consultan a EC2 (describe_instances / describe_volumes) los recursos que
+   no están en el índice; los que no se pueden resolver se recuerdan y no se
+   vuelven a preguntar hasta pasados REINTENTO_DIAS.
+3. Reparto: el "Sin etiqueta" de cada servicio EC2 (base) y de cada
+   categoría (desglose) se reparte entre los Names en proporción a lo que
+   sus recursos costaron en la ventana (resto mayor, al micro-céntimo); lo
+   que no se resuelve se queda en "Sin etiqueta". El total no cambia.
+   Las métricas no aditivas (UsageQuantity) no se reparten: su "Sin
+   etiqueta" suma unidades distintas y se queda como está.
+"""
+
+import json
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+from aws_cost_report import METRICAS_NO_ADITIVAS, SERVICIOS_EC2, categorizar_usage_type
+from consultas_ce import paginar
+from dinero import a_dolares, importe, repartir
+
+SIN_ETIQUETA = 'Sin etiqueta'
+DIAS_VENTANA = 14        # datos por recurso disponibles en Cost Explorer
+REINTENTO_DIAS = 7       # recursos sin Name: no se vuelven a consultar antes
+LOTE_FILTRO_EC2 = 200    # valores por filtro en describe_* de EC2
+RUTA_INDICE_POR_DEFECTO = '.aws_recursos_name.json'
+VERSION_INDICE = 1
+
+
+def ventana_recursos(fecha_inicio, fecha_fin, hoy=None):
+    """Parte del periodo [inicio, fin) con datos por recurso, o None si no hay"""
+    hoy = hoy or date.today()
+    inicio = max(date.fromisoformat(fecha_inicio), hoy - timedelta(days=DIAS_VENTANA))
+    fin = min(date.fromisoformat(fecha_fin), hoy)
+    if inicio >= fin:
+        return None
+    return inicio.isoformat(), fin.isoformat()
+
+
+def id_recurso(recurso):
+    """'arn:aws:ec2:...:volume/vol-0abc' -> 'vol-0abc' (los ids simples no cambian)"""
+    return recurso.rsplit('/', 1)[-1] if recurso.startswith('arn:') else recurso
+
+
+def obtener_costes_recursos(cliente_ce, inicio, fin, metricas, hilos=len(SERVICIOS_EC2)):
+    """{metrica: {servicio: {(recurso, usage_type): importe}}} de las líneas EC2 sin Name
+
+    Un servicio cuya consulta falla queda sin filas (con aviso).
+    """
+    def consultar(servicio):
+        filas = {m: defaultdict(int) for m in metricas}
+        params = {
+            'TimePeriod': {'Start': inicio, 'End': fin},
+            'Granularity': 'DAILY',
+            'Metrics': list(metricas),
+            'GroupBy': [{'Type': 'DIMENSION', 'Key': 'RESOURCE_ID'},
+                        {'Type': 'DIMENSION', 'Key': 'USAGE_TYPE'}],
+            'Filter': {'And': [
+                {'Dimensions': {'Key': 'SERVICE', 'Values': [servicio]}},
+                {'Tags': {'Key': 'Name', 'MatchOptions': ['ABSENT']}},
+            ]},
+        }
+        try:
+            for respuesta in paginar(cliente_ce, 'get_cost_and_usage_with_resources', **params):
+                for periodo in respuesta['ResultsByTime']:
+                    for grupo in periodo['Groups']:
+                        recurso, usage_type = grupo['Keys']
+                        for m in metricas:
+                            filas[m][(id_recurso(recurso), usage_type)] += importe(grupo['Metrics'][m]['Amount'])
+        except Exception as e:
+            print(f"   ⚠️  Sin datos por recurso de {servicio}: {e}")
+            return {m: {} for m in metricas}
+        return filas
+
+    with ThreadPoolExecutor(max_workers=max(1, min(hilos, len(SERVICIOS_EC2)))) as pool:
+        por_servicio = dict(zip(SERVICIOS_EC2, pool.map(consultar, SERVICIOS_EC2)))
+    return {m: {s: por_servicio[s][m] for s in SERVICIOS_EC2} for m in metricas}
+
+
+def _name_de_tags(tags):
+    for tag in tags or []:
+        if tag['Key'] == 'Name' and tag['Value']:
+            return tag['Value']
+    return None
+
+
+class IndiceRecursos:
+    """Índice persistente recurso -> Name (JSON)
+
+    recursos:  {id: name} resueltos
+    sin_name:  {id: 'YYYY-MM-DD'} consultados sin éxito (se reintentan tras REINTENTO_DIAS)
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.recursos = {}
+        self.sin_name = {}
+        if os.path.exists(ruta):
+            with open(ruta, encoding='utf-8') as f:
+                datos = json.load(f)
+            if datos.get('version') == VERSION_INDICE:
+                self.recursos = datos['recursos']
+                self.sin_name = datos['sin_name']
+            else:
+                print(f"   ⚠️  Índice de recursos {ruta} con otra versión: se reconstruye")
+
+    def name(self, recurso):
+        return self.recursos.get(recurso)
+
+    def pendientes(self, recursos, hoy=None):
+        """Recursos que hay que consultar a EC2 (ni resueltos ni fallidos recientemente)"""
+        limite = ((hoy or date.today()) - timedelta(days=REINTENTO_DIAS)).isoformat()
+        return sorted(r for r in set(recursos)
+                      if r not in self.recursos and self.sin_name.get(r, '') < limite)
+
+    def completar(self, recursos, cliente_ec2, hoy=None):
+        """Resuelve con EC2 los recursos pendientes; devuelve cuántos se han resuelto"""
+        pendientes = self.pendientes(recursos, hoy)
+        if not pendientes or cliente_ec2 is None:
+            return 0
+        instancias = [r for r in pendientes if r.startswith('i-')]
+        volumenes = [r for r in pendientes if r.startswith('vol-')]
+        resueltos = {}
+
+        def describir(operacion, filtro, ids, clave_lista):
+            for i in range(0, len(ids), LOTE_FILTRO_EC2):
+                paginas = cliente_ec2.get_paginator(operacion).paginate(
+                    Filters=[{'Name': filtro, 'Values': ids[i:i + LOTE_FILTRO_EC2]}])
+                for pagina in paginas:
+                    yield from clave_lista(pagina)
+
+        def instancias_de(pagina):
+            for reserva in pagina['Reservations']:
+                yield from reserva['Instances']
+
+        def name_de_instancias(ids):
+            return {inst['InstanceId']: _name_de_tags(inst.get('Tags'))
+                    for inst in describir('describe_instances', 'instance-id', ids, instancias_de)}
+
+        resueltos.update(name_de_instancias(instancias))
+
+        # Volúmenes: su propio Name o el de la instancia a la que están conectados
+        conectados = {}
+        for volumen in describir('describe_volumes', 'volume-id', volumenes, lambda p: p['Volumes']):
+            name = _name_de_tags(volumen.get('Tags'))
+            if name:
+                resueltos[volumen['VolumeId']] = name
+            elif volumen.get('Attachments'):
+                conectados[volumen['VolumeId']] = volumen['Attachments'][0]['InstanceId']
+        sin_consultar = sorted({i for i in conectados.values()
+                                if i not in resueltos and i not in self.recursos})
+        resueltos.update(name_de_instancias(sin_consultar))
+        for volumen, instancia in conectados.items():
+            resueltos[volumen] = resueltos.get(instancia) or self.recursos.get(instancia)
+
+        hoy_texto = (hoy or date.today()).isoformat()
+        nuevos = 0
+        for recurso in pendientes:
+            name = resueltos.get(recurso)
+            if name:
+                self.recursos[recurso] = name
+                self.sin_name.pop(recurso, None)
+                nuevos += 1
+            else:
+                self.sin_name[recurso] = hoy_texto
+        return nuevos
+
+    def guardar(self):
+        temporal = self.ruta + '.tmp'
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump({'version': VERSION_INDICE, 'actualizado': datetime.now().isoformat(timespec='seconds'),
+                       'recursos': self.recursos, 'sin_name': self.sin_name}, f, indent=1, sort_keys=True)
+        os.replace(temporal, self.ruta)
+
+
+def _repartir_sin_etiqueta(grupos, clave, pesos):
+    """Mueve grupos[SIN_ETIQUETA][clave] a los Names de `pesos`; devuelve {name: movido}"""
+    sin = grupos.get(SIN_ETIQUETA, {}).get(clave, 0)
+    if sin <= 0 or sum(pesos.values()) <= 0 or set(pesos) <= {SIN_ETIQUETA}:
+        return {}
+    movidos = {name: parte for name, parte in repartir(sin, pesos).items() if name != SIN_ETIQUETA}
+    for name, parte in movidos.items():
+        grupos[name][clave] += parte
+    grupos[SIN_ETIQUETA][clave] -= sum(movidos.values())
+    return movidos
+
+
+def atribuir_sin_etiqueta(costos_base, desglose_ec2, costes_recursos, indice):
+    """Reparte el "Sin etiqueta" EC2 de base y desglose (una métrica) entre los Names
+
+    costos_base / desglose_ec2: {name: {servicio|categoria: importe}} (defaultdicts)
+    costes_recursos: {servicio: {(recurso, usage_type): importe}} de la ventana
+    Devuelve {name: importe movido desde "Sin etiqueta"} (base).
+    """
+    por_name = defaultdict(int)
+    pesos_categoria = defaultdict(lambda: defaultdict(int))
+    for servicio, filas in costes_recursos.items():
+        pesos = defaultdict(int)
+        for (recurso, usage_type), costo in filas.items():
+            if costo <= 0:
+                continue
+            name = indice.name(recurso) or SIN_ETIQUETA
+            pesos[name] += costo
+            pesos_categoria[categorizar_usage_type(usage_type)][name] += costo
+        for name, parte in _repartir_sin_etiqueta(costos_base, servicio, pesos).items():
+            por_name[name] += parte
+    for categoria, pesos in pesos_categoria.items():
+        _repartir_sin_etiqueta(desglose_ec2, categoria, pesos)
+    return por_name
+
+
+def aplicar_atribucion(cliente_ce, cliente_ec2, fecha_inicio, fecha_fin, base_m, desglose_m, metricas,
+                       ruta_indice=RUTA_INDICE_POR_DEFECTO):
+    """Flujo completo de --atribuir-recursos sobre {metrica: costos_base} / {metrica: desglose_ec2}
+
+    cliente_ec2 puede ser None (p. ej. con --replay): solo se usa el índice en disco.
+    """
+    print("\n🔗 Atribuyendo costes EC2 sin etiqueta por recurso...")
+    metricas = [m for m in metricas if m not in METRICAS_NO_ADITIVAS]
+    ventana = ventana_recursos(fecha_inicio, fecha_fin)
+    if ventana is None:
+        print(f"   ⚠️  El periodo queda fuera de los últimos {DIAS_VENTANA} días con datos por recurso: "
+              f"no se atribuye nada")
+        return
+    if not any(base_m[m].get(SIN_ETIQUETA, {}).get(s, 0) > 0 for m in metricas for s in SERVICIOS_EC2):
+        print("   ✅ No hay costes EC2 sin etiqueta")
+        return
+
+    print(f"   → Ventana con datos por recurso: {ventana[0]} a {ventana[1]}")
+    costes = obtener_costes_recursos(cliente_ce, ventana[0], ventana[1], metricas)
+    recursos = {r for filas in costes[metricas[0]].values() for r, _ in filas}
+    if not recursos:
+        print("   ⚠️  Cost Explorer no ha devuelto costes por recurso (¿datos por recurso sin activar?): "
+              "no se atribuye nada")
+        return
+
+    indice = IndiceRecursos(ruta_indice)
+    pendientes = indice.pendientes(recursos)
+    if pendientes and cliente_ec2 is not None:
+        nuevos = indice.completar(recursos, cliente_ec2)
+        print(f"   → Índice de recursos: {nuevos}/{len(pendientes)} nuevos resueltos con EC2")
+        indice.guardar()
+    resueltos = sum(1 for r in recursos if indice.name(r))
+    print(f"   → {len(recursos)} recursos sin etiqueta en la ventana, {resueltos} con Name en el índice")
+
+    for metrica in metricas:
+        movido = atribuir_sin_etiqueta(base_m[metrica], desglose_m[metrica], costes[metrica], indice)
+        if metrica == metricas[0]:
+            for name, importe_movido in sorted(movido.items(), key=lambda x: x[1], reverse=True)[:10]:
+                print(f"   → {name}: +${a_dolares(importe_movido):,.2f} desde '{SIN_ETIQUETA}'")
+            print(f"   ✅ Atribuido: ${a_dolares(sum(movido.values())):,.2f} a {len(movido)} Names")
@@ -10,8 +10,48 @@ import pandas as pd
 from datetime import datetime
 from collections import defaultdict
 import argparse
+import os
 import sys
 
+import dimensiones
+import exportacion
+import presupuesto_filas
+from dinero import a_dolares, desde_dolares, importe, porcentaje, repartir
+from consultas_ce import (
+    ClienteCEMedido, ClienteCEGrabador, ClienteCEReproductor, periodos_ce, valores_etiqueta,
+)
+from motor_async import CONCURRENCIA, MotorCEAsync
+from planificador_consultas import (
+    LOTE_VALORES_ETIQUETA, Consulta, Necesidad, demultiplexar, ejecutar_plan, ejecutar_por_etiqueta,
+)
+from ranking import totales_de, ordenar_por_total, top_n
+from variacion_mensual import comparar_con_anterior, escribir_hoja_variacion, guardar_instantanea
+
+# Servicios que Cost Explorer separa y que el informe fusiona como EC2
+SERVICIOS_EC2 = [
+    'Amazon Elastic Compute Cloud - Compute',
+    'EC2 - Other',
+    'Amazon Elastic Block Store'
+]
+
+# Agregaciones que necesitan los informes (ver planificador_consultas)
+NECESIDAD_BASE = Necesidad('base', ('SERVICE', 'TAG:Name'), None)
+NECESIDAD_EC2 = Necesidad('ec2', ('USAGE_TYPE', 'TAG:Name'), frozenset(SERVICIOS_EC2))
+NECESIDAD_BACKUP = Necesidad('backup', ('TAG:Name',), frozenset({'AWS Backup'}))
+
+# Métricas que se pueden pedir en la misma consulta (--metrics)
+METRICA_PRINCIPAL = 'UnblendedCost'
+METRICAS_DISPONIBLES = ['UnblendedCost', 'AmortizedCost', 'NetUnblendedCost', 'UsageQuantity']
+ETIQUETAS_METRICA = {
+    'UnblendedCost': 'Costo (US$)',
+    'AmortizedCost': 'Amortizado (US$)',
+    'NetUnblendedCost': 'Neto (US$)',
+    'UsageQuantity': 'Uso (cantidad)',
+}
+# Métricas que mezclan unidades (horas, GB, peticiones...): no se normalizan ni se suman en
+# totales; solo se muestran en las filas de detalle
+METRICAS_NO_ADITIVAS = {'UsageQuantity'}
+
 
 def obtener_rango_fechas(mes=None, anio=None):
     """
@@ -32,83 +72,291 @@ def obtener_rango_fechas(mes=None, anio=None):
     return fecha_inicio.strftime('%Y-%m-%d'), fecha_fin.strftime('%Y-%m-%d')
 
 
-def obtener_costos_base(cliente_ce, fecha_inicio, fecha_fin):
-    """Obtiene todos los costos agrupados por servicio y Name"""
-    print("📊 Obteniendo costos base por Name y Servicio...")
+def name_de_etiqueta(clave):
+    """'Name$valor' -> 'valor'; 'Name$' (recurso sin etiqueta) -> 'Sin etiqueta'"""
+    return clave.replace('Name$', '') if clave != 'Name$' else 'Sin etiqueta'
 
-    try:
-        response = cliente_ce.get_cost_and_usage(
-            TimePeriod={'Start': fecha_inicio, 'End': fecha_fin},
-            Granularity='MONTHLY',
-            Metrics=['UnblendedCost'],
-            GroupBy=[
-                {'Type': 'DIMENSION', 'Key': 'SERVICE'},
-                {'Type': 'TAG', 'Key': 'Name'}
-            ]
-        )
-
-        costos = defaultdict(lambda: defaultdict(float))
-        for periodo in response['ResultsByTime']:
-            for grupo in periodo['Groups']:
-                servicio = grupo['Keys'][0]
-                name = grupo['Keys'][1].replace('Name$', '') if grupo['Keys'][1] != 'Name$' else 'Sin etiqueta'
-                costo = float(grupo['Metrics']['UnblendedCost']['Amount'])
-
-                if costo > 0:
-                    costos[name][servicio] += costo
-
-        return costos
-    except Exception as e:
-        print(f"❌ Error: {e}")
+
+def _granularidad(por_dia):
+    return 'DAILY' if por_dia else 'MONTHLY'
+
+
+def _costos_base_desde_filas(filas, metricas, por_dia):
+    """Filas SERVICE × Name del planificador -> estructura de obtener_costos_base"""
+    metricas_consulta = metricas or [METRICA_PRINCIPAL]
+    costos = {m: defaultdict(lambda: defaultdict(int)) for m in metricas_consulta}
+    diario = {m: defaultdict(lambda: defaultdict(lambda: defaultdict(int))) for m in metricas_consulta}
+    for periodo, (servicio, etiqueta), valores in filas:
+        name = name_de_etiqueta(etiqueta)
+
+        for metrica in metricas_consulta:
+            costo = valores[metrica]
+
+            if por_dia:
+                if costo != 0:
+                    diario[metrica][periodo][name][servicio] += costo
+            elif costo > 0:
+                costos[metrica][name][servicio] += costo
+
+    if por_dia:
+        costos = diario
+    return costos if metricas else costos[METRICA_PRINCIPAL]
+
+
+def _desglose_desde_filas(filas, names_con_ec2, metricas, por_dia):
+    """Filas USAGE_TYPE × Name del planificador -> estructura de obtener_desglose_ec2_completo"""
+    metricas_consulta = metricas or [METRICA_PRINCIPAL]
+    desglose = {m: defaultdict(lambda: defaultdict(int)) for m in metricas_consulta}
+    diario = {m: defaultdict(lambda: defaultdict(lambda: defaultdict(int))) for m in metricas_consulta}
+    for periodo, (usage_type, etiqueta), valores in filas:
+        name = name_de_etiqueta(etiqueta)
+
+        # ✅ CRÍTICO: Solo agregar si este Name tiene EC2 en costos_base
+        # Esto evita capturar recursos sin etiqueta que AWS asocia automáticamente
+        if name not in names_con_ec2:
+            continue
+
+        for metrica in metricas_consulta:
+            costo = valores[metrica]
+            if por_dia:
+                if costo != 0 or 'boxusage' in usage_type.lower():
+                    diario[metrica][periodo][name][usage_type] += costo
+                continue
+            # Incluir si tiene costo > 0 O si es una instancia EC2 (para visibilidad de Savings Plans/Reserved)
+            es_instancia = 'boxusage' in usage_type.lower()
+            if costo > 0 or es_instancia:
+                categoria = categorizar_usage_type(usage_type)
+                desglose[metrica][name][categoria] += costo
+
+    if por_dia:
+        desglose = diario
+    return desglose if metricas else desglose[METRICA_PRINCIPAL]
+
+
+def _backup_desde_filas(filas, metricas, por_dia):
+    """Filas por Name (servicio AWS Backup) -> estructura de obtener_costos_backup"""
+    metricas_consulta = metricas or [METRICA_PRINCIPAL]
+    backup_costs = {m: defaultdict(int) for m in metricas_consulta}
+    diario = {m: defaultdict(lambda: defaultdict(int)) for m in metricas_consulta}
+    for periodo, (etiqueta,), valores in filas:
+        name = name_de_etiqueta(etiqueta)
+
+        for metrica in metricas_consulta:
+            costo = valores[metrica]
+
+            if por_dia:
+                if costo != 0:
+                    diario[metrica][periodo][name] += costo
+            elif costo > 0:
+                backup_costs[metrica][name] += costo
+
+    if por_dia:
+        backup_costs = diario
+    return backup_costs if metricas else backup_costs[METRICA_PRINCIPAL]
+
+
+def obtener_costos_base(cliente_ce, fecha_inicio, fecha_fin, por_dia=False, metricas=None):
+    """Obtiene todos los costos agrupados por servicio y Name
+
+    Con por_dia=True consulta con granularidad DAILY y devuelve
+    {fecha: {name: {servicio: costo}}} sin descartar importes negativos
+    (el filtro de costo > 0 se aplica después, sobre el total del mes).
+
+    Con metricas=[...] pide todas las métricas en la MISMA consulta y devuelve
+    {metrica: {name: {servicio: valor}}}, una estructura paralela por métrica
+    (también con por_dia=True: {metrica: {fecha: ...}}).
+    """
+    print("📊 Obteniendo costos base por Name y Servicio...")
+    filas = ejecutar_plan(cliente_ce, [NECESIDAD_BASE], fecha_inicio, fecha_fin,
+                          metricas or [METRICA_PRINCIPAL], _granularidad(por_dia))['base']
+    if filas is None:
+        print("❌ Error: no se pudieron obtener los costos base")
         sys.exit(1)
+    return _costos_base_desde_filas(filas, metricas, por_dia)
 
 
-def obtener_desglose_ec2_completo(cliente_ce, fecha_inicio, fecha_fin, names_con_ec2):
-    """Obtiene el desglose COMPLETO de EC2 por Usage Type - SOLO para Names que ya tienen EC2"""
+def _names_con_ec2(filas_base, por_dia):
+    """Names con EC2 en las filas base (en cualquier métrica: con Savings Plans el UnblendedCost puede ser 0)"""
+    return {
+        name_de_etiqueta(etiqueta)
+        for _, (servicio, etiqueta), valores in filas_base
+        if servicio in SERVICIOS_EC2 and any((v != 0) if por_dia else (v > 0) for v in valores.values())
+    }
+
+
+def _filas_ec2(cliente_ce, fecha_inicio, fecha_fin, names_con_ec2, por_dia, metricas, filas_base=None):
+    """Filas USAGE_TYPE × Name del desglose EC2, pedidas SOLO para names_con_ec2
+
+    El conjunto de Names va en el filtro de la consulta (lotes en paralelo): Cost
+    Explorer no devuelve las filas que _desglose_desde_filas descartaría. Si las
+    filas base muestran que el filtro no quitaría ninguna (todos los Names con
+    EC2 la tienen con importe), basta una consulta sin filtrar.
+    """
+    if filas_base is not None:
+        names_ec2_en_base = {name_de_etiqueta(etiqueta) for _, (servicio, etiqueta), _ in filas_base
+                             if servicio in SERVICIOS_EC2}
+        if names_ec2_en_base <= names_con_ec2:
+            return ejecutar_plan(cliente_ce, [NECESIDAD_EC2], fecha_inicio, fecha_fin,
+                                 metricas or [METRICA_PRINCIPAL], _granularidad(por_dia))['ec2']
+    valores = ['' if name == 'Sin etiqueta' else name for name in names_con_ec2]
+    return ejecutar_por_etiqueta(cliente_ce, NECESIDAD_EC2, 'TAG:Name', valores, fecha_inicio, fecha_fin,
+                                 metricas or [METRICA_PRINCIPAL], _granularidad(por_dia))
+
+
+def obtener_desglose_ec2_completo(cliente_ce, fecha_inicio, fecha_fin, names_con_ec2, por_dia=False,
+                                  metricas=None):
+    """Obtiene el desglose COMPLETO de EC2 por Usage Type - SOLO para Names que ya tienen EC2
+
+    Los servicios de SERVICIOS_EC2 se piden juntos, con un filtro multi-valor, y
+    los Names en el filtro de etiqueta (ver _filas_ec2).
+
+    Con por_dia=True devuelve {fecha: {name: {usage_type: costo}}} SIN categorizar
+    ni filtrar por importe; categorizar_desglose() aplica después el mismo criterio
+    sobre el total del mes.
+
+    Con metricas=[...] devuelve {metrica: {name: {categoria: valor}}} (o {metrica: {fecha: ...}}).
+    """
     print("🔍 Desglosando EC2 en detalle...")
+    filas = _filas_ec2(cliente_ce, fecha_inicio, fecha_fin, names_con_ec2, por_dia, metricas)
+    return _desglose_desde_filas(filas or [], names_con_ec2, metricas, por_dia)
 
-    desglose = defaultdict(lambda: defaultdict(float))
 
-    # Todos los servicios relacionados con EC2
-    servicios_ec2 = [
-        'Amazon Elastic Compute Cloud - Compute',
-        'EC2 - Other',
-        'Amazon Elastic Block Store'
-    ]
+def obtener_costos_backup(cliente_ce, fecha_inicio, fecha_fin, por_dia=False, metricas=None):
+    """Obtiene costos de AWS Backup por Name (sin necesidad de etiqueta especial)
 
-    for servicio in servicios_ec2:
-        print(f"   → {servicio}")
-        try:
-            response = cliente_ce.get_cost_and_usage(
-                TimePeriod={'Start': fecha_inicio, 'End': fecha_fin},
-                Granularity='MONTHLY',
-                Metrics=['UnblendedCost'],
-                Filter={'Dimensions': {'Key': 'SERVICE', 'Values': [servicio]}},
-                GroupBy=[
-                    {'Type': 'DIMENSION', 'Key': 'USAGE_TYPE'},
-                    {'Type': 'TAG', 'Key': 'Name'}
-                ]
-            )
-
-            for periodo in response['ResultsByTime']:
-                for grupo in periodo['Groups']:
-                    usage_type = grupo['Keys'][0]
-                    name = grupo['Keys'][1].replace('Name$', '') if grupo['Keys'][1] != 'Name$' else 'Sin etiqueta'
-                    costo = float(grupo['Metrics']['UnblendedCost']['Amount'])
-
-                    # ✅ CRÍTICO: Solo agregar si este Name tiene EC2 en costos_base
-                    # Esto evita capturar recursos sin etiqueta que AWS asocia automáticamente
-                    if name in names_con_ec2:
-                        # Incluir si tiene costo > 0 O si es una instancia EC2 (para visibilidad de Savings Plans/Reserved)
-                        es_instancia = 'boxusage' in usage_type.lower()
-                        if costo > 0 or es_instancia:
-                            categoria = categorizar_usage_type(usage_type)
-                            desglose[name][categoria] += costo
+    Con por_dia=True devuelve {fecha: {name: costo}} sin filtrar por importe.
+    Con metricas=[...] devuelve {metrica: {name: valor}} (o {metrica: {fecha: ...}}).
+    """
+    print("💾 Obteniendo costos de AWS Backup...")
+    filas = ejecutar_plan(cliente_ce, [NECESIDAD_BACKUP], fecha_inicio, fecha_fin,
+                          metricas or [METRICA_PRINCIPAL], _granularidad(por_dia))['backup']
+    return _backup_desde_filas(filas or [], metricas, por_dia)
 
-        except Exception as e:
-            print(f"   ⚠️  {e}")
-            continue
 
+def _filas_base_fragmentadas(cliente_ce, fecha_inicio, fecha_fin, por_dia, metricas, fragmentos):
+    """SERVICE × Name en `fragmentos` consultas paralelas, cada una filtrada a una parte de los Names
+
+    En cuentas con decenas de miles de Names la consulta base es una larga
+    cadena de páginas que solo se puede recorrer en serie. Los Names del
+    periodo (get_tags, paginado) se reparten en fragmentos del mismo tamaño
+    (como máximo LOTE_VALORES_ETIQUETA por filtro) más uno para los recursos
+    sin etiqueta, y cada fragmento se pagina en su propio hilo. Como los
+    fragmentos no se solapan, las filas se concatenan tal cual.
+
+    Si los fragmentos no suman el total de la cuenta (_comprobar_fragmentos),
+    se repite la consulta base sin fragmentar: el informe nunca se queda corto.
+    """
+    metricas_consulta = metricas or [METRICA_PRINCIPAL]
+    names = valores_etiqueta(cliente_ce, 'Name', fecha_inicio, fecha_fin)
+    lote = min(LOTE_VALORES_ETIQUETA, max(1, -(-len(names) // fragmentos)))
+    print(f"🧩 {len(names)} Names en el periodo → fragmentos de {lote} Names + sin etiqueta")
+    filas = ejecutar_por_etiqueta(cliente_ce, NECESIDAD_BASE, 'TAG:Name', names + [''], fecha_inicio, fecha_fin,
+                                  metricas_consulta, _granularidad(por_dia), lote=lote, hilos=fragmentos)
+    if filas is not None and not _comprobar_fragmentos(cliente_ce, fecha_inicio, fecha_fin, por_dia, filas):
+        print("   🔁 Se repite la consulta base sin fragmentar")
+        filas = ejecutar_plan(cliente_ce, [NECESIDAD_BASE], fecha_inicio, fecha_fin, metricas_consulta,
+                              _granularidad(por_dia))['base']
+    return filas
+
+
+def _comprobar_fragmentos(cliente_ce, fecha_inicio, fecha_fin, por_dia, filas):
+    """¿Suman los fragmentos el total sin agrupar de la cuenta? (una petición más)
+
+    Un Name que get_tags no devolviera quedaría fuera de todos los fragmentos.
+    """
+    total = sum(importe(periodo['Total'][METRICA_PRINCIPAL]['Amount'])
+                for periodo in periodos_ce(cliente_ce, TimePeriod={'Start': fecha_inicio, 'End': fecha_fin},
+                                           Granularity=_granularidad(por_dia), Metrics=[METRICA_PRINCIPAL]))
+    total_fragmentos = sum(valores[METRICA_PRINCIPAL] for _, _, valores in filas)
+    diferencia = total_fragmentos - total
+    if abs(diferencia) < desde_dolares(0.01):  # redondeo por grupo de Cost Explorer
+        print(f"   ✅ Fragmentos = total de la cuenta (${a_dolares(total):,.2f})")
+        return True
+    print(f"   ⚠️  Los fragmentos suman ${a_dolares(total_fragmentos):,.2f} y la cuenta "
+          f"${a_dolares(total):,.2f}: faltan Names en get_tags")
+    return False
+
+
+def filas_informe(cliente_ce, fecha_inicio, fecha_fin, por_dia, metricas, extra=(), fragmentos=None):
+    """Base y Backup (y `extra`) en un plan; después el desglose EC2 filtrado por los Names con EC2
+
+    Con `fragmentos` la consulta base se pide fragmentada por Name
+    (_filas_base_fragmentadas) y Backup se deriva de ella en memoria.
+    Devuelve {'base', 'backup', 'ec2', nombres de `extra`} con las filas del
+    planificador (None si falla su consulta); sale con ❌ si falla la base.
+    """
+    if fragmentos:
+        filas = ejecutar_plan(cliente_ce, list(extra), fecha_inicio, fecha_fin,
+                              metricas or [METRICA_PRINCIPAL], _granularidad(por_dia)) if extra else {}
+        filas['base'] = _filas_base_fragmentadas(cliente_ce, fecha_inicio, fecha_fin, por_dia, metricas, fragmentos)
+        filas['backup'] = demultiplexar(Consulta(NECESIDAD_BASE.agrupar, None), NECESIDAD_BACKUP, filas['base'],
+                                        metricas or [METRICA_PRINCIPAL])
+    else:
+        filas = ejecutar_plan(cliente_ce, [NECESIDAD_BASE, NECESIDAD_BACKUP, *extra],
+                              fecha_inicio, fecha_fin, metricas or [METRICA_PRINCIPAL], _granularidad(por_dia))
+    if filas['base'] is None:
+        print("❌ Error: no se pudieron obtener los costos base")
+        sys.exit(1)
+    filas['ec2'] = _filas_ec2(cliente_ce, fecha_inicio, fecha_fin, _names_con_ec2(filas['base'], por_dia),
+                              por_dia, metricas, filas['base'])
+    return filas
+
+
+def obtener_costos_informe(cliente_ce, fecha_inicio, fecha_fin, por_dia=False, metricas=None, fragmentos=None):
+    """Base, desglose EC2 y AWS Backup con el mínimo de consultas
+
+    El planificador pide SERVICE × Name y deriva Backup por Name de ella; después
+    USAGE_TYPE × Name (servicios EC2) solo para los Names con EC2, en lugar de
+    las 5 consultas del flujo por pasos. Devuelve (costos_base, desglose_ec2, backup_costs) con la misma
+    forma que las tres funciones anteriores. Con fragmentos=N la consulta base
+    se reparte en N consultas paralelas por Name (cuentas muy grandes).
+    """
+    print("📊 Obteniendo costos base, desglose EC2 y AWS Backup...")
+    filas = filas_informe(cliente_ce, fecha_inicio, fecha_fin, por_dia, metricas, fragmentos=fragmentos)
+    return costos_informe_desde_filas(filas, metricas, por_dia)
+
+
+def obtener_costos_informe_dimensiones(cliente_ce, fecha_inicio, fecha_fin, combinaciones, metricas=None,
+                                       fragmentos=None):
+    """Como obtener_costos_informe, más las dimensiones de --dimensiones en el MISMO plan
+
+    Devuelve (costos_base, desglose_ec2, backup_costs, modelo); `modelo` es el
+    de dimensiones.modelo_desde_filas (métrica principal).
+    """
+    print(f"📊 Obteniendo costos base, desglose EC2, AWS Backup y "
+          f"{len(dimensiones.claves_a_consultar(combinaciones))} dimensiones...")
+    filas = filas_informe(cliente_ce, fecha_inicio, fecha_fin, False, metricas,
+                           dimensiones.necesidades(combinaciones), fragmentos)
+    return (*costos_informe_desde_filas(filas, metricas),
+            dimensiones.modelo_desde_filas(filas, METRICA_PRINCIPAL))
+
+
+def costos_informe_desde_filas(filas, metricas=None, por_dia=False):
+    """{'base', 'ec2', 'backup'} en filas del planificador -> (costos_base, desglose_ec2, backup_costs)
+
+    Común a Cost Explorer y a otras fuentes (CUR) que producen las mismas filas.
+    """
+    # ✅ Names con EC2 en costos_base; limitan el desglose igual que en el flujo por pasos
+    names_con_ec2 = _names_con_ec2(filas['base'], por_dia)
+    print(f"   → {len(names_con_ec2)} Names con costos EC2 detectados")
+
+    return (_costos_base_desde_filas(filas['base'], metricas, por_dia),
+            _desglose_desde_filas(filas['ec2'] or [], names_con_ec2, metricas, por_dia),
+            _backup_desde_filas(filas['backup'] or [], metricas, por_dia))
+
+
+def categorizar_desglose(por_usage_type):
+    """Convierte {name: {usage_type: costo}} en {name: {categoria: costo}}
+
+    Aplica el mismo criterio que obtener_desglose_ec2_completo: se incluye el
+    usage type si tiene costo > 0 o si es una instancia (Savings Plans/Reserved).
+    """
+    desglose = defaultdict(lambda: defaultdict(int))
+    for name, usage_types in por_usage_type.items():
+        for usage_type, costo in usage_types.items():
+            es_instancia = 'boxusage' in usage_type.lower()
+            if costo > 0 or es_instancia:
+                desglose[name][categorizar_usage_type(usage_type)] += costo
     return desglose
 
 
@@ -209,37 +457,13 @@ def categorizar_usage_type(usage_type):
         return f'EC2 - {tipo_limpio}'
 
 
-def obtener_costos_backup(cliente_ce, fecha_inicio, fecha_fin):
-    """Obtiene costos de AWS Backup por Name (sin necesidad de etiqueta especial)"""
-    print("💾 Obteniendo costos de AWS Backup...")
-
-    backup_costs = defaultdict(float)
-
-    try:
-        response = cliente_ce.get_cost_and_usage(
-            TimePeriod={'Start': fecha_inicio, 'End': fecha_fin},
-            Granularity='MONTHLY',
-            Metrics=['UnblendedCost'],
-            Filter={'Dimensions': {'Key': 'SERVICE', 'Values': ['AWS Backup']}},
-            GroupBy=[{'Type': 'TAG', 'Key': 'Name'}]
-        )
-
-        for periodo in response['ResultsByTime']:
-            for grupo in periodo['Groups']:
-                name = grupo['Keys'][0].replace('Name$', '') if grupo['Keys'][0] != 'Name$' else 'Sin etiqueta'
-                costo = float(grupo['Metrics']['UnblendedCost']['Amount'])
-
-                if costo > 0:
-                    backup_costs[name] += costo
-
-        return backup_costs
-    except Exception as e:
-        print(f"⚠️  Advertencia Backup: {e}")
-        return {}
-
-
 def normalizar_desglose_ec2(costos_base, desglose_ec2):
-    """Normaliza el desglose EC2 para que coincida exactamente con costos_base por Name"""
+    """Normaliza el desglose EC2 para que coincida exactamente con costos_base por Name
+
+    El total EC2 de costos_base se reparte entre las categorías en proporción
+    a su importe (resto mayor, en micro-céntimos): la suma por Name es
+    EXACTAMENTE la de costos_base.
+    """
     print("🔧 Normalizando desglose EC2...")
 
     servicios_ec2 = [
@@ -248,7 +472,7 @@ def normalizar_desglose_ec2(costos_base, desglose_ec2):
         'Amazon Elastic Block Store'
     ]
 
-    desglose_normalizado = defaultdict(lambda: defaultdict(float))
+    desglose_normalizado = defaultdict(lambda: defaultdict(int))
 
     for name in desglose_ec2.keys():
         # Total EC2 en costos_base para este Name
@@ -258,15 +482,12 @@ def normalizar_desglose_ec2(costos_base, desglose_ec2):
         total_desglose = sum(desglose_ec2[name].values())
 
         if total_desglose > 0 and total_base > 0:
-            # Factor de normalización
-            factor = total_base / total_desglose
-
-            # Aplicar factor a cada categoría
-            for categoria, costo in desglose_ec2[name].items():
-                desglose_normalizado[name][categoria] = costo * factor
+            # Repartir el total de la base en proporción al desglose
+            desglose_normalizado[name].update(repartir(total_base, desglose_ec2[name]))
 
+            factor = total_base / total_desglose
             if abs(factor - 1.0) > 0.01:
-                print(f"   ⚙️  {name}: factor={factor:.3f} (base=${total_base:.2f}, desglose=${total_desglose:.2f})")
+                print(f"   ⚙️  {name}: factor={factor:.3f} (base=${a_dolares(total_base):.2f}, desglose=${a_dolares(total_desglose):.2f})")
         elif total_desglose == 0 and len(desglose_ec2[name]) > 0:
             # ✅ Caso especial: Instancias con costo $0 (Savings Plans/Reserved)
             # Copiar las categorías sin normalizar (son $0 de todas formas)
@@ -278,7 +499,7 @@ def normalizar_desglose_ec2(costos_base, desglose_ec2):
                 print(f"   💰 {name}: {', '.join(instancias_cero)} (Savings Plan/Reserved - $0)")
         elif total_base > 0:
             # Hay costos en base pero no en desglose - mantener base sin desglosar
-            print(f"   ⚠️  {name}: tiene EC2 en base (${total_base:.2f}) pero no en desglose")
+            print(f"   ⚠️  {name}: tiene EC2 en base (${a_dolares(total_base):.2f}) pero no en desglose")
 
     return desglose_normalizado
 
@@ -296,8 +517,8 @@ def diagnosticar_ec2(costos_base, desglose_ec2):
 
     # Total EC2 en costos_base
     total_ec2_base = 0
-    ec2_por_name = defaultdict(float)
-    ec2_por_servicio = defaultdict(float)
+    ec2_por_name = defaultdict(int)
+    ec2_por_servicio = defaultdict(int)
 
     for name, servicios in costos_base.items():
         for servicio in servicios_ec2:
@@ -310,48 +531,53 @@ def diagnosticar_ec2(costos_base, desglose_ec2):
     # Total EC2 en desglose
     total_ec2_desglose = sum(sum(cats.values()) for cats in desglose_ec2.values())
 
-    print(f"Total EC2 en costos_base: ${total_ec2_base:,.2f}")
+    print(f"Total EC2 en costos_base: ${a_dolares(total_ec2_base):,.2f}")
     for servicio in servicios_ec2:
-        print(f"  - {servicio}: ${ec2_por_servicio[servicio]:,.2f}")
+        print(f"  - {servicio}: ${a_dolares(ec2_por_servicio[servicio]):,.2f}")
 
-    print(f"\nTotal EC2 en desglose: ${total_ec2_desglose:,.2f}")
+    print(f"\nTotal EC2 en desglose: ${a_dolares(total_ec2_desglose):,.2f}")
     diferencia = total_ec2_base - total_ec2_desglose
-    print(f"Diferencia: ${diferencia:,.2f}")
+    print(f"Diferencia: ${a_dolares(diferencia):,.2f}")
 
-    if abs(diferencia) > 0.01:
-        print(f"\n⚠️  ¡DIFERENCIA DE ${abs(diferencia):,.2f}!")
+    if diferencia != 0:
+        print(f"\n⚠️  ¡DIFERENCIA DE ${a_dolares(abs(diferencia)):,.2f}!")
 
         # Names que tienen EC2 en base pero NO en desglose
         names_solo_base = set(ec2_por_name.keys()) - set(desglose_ec2.keys())
         if names_solo_base:
             total_sin_desglose = sum(ec2_por_name[n] for n in names_solo_base)
             print(f"\n⚠️  Names con EC2 en base pero SIN desglose ({len(names_solo_base)}):")
-            print(f"    Total sin desglose: ${total_sin_desglose:,.2f}")
-            for name in sorted(names_solo_base, key=lambda x: ec2_por_name[x], reverse=True)[:5]:
-                print(f"  - {name}: ${ec2_por_name[name]:,.2f}")
+            print(f"    Total sin desglose: ${a_dolares(total_sin_desglose):,.2f}")
+            for name, costo in top_n({n: ec2_por_name[n] for n in names_solo_base}, 5):
+                print(f"  - {name}: ${a_dolares(costo):,.2f}")
 
         # Comparar totales por Name
         print(f"\n📊 Mayores diferencias por Name:")
-        diferencias = []
+        diferencias = {}
         for name in set(ec2_por_name.keys()) | set(desglose_ec2.keys()):
             base = ec2_por_name[name]
             desg = sum(desglose_ec2.get(name, {}).values())
-            if abs(base - desg) > 0.01:
-                diferencias.append((name, base, desg, base - desg))
+            if base != desg:
+                diferencias[name] = (base, desg, base - desg)
 
-        for name, base, desg, diff in sorted(diferencias, key=lambda x: abs(x[3]), reverse=True)[:5]:
-            print(f"  {name}: Base=${base:.2f}, Desglose=${desg:.2f}, Diff=${diff:.2f}")
+        for name, (base, desg, diff) in top_n(diferencias, 5, clave=lambda x: abs(x[1][2])):
+            print(f"  {name}: Base=${a_dolares(base):.2f}, Desglose=${a_dolares(desg):.2f}, Diff=${a_dolares(diff):.2f}")
     else:
         print(f"✅ Desglose EC2 completo y correcto")
 
     return total_ec2_base, total_ec2_desglose
 
 
-def procesar_datos(costos_base, desglose_ec2, backup_costs):
-    """Procesa y combina todos los datos SIN DUPLICACIONES"""
-    print("\n⚙️  Procesando datos...")
+def procesar_datos(costos_base, desglose_ec2, backup_costs, verbose=True):
+    """Procesa y combina todos los datos SIN DUPLICACIONES
 
-    datos_finales = defaultdict(lambda: {'servicios': defaultdict(float)})
+    Con verbose=False se omiten la verificación y el listado de depuración
+    (se usa para las métricas adicionales de --metrics).
+    """
+    if verbose:
+        print("\n⚙️  Procesando datos...")
+
+    datos_finales = defaultdict(lambda: {'servicios': defaultdict(int)})
 
     # Servicios EC2 que serán reemplazados por el desglose
     servicios_ec2_a_reemplazar = {
@@ -385,17 +611,20 @@ def procesar_datos(costos_base, desglose_ec2, backup_costs):
         if name in backup_costs:
             datos_finales[name]['servicios']['AWS Backup'] += backup_costs[name]
 
+    if not verbose:
+        return datos_finales
+
     # Verificación de totales
     total_procesado = sum(sum(info['servicios'].values()) for info in datos_finales.values())
     total_base = sum(sum(servicios.values()) for servicios in costos_base.values())
 
-    print(f"Total en costos_base: ${total_base:,.2f}")
-    print(f"Total procesado: ${total_procesado:,.2f}")
+    print(f"Total en costos_base: ${a_dolares(total_base):,.2f}")
+    print(f"Total procesado: ${a_dolares(total_procesado):,.2f}")
 
-    if abs(total_procesado - total_base) > 1:
-        print(f"⚠️  Diferencia en procesamiento: ${abs(total_procesado - total_base):,.2f}")
+    if total_procesado != total_base:
+        print(f"⚠️  Diferencia en procesamiento: ${a_dolares(abs(total_procesado - total_base)):,.2f}")
     else:
-        print(f"✅ Procesamiento correcto (diferencia: ${abs(total_procesado - total_base):.2f})")
+        print("✅ Procesamiento correcto (sin diferencia)")
 
     # 🔍 DEBUG: Mostrar todos los servidores procesados
     print("\n" + "=" * 70)
@@ -415,13 +644,13 @@ def procesar_datos(costos_base, desglose_ec2, backup_costs):
         print(f"\n   ⚠️  SERVIDORES EN costos_base PERO NO EN datos_finales ({len(faltantes)}):")
         for name in sorted(faltantes):
             total = sum(costos_base[name].values())
-            print(f"      - {name}: ${total:.2f}")
+            print(f"      - {name}: ${a_dolares(total):.2f}")
 
     if extras:
         print(f"\n   ⚠️  SERVIDORES EN datos_finales PERO NO EN costos_base ({len(extras)}):")
         for name in sorted(extras):
             total = sum(datos_finales[name]['servicios'].values())
-            print(f"      - {name}: ${total:.2f}")
+            print(f"      - {name}: ${a_dolares(total):.2f}")
 
     if not faltantes and not extras:
         print("   ✅ Todos los servidores de costos_base están en datos_finales")
@@ -430,24 +659,83 @@ def procesar_datos(costos_base, desglose_ec2, backup_costs):
     print(f"\n   📋 Lista completa de servidores en datos_finales:")
     for name in sorted(nombres_en_datos):
         total = sum(datos_finales[name]['servicios'].values())
-        print(f"      - {name}: ${total:.2f}")
+        print(f"      - {name}: ${a_dolares(total):.2f}")
     print("=" * 70)
 
     return datos_finales
 
 
-def crear_excel(datos, fecha_inicio, fecha_fin, nombre_archivo, es_partner=False, porcentaje_descuento=5.0):
-    """Crea el archivo Excel con los resultados"""
+def preparar_metricas(metricas):
+    """Lista de métricas a consultar: la principal siempre primero y sin duplicados"""
+    return [METRICA_PRINCIPAL] + [m for m in dict.fromkeys(metricas or []) if m != METRICA_PRINCIPAL]
+
+
+def alinear_metricas(datos, metricas_extra):
+    """Añade con 0 a `datos` los Name/servicio que solo existen en otras métricas
+
+    Por ejemplo, una instancia cubierta por Savings Plans tiene UnblendedCost 0
+    pero AmortizedCost > 0: la fila debe aparecer para mostrar la columna extra.
+    """
+    for datos_m in metricas_extra.values():
+        for name, info in datos_m.items():
+            for servicio in info['servicios']:
+                datos[name]['servicios'][servicio] += 0
+    return datos
+
+
+def crear_excel(datos, fecha_inicio, fecha_fin, nombre_archivo, es_partner=False, porcentaje_descuento=5.0,
+                metricas_extra=None, cruces=None, variacion=None, anomalias=None, prevision=None,
+                max_filas=presupuesto_filas.LIMITE_FILAS_EXCEL, desborde='hojas', tabla_dinamica=False):
+    """Crea el archivo Excel con los resultados
+
+    metricas_extra: {metrica: datos} con la misma forma que `datos`; cada métrica
+    añade una columna paralela junto a 'Costo (US$)'.
+    cruces: [(combinacion, {valores: {name: costo}})] de --dimensiones; una hoja
+    'Por ...' por combinación.
+    variacion: resultado de variacion_mensual.comparar_con_anterior (hoja 'Variación').
+    anomalias: lista de anomalias.detectar (hoja 'Anomalías').
+    prevision: resultado de prevision.PrevisionMes.resultados (hoja 'Previsión').
+    max_filas, desborde: presupuesto de filas de 'Detalle de Costos' (--max-filas, --desborde):
+    los Names que no caben van a hojas de continuación o a un CSV (ver presupuesto_filas).
+    tabla_dinamica: en lugar de 'Detalle de Costos', hoja 'Datos' con tablas dinámicas de
+    Excel por Name y por servicio (ver tabla_dinamica).
+    """
     print("\n📝 Creando Excel...")
+    metricas_extra = metricas_extra or {}
+    columnas_extra = {m: ETIQUETAS_METRICA[m] for m in metricas_extra}
+
+    # Total de cada Name calculado una sola vez (ranking y filas de total)
+    def total_name(info):
+        return sum(info['servicios'].values())
+    totales_name = totales_de(datos, total_name)
+    totales_extra = {m: totales_de(d, total_name) for m, d in metricas_extra.items()}
+
+    def valores_extra(name=None, servicio=None, vacio=False):
+        """Columnas de las métricas extra para una fila (total, Name o Name+servicio)
+
+        Las métricas de METRICAS_NO_ADITIVAS solo tienen valor en las filas Name+servicio.
+        """
+        fila = {}
+        for metrica, columna in columnas_extra.items():
+            datos_m = metricas_extra[metrica]
+            if vacio or (servicio is None and metrica in METRICAS_NO_ADITIVAS):
+                fila[columna] = ''
+            elif name is None:
+                fila[columna] = a_dolares(sum(totales_extra[metrica].values()))
+            elif servicio is None:
+                fila[columna] = a_dolares(totales_extra[metrica].get(name, 0))
+            else:
+                fila[columna] = a_dolares(datos_m[name]['servicios'].get(servicio, 0) if name in datos_m else 0)
+        return fila
 
     # Calcular total general
-    costo_total = sum(sum(info['servicios'].values()) for info in datos.values())
+    costo_total = sum(totales_name.values())
 
     # Calcular descuento si es partner
     monto_descuento = 0
     costo_con_descuento = costo_total
     if es_partner:
-        monto_descuento = costo_total * (porcentaje_descuento / 100)
+        monto_descuento = porcentaje(costo_total, porcentaje_descuento)
         costo_con_descuento = costo_total - monto_descuento
 
     filas = []
@@ -456,7 +744,8 @@ def crear_excel(datos, fecha_inicio, fecha_fin, nombre_archivo, es_partner=False
     filas.append({
         'Name': '*** TOTAL GENERAL ***',
         'Servicio': '',
-        'Costo (US$)': round(costo_total, 2)
+        'Costo (US$)': a_dolares(costo_total),
+        **valores_extra()
     })
 
     # Si es partner, añadir línea de descuento
@@ -464,58 +753,69 @@ def crear_excel(datos, fecha_inicio, fecha_fin, nombre_archivo, es_partner=False
         filas.append({
             'Name': f'Descuento Partner ({porcentaje_descuento}%)',
             'Servicio': '',
-            'Costo (US$)': round(-monto_descuento, 2)
+            'Costo (US$)': a_dolares(-monto_descuento)
         })
         filas.append({
             'Name': '*** TOTAL CON DESCUENTO ***',
             'Servicio': '',
-            'Costo (US$)': round(costo_con_descuento, 2)
+            'Costo (US$)': a_dolares(costo_con_descuento)
         })
 
     # Línea en blanco separadora
-    filas.append({'Name': '', 'Servicio': '', 'Costo (US$)': ''})
-    filas.append({'Name': '', 'Servicio': '', 'Costo (US$)': ''})
+    filas.append({'Name': '', 'Servicio': '', 'Costo (US$)': '', **valores_extra(vacio=True)})
+    filas.append({'Name': '', 'Servicio': '', 'Costo (US$)': '', **valores_extra(vacio=True)})
 
     # Ordenar por costo total descendente
-    datos_ordenados = sorted(
-        datos.items(),
-        key=lambda x: sum(x[1]['servicios'].values()),
-        reverse=True
-    )
+    datos_ordenados = ordenar_por_total(totales_name)
 
-    for name, info in datos_ordenados:
-        total = sum(info['servicios'].values())
-
-        # Fila de total
-        filas.append({
+    # Un bloque por Name: fila de total, servicios ordenados por costo y línea en blanco
+    def bloque(name, total):
+        filas_name = [{
             'Name': name,
             'Servicio': '*** TOTAL ***',
-            'Costo (US$)': round(total, 2)
-        })
-
-        # Servicios ordenados por costo
-        for servicio, costo in sorted(info['servicios'].items(), key=lambda x: x[1], reverse=True):
-            filas.append({
+            'Costo (US$)': a_dolares(total),
+            **valores_extra(name)
+        }]
+        for servicio, costo in ordenar_por_total(datos[name]['servicios']):
+            filas_name.append({
                 'Name': '',
                 'Servicio': servicio,
-                'Costo (US$)': round(costo, 2)
+                'Costo (US$)': a_dolares(costo),
+                **valores_extra(name, servicio)
             })
-
-        # Línea en blanco
-        filas.append({'Name': '', 'Servicio': '', 'Costo (US$)': ''})
-
-    df = pd.DataFrame(filas)
+        filas_name.append({'Name': '', 'Servicio': '', 'Costo (US$)': '', **valores_extra(vacio=True)})
+        return filas_name
+
+    # --tabla-dinamica: el dataset (una fila por Name y servicio) va en una sola hoja
+    if tabla_dinamica and sum(len(info['servicios']) for info in datos.values()) + 1 > max_filas:
+        print("   ⚠️  El dataset de la tabla dinámica supera --max-filas: se escribe 'Detalle de Costos'")
+        tabla_dinamica = False
+
+    hojas_detalle = []
+    if not tabla_dinamica:
+        # Presupuesto de filas (--max-filas): cabecera de columnas, filas de total y nota de desborde
+        paginas = presupuesto_filas.paginar(
+            [(name, len(datos[name]['servicios']) + 2) for name, _ in datos_ordenados],
+            max_filas - 1 - len(filas) - 1)
+        totales_ordenados = dict(datos_ordenados)
+        hojas_detalle = [filas + [f for name in paginas[0] for f in bloque(name, totales_ordenados[name])]]
+        if len(paginas) > 1 and desborde == 'csv':
+            resto = [name for pagina in paginas[1:] for name in pagina]
+            ruta = presupuesto_filas.ruta_desborde(nombre_archivo, 'Detalle de Costos')
+            presupuesto_filas.escribir_csv(
+                ruta, ['Name', 'Servicio', 'Costo (US$)'] + list(columnas_extra.values()),
+                ([name, f['Servicio'], f['Costo (US$)']] + [f[c] for c in columnas_extra.values()]
+                 for name in resto for f in bloque(name, totales_ordenados[name])[1:-1]))
+            print(f"   ⚠️  Detalle de Costos: {len(resto)} Names superan --max-filas -> {ruta}")
+            hojas_detalle[0].append({'Name': presupuesto_filas.nota_desborde(len(resto), ruta),
+                                     'Servicio': '', 'Costo (US$)': '', **valores_extra(vacio=True)})
+        elif len(paginas) > 1:
+            print(f"   ⚠️  Detalle de Costos: {len(paginas)} hojas para no superar --max-filas")
+            hojas_detalle += [[f for name in pagina for f in bloque(name, totales_ordenados[name])]
+                              for pagina in paginas[1:]]
 
     with pd.ExcelWriter(nombre_archivo, engine='openpyxl') as writer:
-        df.to_excel(writer, sheet_name='Detalle de Costos', index=False)
-
         workbook = writer.book
-        worksheet = writer.sheets['Detalle de Costos']
-
-        # Ajustar anchos
-        worksheet.column_dimensions['A'].width = 40
-        worksheet.column_dimensions['B'].width = 55
-        worksheet.column_dimensions['C'].width = 15
 
         # Formato
         from openpyxl.styles import Font, PatternFill
@@ -527,49 +827,69 @@ def crear_excel(datos, fecha_inicio, fecha_fin, nombre_archivo, es_partner=False
         font_bold = Font(bold=True, size=11)
         font_bold_large = Font(bold=True, size=12)
 
-        # Formatear filas
-        for idx, row in enumerate(worksheet.iter_rows(min_row=2, max_row=worksheet.max_row), start=2):
-            cell_value = row[0].value or ''
-            servicio_value = row[1].value or ''
-
-            # Total general al inicio
-            if cell_value == '*** TOTAL GENERAL ***':
-                for cell in row:
-                    cell.fill = fill_total_general
-                    cell.font = font_bold_large
-            # Línea de descuento (en verde)
-            elif 'Descuento Partner' in str(cell_value):
-                for cell in row:
-                    cell.fill = fill_descuento
-                    cell.font = font_bold_large
-            # Total con descuento (en verde más fuerte)
-            elif cell_value == '*** TOTAL CON DESCUENTO ***':
-                for cell in row:
-                    cell.fill = fill_total_descuento
-                    cell.font = font_bold_large
-            # Totales de cada Name
-            elif servicio_value == '*** TOTAL ***':
-                for cell in row:
-                    cell.fill = fill_total
-                    cell.font = font_bold
+        def formatear_detalle(worksheet):
+            # Ajustar anchos
+            worksheet.column_dimensions['A'].width = 40
+            worksheet.column_dimensions['B'].width = 55
+            worksheet.column_dimensions['C'].width = 15
+            for i in range(len(columnas_extra)):
+                worksheet.column_dimensions[chr(ord('D') + i)].width = 17
+
+            # Formatear filas
+            for row in worksheet.iter_rows(min_row=2, max_row=worksheet.max_row):
+                cell_value = row[0].value or ''
+                servicio_value = row[1].value or ''
+
+                # Total general al inicio
+                if cell_value == '*** TOTAL GENERAL ***':
+                    for cell in row:
+                        cell.fill = fill_total_general
+                        cell.font = font_bold_large
+                # Línea de descuento (en verde)
+                elif 'Descuento Partner' in str(cell_value):
+                    for cell in row:
+                        cell.fill = fill_descuento
+                        cell.font = font_bold_large
+                # Total con descuento (en verde más fuerte)
+                elif cell_value == '*** TOTAL CON DESCUENTO ***':
+                    for cell in row:
+                        cell.fill = fill_total_descuento
+                        cell.font = font_bold_large
+                # Totales de cada Name
+                elif servicio_value == '*** TOTAL ***':
+                    for cell in row:
+                        cell.fill = fill_total
+                        cell.font = font_bold
+
+        if tabla_dinamica:
+            from tabla_dinamica import escribir_tablas_dinamicas
+            escribir_tablas_dinamicas(workbook, datos, metricas_extra, columnas_extra,
+                                      f'Periodo: {fecha_inicio} a {fecha_fin}')
+
+        # 'Detalle de Costos' y sus hojas de continuación
+        for i, filas_hoja in enumerate(hojas_detalle, start=1):
+            hoja = presupuesto_filas.titulo_continuacion('Detalle de Costos', i) if i > 1 else 'Detalle de Costos'
+            pd.DataFrame(filas_hoja).to_excel(writer, sheet_name=hoja, index=False)
+            formatear_detalle(writer.sheets[hoja])
 
         # Hoja de resumen
         resumen = [
             ['Periodo', f'{fecha_inicio} a {fecha_fin}'],
             [''],
-            ['TOTAL GENERAL', '', round(costo_total, 2)]
+            ['TOTAL GENERAL', '', a_dolares(costo_total)]
         ]
 
         if es_partner:
-            resumen.append([f'Descuento Partner ({porcentaje_descuento}%)', '', round(-monto_descuento, 2)])
-            resumen.append(['TOTAL CON DESCUENTO', '', round(costo_con_descuento, 2)])
+            resumen.append([f'Descuento Partner ({porcentaje_descuento}%)', '', a_dolares(-monto_descuento)])
+            resumen.append(['TOTAL CON DESCUENTO', '', a_dolares(costo_con_descuento)])
 
         resumen.append([''])
-        resumen.append(['Name', 'Costo Total (US$)'])
+        columnas_resumen = [c for m, c in columnas_extra.items() if m not in METRICAS_NO_ADITIVAS]
+        resumen.append(['Name', 'Costo Total (US$)'] + columnas_resumen)
 
-        for name, info in datos_ordenados:
-            total = sum(info['servicios'].values())
-            resumen.append([name, round(total, 2)])
+        for name, total in datos_ordenados:
+            extra = valores_extra(name)
+            resumen.append([name, a_dolares(total)] + [extra[c] for c in columnas_resumen])
 
         df_resumen = pd.DataFrame(resumen)
         df_resumen.to_excel(writer, sheet_name='Resumen', index=False, header=False)
@@ -594,31 +914,196 @@ def crear_excel(datos, fecha_inicio, fecha_fin, nombre_archivo, es_partner=False
                 cell.fill = fill_total_descuento
                 cell.font = font_bold_large
 
+        # Hojas por dimensión (--dimensiones): subtotal por grupo y Names debajo
+        usados = {'Resumen'} | set(writer.sheets)
+        for combinacion, cruce in cruces or []:
+            hoja = dimensiones.nombre_hoja(combinacion, usados)
+            columnas = [dimensiones.nombre(c) for c in combinacion]
+            filas_dim = [{**dict.fromkeys(columnas, ''), 'Name': '*** TOTAL GENERAL ***',
+                          'Costo (US$)': a_dolares(sum(sum(n.values()) for n in cruce.values()))}]
+            for valores, total in ordenar_por_total(totales_de(cruce)):
+                grupo = dict(zip(columnas, valores))
+                filas_dim.append({**grupo, 'Name': '*** TOTAL ***', 'Costo (US$)': a_dolares(total)})
+                for name, costo in ordenar_por_total(cruce[valores]):
+                    filas_dim.append({**grupo, 'Name': name, 'Costo (US$)': a_dolares(costo)})
+            pd.DataFrame(filas_dim).to_excel(writer, sheet_name=hoja, index=False)
+
+            ws_dim = writer.sheets[hoja]
+            for i in range(len(columnas)):
+                ws_dim.column_dimensions[chr(ord('A') + i)].width = 30
+            ws_dim.column_dimensions[chr(ord('A') + len(columnas))].width = 40
+            ws_dim.column_dimensions[chr(ord('B') + len(columnas))].width = 15
+            for row in ws_dim.iter_rows(min_row=2, max_row=ws_dim.max_row):
+                etiqueta = row[len(columnas)].value
+                if etiqueta in ('*** TOTAL ***', '*** TOTAL GENERAL ***'):
+                    for cell in row:
+                        cell.fill = fill_total if etiqueta == '*** TOTAL ***' else fill_total_general
+                        cell.font = font_bold
+
+        if variacion is not None:
+            escribir_hoja_variacion(workbook, variacion)
+        if anomalias is not None:
+            from anomalias import escribir_hoja_anomalias
+            escribir_hoja_anomalias(workbook, anomalias)
+        if prevision is not None:
+            from prevision import escribir_hoja_prevision
+            escribir_hoja_prevision(workbook, prevision)
+
     print(f"\n✅ Excel creado: {nombre_archivo}")
-    print(f"💰 Costo total: ${costo_total:,.2f} USD")
+    print(f"💰 Costo total: ${a_dolares(costo_total):,.2f} USD")
     if es_partner:
-        print(f"💚 Descuento ({porcentaje_descuento}%): ${monto_descuento:,.2f} USD")
-        print(f"💰 Total con descuento: ${costo_con_descuento:,.2f} USD")
+        print(f"💚 Descuento ({porcentaje_descuento}%): ${a_dolares(monto_descuento):,.2f} USD")
+        print(f"💰 Total con descuento: ${a_dolares(costo_con_descuento):,.2f} USD")
     print(f"📊 Recursos: {len(datos)}")
 
     return nombre_archivo
 
 
+def validar_dimensiones(args):
+    """--dimensiones -> combinaciones del módulo dimensiones (sale con ❌ si no son válidas)"""
+    if not args.dimensiones:
+        return []
+    if args.incremental or args.cur or args.cubo:
+        print("❌ --dimensiones solo está disponible con Cost Explorer (no con --incremental/--cur/--cubo)")
+        sys.exit(1)
+    try:
+        combinaciones = dimensiones.parsear_combinaciones(args.dimensiones)
+    except ValueError as e:
+        print(f"❌ --dimensiones: {e}")
+        sys.exit(1)
+    for combinacion in combinaciones:
+        print(f"🧩 Dimensión: {dimensiones.titulo(combinacion)}")
+    return combinaciones
+
+
 def main():
     parser = argparse.ArgumentParser(description='Extrae costos de AWS por Name con desglose EC2 completo')
     parser.add_argument('--mes', type=int, help='Mes (1-12)')
     parser.add_argument('--anio', type=int, help='Año')
-    parser.add_argument('--output', type=str, default='aws_costos_detallados.xlsx', help='Archivo de salida')
+    parser.add_argument('--output', type=str, default='aws_costos_detallados.xlsx',
+                        help="Archivo de salida ('-' = stdout con --format csv|jsonl)")
+    parser.add_argument('--format', choices=('xlsx', 'csv', 'jsonl'), default='xlsx',
+                        help='xlsx (default), o csv/jsonl: filas normalizadas en flujo, sin Excel')
+    parser.add_argument('--gzip', action='store_true', help='Comprime la salida csv/jsonl con gzip')
     parser.add_argument('--profile', type=str, help='Perfil AWS')
     parser.add_argument('--region', type=str, default='eu-west-1', help='Región AWS')
     parser.add_argument('--partner', action='store_true', help='Aplicar descuento de partner')
     parser.add_argument('--descuento', type=float, default=5.0, help='Porcentaje de descuento (default: 5.0)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Reutiliza los días ya consultados y solo pide los nuevos (mes en curso)')
+    parser.add_argument('--estado', type=str,
+                        help='Fichero de estado incremental (default: .aws_cost_estado_YYYY-MM.json)')
+    parser.add_argument('--ventana-revision', type=int, default=3,
+                        help='Días recientes que se vuelven a consultar en modo incremental (default: 3)')
+    parser.add_argument('--metrics', nargs='+', choices=METRICAS_DISPONIBLES, metavar='METRICA',
+                        help=f'Métricas adicionales en las mismas consultas ({", ".join(METRICAS_DISPONIBLES)})')
+    parser.add_argument('--max-requests', type=int,
+                        help='Máximo de peticiones (facturadas) a Cost Explorer; se aborta antes de superarlo')
+    parser.add_argument('--resumen-api', type=str,
+                        help='Guarda en este JSON el recuento de peticiones y el coste estimado de la API')
+    parser.add_argument('--max-filas', type=int, default=presupuesto_filas.LIMITE_FILAS_EXCEL, metavar='N',
+                        help='Filas máximas por hoja; Detalle de Costos se parte en hojas de continuación o en CSV '
+                             f'(default: {presupuesto_filas.LIMITE_FILAS_EXCEL}, el límite de Excel)')
+    parser.add_argument('--desborde', choices=presupuesto_filas.DESBORDES, default='hojas',
+                        help='Qué hacer con las filas que superan --max-filas (default: hojas)')
+    parser.add_argument('--tabla-dinamica', action='store_true',
+                        help='Hoja Datos con tablas dinámicas de Excel por Name y por servicio en lugar de '
+                             'Detalle de Costos')
+    grabacion = parser.add_mutually_exclusive_group()
+    grabacion.add_argument('--record', type=str, metavar='DIR',
+                           help='Graba en DIR las respuestas crudas de Cost Explorer (comprimidas)')
+    grabacion.add_argument('--replay', type=str, metavar='DIR',
+                           help='Reproduce las respuestas grabadas en DIR, sin conectar a AWS')
+    grabacion.add_argument('--cur', type=str, metavar='DIR',
+                           help='Lee los costes de los Parquet del CUR en DIR en lugar de Cost Explorer (requiere pyarrow)')
+    grabacion.add_argument('--cubo', type=str, metavar='DIR',
+                           help='Lee el periodo del cubo de costes en disco (ver cubo_costes.py)')
+    parser.add_argument('--procesos', type=int,
+                        help='Procesos para agregar el CUR en paralelo (con --cur; default: todos los núcleos)')
+    parser.add_argument('--atribuir-recursos', action='store_true',
+                        help='Atribuye a los Names los costes EC2 sin etiqueta con datos por recurso (últimos 14 días)')
+    parser.add_argument('--indice-recursos', type=str, default='.aws_recursos_name.json',
+                        help='Índice recurso -> Name en disco para --atribuir-recursos (default: .aws_recursos_name.json)')
+    parser.add_argument('--instantaneas', type=str, metavar='DIR',
+                        help='Guarda en DIR una instantánea del modelo del mes (para --comparar)')
+    parser.add_argument('--comparar', action='store_true',
+                        help='Añade la hoja Variación frente a la instantánea del mes anterior (requiere --instantaneas)')
+    parser.add_argument('--anomalias', action='store_true',
+                        help='Detecta picos en el coste diario por Name (hoja Anomalías y <output>_anomalias.json)')
+    parser.add_argument('--umbral-anomalia', type=float, default=5.0,
+                        help='Puntuación robusta mínima para marcar un día como anómalo (default: 5)')
+    parser.add_argument('--dimensiones', nargs='+', metavar='DIM[,DIM]',
+                        help='Hojas adicionales por dimensión o combinación (ServerGroup, REGION, '
+                             'LINKED_ACCOUNT, USAGE_TYPE, tag:<clave>; p. ej. ServerGroup REGION,ServerGroup)')
+    parser.add_argument('--fragmentos', type=int, metavar='N',
+                        help='Divide la consulta base en N consultas paralelas por Name (cuentas muy grandes)')
+    parser.add_argument('--preflight', action='store_true',
+                        help='Valida credenciales, permisos y etiquetas antes de consultar (respuestas en caché)')
+    parser.add_argument('--prevision', action='store_true',
+                        help='Añade la hoja Previsión con el cierre estimado del mes en curso (get_cost_forecast)')
+    parser.add_argument('--cache', type=str, default='.aws_cost_cache', metavar='DIR',
+                        help='Caché en disco de las respuestas de previsión y validación (default: .aws_cost_cache)')
+    parser.add_argument('--cache-ttl', type=float, default=6, metavar='HORAS',
+                        help='Horas de validez de la caché para periodos abiertos (default: 6)')
+    parser.add_argument('--motor', choices=('hilos', 'async'), default='hilos',
+                        help='Cómo se lanzan las consultas a Cost Explorer: hilos (default) o async, todas a la vez '
+                             'sobre asyncio con un límite global (--concurrencia)')
+    parser.add_argument('--concurrencia', type=int, default=CONCURRENCIA, metavar='N',
+                        help=f'Peticiones simultáneas como máximo con --motor async (default: {CONCURRENCIA})')
+    parser.add_argument('--endpoint-url', type=str, metavar='URL',
+                        help='Endpoint de Cost Explorer alternativo (p. ej. servidor_ce_simulado.py en local)')
 
     args = parser.parse_args()
 
+    # csv/jsonl: con --output - los datos van a stdout y los mensajes de progreso a stderr
+    estandar = None
+    if args.format in exportacion.FORMATOS:
+        args.output, args.gzip = exportacion.ruta_salida(args.output, args.format, args.gzip)
+        if args.output == exportacion.SALIDA_ESTANDAR:
+            estandar = exportacion.desviar_registro()
+    elif args.gzip:
+        print("❌ --gzip solo se usa con --format csv|jsonl")
+        sys.exit(1)
+    # Opciones que solo van en el Excel: con otro formato sus consultas (facturadas) se tirarían
+    if args.format != 'xlsx':
+        solo_excel = [opcion for opcion, usada in (
+            ('--dimensiones', args.dimensiones), ('--prevision', args.prevision), ('--comparar', args.comparar),
+            ('--partner', args.partner), ('--tabla-dinamica', args.tabla_dinamica),
+            ('--max-filas', args.max_filas != parser.get_default('max_filas')),
+            ('--desborde', args.desborde != parser.get_default('desborde'))) if usada]
+        if solo_excel:
+            print(f"❌ Solo con --format xlsx (no con {args.format}): {', '.join(solo_excel)}")
+            sys.exit(1)
     if (args.mes and not args.anio) or (args.anio and not args.mes):
         print("❌ Debes especificar mes Y año, o ninguno")
         sys.exit(1)
+    if args.incremental and args.metrics:
+        print("❌ --metrics no es compatible con --incremental")
+        sys.exit(1)
+    if args.incremental and (args.cur or args.cubo):
+        print("❌ --cur/--cubo no son compatibles con --incremental")
+        sys.exit(1)
+    if args.comparar and not args.instantaneas:
+        print("❌ --comparar requiere --instantaneas DIR")
+        sys.exit(1)
+    if args.atribuir_recursos and (args.incremental or args.cur or args.cubo):
+        print("❌ --atribuir-recursos solo está disponible con Cost Explorer (no con --incremental/--cur/--cubo)")
+        sys.exit(1)
+    if args.fragmentos is not None and (args.fragmentos < 1 or args.incremental or args.cur or args.cubo):
+        print("❌ --fragmentos necesita N >= 1 y Cost Explorer (no con --incremental/--cur/--cubo)")
+        sys.exit(1)
+    if args.procesos is not None and (args.procesos < 1 or not args.cur):
+        print("❌ --procesos necesita N >= 1 y --cur")
+        sys.exit(1)
+    if args.prevision and (args.cur or args.cubo):
+        print("❌ --prevision solo está disponible con Cost Explorer (no con --cur/--cubo)")
+        sys.exit(1)
+    if args.motor == 'async' and (args.record or args.replay or args.cur or args.cubo or args.concurrencia < 1):
+        print("❌ --motor async necesita --concurrencia N >= 1 y Cost Explorer (no con --record/--replay/--cur/--cubo)")
+        sys.exit(1)
+    presupuesto_filas.validar(args)
+    combinaciones = validar_dimensiones(args)
+    metricas = preparar_metricas(args.metrics)
 
     print("=" * 70)
     print("AWS COST REPORT - Desglose Completo por Name")
@@ -627,71 +1112,176 @@ def main():
     print("=" * 70)
 
     # Obtener fechas
-    fecha_inicio, fecha_fin = obtener_rango_fechas(args.mes, args.anio)
+    reproductor = None
+    if args.replay:
+        try:
+            reproductor = ClienteCEReproductor(args.replay)
+        except (OSError, ValueError) as e:
+            print(f"❌ No se puede reproducir: {e}")
+            sys.exit(1)
+
+    if reproductor and not args.mes and reproductor.manifiesto['descripcion'].get('periodo'):
+        # Sin --mes/--anio se reproduce el periodo grabado
+        fecha_inicio, fecha_fin = reproductor.manifiesto['descripcion']['periodo']
+        print(f"📅 Periodo grabado: {fecha_inicio} a {fecha_fin}")
+    else:
+        fecha_inicio, fecha_fin = obtener_rango_fechas(args.mes, args.anio)
 
     # Cliente AWS
     session_params = {'region_name': args.region}
     if args.profile:
         session_params['profile_name'] = args.profile
 
+    ce = None
+    cliente_ec2 = None
+    # El resumen de la API se muestra (y --resumen-api se escribe) también si el informe termina
+    # antes de tiempo: las peticiones hechas hasta entonces ya se han facturado
     try:
-        session = boto3.Session(**session_params)
-        ce = session.client('ce')
-        print(f"✅ Conectado a AWS ({args.region})")
-    except Exception as e:
-        print(f"❌ Error conectando: {e}")
-        sys.exit(1)
-
-    # Obtener datos
-    costos_base = obtener_costos_base(ce, fecha_inicio, fecha_fin)
-
-    # ✅ Calcular qué Names tienen EC2 en costos_base (para limitar el desglose)
-    servicios_ec2 = [
-        'Amazon Elastic Compute Cloud - Compute',
-        'EC2 - Other',
-        'Amazon Elastic Block Store'
-    ]
-    names_con_ec2 = set()
-    for name, servicios in costos_base.items():
-        if any(s in servicios for s in servicios_ec2):
-            names_con_ec2.add(name)
-
-    print(f"   → {len(names_con_ec2)} Names con costos EC2 detectados")
-
-    desglose_ec2 = obtener_desglose_ec2_completo(ce, fecha_inicio, fecha_fin, names_con_ec2)
-    backup_costs = obtener_costos_backup(ce, fecha_inicio, fecha_fin)
-
-    # ✅ Normalizar el desglose para que coincida exactamente con costos_base
-    desglose_ec2_normalizado = normalizar_desglose_ec2(costos_base, desglose_ec2)
-
-    # DIAGNÓSTICO EC2 (después de normalizar)
-    diagnosticar_ec2(costos_base, desglose_ec2_normalizado)
-
-    # Procesar
-    datos = procesar_datos(costos_base, desglose_ec2_normalizado, backup_costs)
-
-    if not datos:
-        print("\n⚠️  No se encontraron costos")
-        sys.exit(0)
-
-    # Verificación final
-    total_final = sum(sum(info['servicios'].values()) for info in datos.values())
-    total_esperado = sum(sum(servicios.values()) for servicios in costos_base.values())
-
-    print("\n" + "=" * 70)
-    print("✅ VERIFICACIÓN FINAL:")
-    print(f"   Total Cost Explorer esperado: ${total_esperado:,.2f}")
-    print(f"   Total calculado: ${total_final:,.2f}")
-    diferencia_final = abs(total_final - total_esperado)
-    if diferencia_final < 1:
-        print(f"   ✅ ¡COINCIDENCIA PERFECTA! (diff: ${diferencia_final:.2f})")
-    else:
-        print(f"   ⚠️  Diferencia: ${diferencia_final:,.2f}")
-    print("=" * 70)
-
-    # Crear Excel con información de partner
-    crear_excel(datos, fecha_inicio, fecha_fin, args.output, args.partner, args.descuento)
-
+        try:
+            if args.cur or args.cubo:
+                print(f"📦 Fuente de datos: {'CUR' if args.cur else 'cubo'} en {args.cur or args.cubo} "
+                      f"(sin llamadas a Cost Explorer)")
+            elif reproductor:
+                ce = ClienteCEMedido(reproductor, args.max_requests, facturado=False)
+                print(f"📼 Reproduciendo respuestas grabadas en {args.replay} "
+                      f"({reproductor.manifiesto['grabado']}, {reproductor.manifiesto['respuestas']} respuestas)")
+            else:
+                session = boto3.Session(**session_params)
+                cliente = session.client('ce', endpoint_url=args.endpoint_url)
+                if args.record:
+                    cliente = ClienteCEGrabador(cliente, args.record, {
+                        'script': os.path.basename(__file__),
+                        'periodo': [fecha_inicio, fecha_fin],
+                        'argumentos': sys.argv[1:],
+                    })
+                    print(f"⏺️  Grabando respuestas de Cost Explorer en {args.record}")
+                ce = ClienteCEMedido(cliente, args.max_requests)
+                if args.motor == 'async':
+                    ce = MotorCEAsync.desde_sesion(session, cliente, ce, args.concurrencia)
+                    print(f"⚡ Motor asyncio: hasta {args.concurrencia} peticiones simultáneas a {ce.endpoint}")
+                if args.preflight:
+                    from validar_configuracion import preflight
+                    if not preflight(session, args.cache, cliente_ce=ce):
+                        sys.exit(1)
+                if args.atribuir_recursos:
+                    cliente_ec2 = session.client('ec2')
+                print(f"✅ Conectado a AWS ({args.region})")
+        except Exception as e:
+            print(f"❌ Error conectando: {e}")
+            sys.exit(1)
+
+        # Previsión de cierre: arranca ya y corre en paralelo con las consultas de costes
+        prevision_mes = None
+        if args.prevision:
+            from prevision import PrevisionMes
+            prevision_mes = PrevisionMes(ce, fecha_inicio, fecha_fin, args.cache, args.cache_ttl)
+
+        # Obtener datos
+        modelo = None
+        if args.incremental:
+            from refresco_incremental import refrescar_mes, ruta_estado_por_defecto
+            costos_base, desglose_ec2, backup_costs = refrescar_mes(
+                ce, fecha_inicio, fecha_fin, args.estado or ruta_estado_por_defecto(fecha_inicio),
+                args.ventana_revision)
+            base_m, desglose_m, backup_m = {}, {}, {}
+        else:
+            if args.cubo:
+                from cubo_costes import obtener_costos_cubo
+                base_m, desglose_m, backup_m = obtener_costos_cubo(args.cubo, fecha_inicio, fecha_fin, metricas)
+            elif args.cur:
+                from fuente_cur import obtener_costos_cur
+                base_m, desglose_m, backup_m = obtener_costos_cur(args.cur, fecha_inicio, fecha_fin,
+                                                                  metricas=metricas, procesos=args.procesos)
+            elif combinaciones:
+                # Las consultas D × Name van en el mismo plan (y en paralelo) que las del informe
+                base_m, desglose_m, backup_m, modelo = obtener_costos_informe_dimensiones(
+                    ce, fecha_inicio, fecha_fin, combinaciones, metricas, args.fragmentos)
+            else:
+                # Base, desglose EC2 y Backup con el mínimo de consultas (planificador)
+                base_m, desglose_m, backup_m = obtener_costos_informe(ce, fecha_inicio, fecha_fin, metricas=metricas,
+                                                                      fragmentos=args.fragmentos)
+            if args.atribuir_recursos:
+                from atribucion_recursos import aplicar_atribucion
+                aplicar_atribucion(ce, cliente_ec2, fecha_inicio, fecha_fin, base_m, desglose_m, metricas,
+                                   args.indice_recursos)
+            costos_base = base_m[METRICA_PRINCIPAL]
+            desglose_ec2 = desglose_m[METRICA_PRINCIPAL]
+            backup_costs = backup_m[METRICA_PRINCIPAL]
+
+        # ✅ Normalizar el desglose para que coincida exactamente con costos_base
+        desglose_ec2_normalizado = normalizar_desglose_ec2(costos_base, desglose_ec2)
+
+        # DIAGNÓSTICO EC2 (después de normalizar)
+        diagnosticar_ec2(costos_base, desglose_ec2_normalizado)
+
+        # Procesar
+        datos = procesar_datos(costos_base, desglose_ec2_normalizado, backup_costs)
+
+        if not datos:
+            print("\n⚠️  No se encontraron costos")
+            if prevision_mes:
+                prevision_mes.cancelar()
+            sys.exit(0)
+
+        # Métricas adicionales: mismo tratamiento, normalizadas contra su propia base (salvo las
+        # que mezclan unidades: su desglose se muestra tal cual)
+        metricas_extra = {}
+        for metrica in metricas[1:]:
+            print(f"\n📐 Métrica adicional: {metrica}")
+            desglose_n = (desglose_m[metrica] if metrica in METRICAS_NO_ADITIVAS
+                          else normalizar_desglose_ec2(base_m[metrica], desglose_m[metrica]))
+            metricas_extra[metrica] = procesar_datos(base_m[metrica], desglose_n, backup_m[metrica], verbose=False)
+        alinear_metricas(datos, metricas_extra)
+
+        # Verificación final
+        total_final = sum(sum(info['servicios'].values()) for info in datos.values())
+        total_esperado = sum(sum(servicios.values()) for servicios in costos_base.values())
+
+        print("\n" + "=" * 70)
+        print("✅ VERIFICACIÓN FINAL:")
+        print(f"   Total Cost Explorer esperado: ${a_dolares(total_esperado):,.2f}")
+        print(f"   Total calculado: ${a_dolares(total_final):,.2f}")
+        diferencia_final = abs(total_final - total_esperado)
+        if diferencia_final == 0:
+            print("   ✅ ¡COINCIDENCIA EXACTA! (diff: $0, al micro-céntimo)")
+        else:
+            print(f"   ⚠️  Diferencia: ${a_dolares(diferencia_final):,.2f}")
+        cruces = dimensiones.cruces(modelo, combinaciones, totales_de(costos_base)) if modelo is not None else None
+        if cruces:
+            dimensiones.verificar(cruces, total_esperado)
+        print("=" * 70)
+
+        # Variación frente al mes anterior (instantáneas en disco, sin llamadas a la API)
+        variacion = None
+        if args.instantaneas:
+            if args.comparar:
+                variacion = comparar_con_anterior(args.instantaneas, fecha_inicio, costos_base)
+            guardar_instantanea(args.instantaneas, fecha_inicio, fecha_fin, costos_base)
+
+        # Anomalías en el coste diario por Name
+        anomalias = None
+        if args.anomalias:
+            # Con --output - (stdout) el JSON va junto al nombre de salida por defecto
+            salida = parser.get_default('output') if args.output == exportacion.SALIDA_ESTANDAR else args.output
+            ruta_anomalias = os.path.splitext(salida)[0] + '_anomalias.json'
+            from anomalias import analizar
+            anomalias = analizar(ce, fecha_inicio, fecha_fin, args.cur, args.cubo, args.procesos,
+                                 args.umbral_anomalia, ruta_anomalias)
+
+        prevision = prevision_mes.resultados(costos_base) if prevision_mes else None
+
+        if args.format in exportacion.FORMATOS:
+            exportacion.exportar(exportacion.filas_detalle(datos, metricas_extra), metricas, fecha_inicio, fecha_fin,
+                                 args.format, args.output, args.gzip, estandar)
+        else:
+            # Crear Excel con información de partner
+            crear_excel(datos, fecha_inicio, fecha_fin, args.output, args.partner, args.descuento, metricas_extra,
+                        cruces, variacion, anomalias, prevision, args.max_filas, args.desborde, args.tabla_dinamica)
+    finally:
+        if ce:
+            ce.imprimir_resumen(args.resumen_api)
+        if isinstance(ce, MotorCEAsync):
+            ce.cerrar()
     print("=" * 70)
     print("✨ Completado exitosamente")
     print("=" * 70)
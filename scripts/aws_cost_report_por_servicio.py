@@ -24,6 +24,7 @@ import boto3
 from collections import defaultdict
 import argparse
 import hashlib
+import os
 import sys
 
 from openpyxl import Workbook
@@ -35,11 +36,26 @@ from openpyxl.chart.series import DataPoint
 from openpyxl.chart.shapes import GraphicalProperties
 
 from aws_cost_report import (
+    METRICA_PRINCIPAL,
+    METRICAS_DISPONIBLES,
+    ETIQUETAS_METRICA,
+    METRICAS_NO_ADITIVAS,
+    preparar_metricas,
     obtener_rango_fechas,
-    obtener_costos_base,
-    obtener_desglose_ec2_completo,
+    obtener_costos_informe,
+    obtener_costos_informe_dimensiones,
     normalizar_desglose_ec2,
+    validar_dimensiones,
 )
+import dimensiones
+import exportacion
+import informe_html
+import presupuesto_filas
+from dinero import a_dolares, desde_dolares, porcentaje
+from consultas_ce import ClienteCEMedido, ClienteCEGrabador, ClienteCEReproductor
+from motor_async import CONCURRENCIA, MotorCEAsync
+from ranking import totales_de, ordenar_por_total, top_n
+from variacion_mensual import comparar_con_anterior, escribir_hoja_variacion, guardar_instantanea
 
 # --------------------------------------------------------------------------
 # Configuración de servicios
@@ -137,6 +153,7 @@ PALETA_GRAFICA = ['FF9900', '146EB4', '232F3E', '2E7D32', 'C7511F', '7D3C98',
                   '117A65', '6C3483', '922B21']
 
 CUR = '"$"#,##0.00'
+NUM = '#,##0.00'  # métricas que no son dinero (UsageQuantity)
 _THIN = Side(style='thin', color='D9DEE3')
 BORDE = Border(left=_THIN, right=_THIN, top=_THIN, bottom=_THIN)
 
@@ -189,6 +206,7 @@ COLOR_SERVICIO = {
 COLORES_FALLBACK = ['2874A6', '9A7D0A', '7B241C', '1E8449', '5B2C6F', '935116',
                     '148F77', '512E5F', '6E2C00', '154360', '7D6608', '4A235A']
 COLOR_OTROS = '5D6D7E'  # gris azulado neutro para "Otros servicios"
+COLOR_DIMENSION = C_AZUL  # hojas "Por ..." de --dimensiones
 
 
 def color_de_servicio(servicio):
@@ -222,7 +240,7 @@ def _etiquetas(showVal=False, showPercent=False):
 # Reorganización de datos
 # --------------------------------------------------------------------------
 def reorganizar_por_servicio(costos_base):
-    servicios_data = defaultdict(lambda: defaultdict(float))
+    servicios_data = defaultdict(lambda: defaultdict(int))
     for name, servicios in costos_base.items():
         for servicio, costo in servicios.items():
             if servicio in SERVICIOS_EC2:
@@ -232,8 +250,10 @@ def reorganizar_por_servicio(costos_base):
 
 
 def clasificar_servicios(servicios_data, umbral):
+    """umbral en dólares; los importes de servicios_data en micro-céntimos (dinero.py)"""
+    umbral = desde_dolares(umbral)
     con_hoja = {}
-    otros = defaultdict(lambda: defaultdict(float))
+    otros = defaultdict(lambda: defaultdict(int))
     for servicio, names in servicios_data.items():
         total = sum(names.values())
         if servicio in PRINCIPALES or total >= umbral:
@@ -276,7 +296,7 @@ def _merge_estilo(ws, rango, valor, fill=None, font=None, align=None):
                 c.fill = fill
 
 
-def _cabecera_hoja(ws, titulo, desc, total, ncols, color=None):
+def _cabecera_hoja(ws, titulo, desc, total, ncols, color=None, etiqueta_total='TOTAL DEL SERVICIO'):
     """Escribe título + descripción + KPI de total. Devuelve la fila donde empieza la tabla.
     Si se pasa `color`, colorea el título y la pestaña de la hoja con ese color."""
     fill_titulo = PatternFill('solid', fgColor=color) if color else FILL_TITULO
@@ -293,9 +313,9 @@ def _cabecera_hoja(ws, titulo, desc, total, ncols, color=None):
     ws.row_dimensions[2].height = 18
     ws.row_dimensions[3].height = 18
     # Fila 4: KPI total
-    _merge_estilo(ws, f'A4:{get_column_letter(ncols-1)}4', 'TOTAL DEL SERVICIO',
+    _merge_estilo(ws, f'A4:{get_column_letter(ncols-1)}4', etiqueta_total,
                   FILL_KPI, F_KPI_LBL, Alignment(horizontal='right', vertical='center'))
-    cell = ws.cell(4, ncols, round(total, 2))
+    cell = ws.cell(4, ncols, a_dolares(total))
     cell.fill = FILL_KPI
     cell.font = F_KPI_VAL
     cell.number_format = CUR
@@ -309,11 +329,49 @@ def _formato_columnas(ws, anchos):
         ws.column_dimensions[col].width = ancho
 
 
+def _cabeceras_extra(ws, h, col, extras, fill_header):
+    """Cabeceras de las columnas de métricas adicionales (--metrics) a partir de `col`."""
+    for i, metrica in enumerate(extras):
+        ws.column_dimensions[get_column_letter(col + i)].width = 18
+        cell = ws.cell(h, col + i, ETIQUETAS_METRICA[metrica])
+        cell.fill = fill_header
+        cell.font = F_HEADER
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+        cell.border = BORDE
+
+
+def _subtotal_extra(metrica, valores):
+    """Suma de una métrica adicional para una fila de subtotal; None (celda vacía) si no es aditiva."""
+    return None if metrica in METRICAS_NO_ADITIVAS else sum(valores)
+
+
+def _celdas_extra(ws, r, col, valores, fill, font):
+    """Valores de las métricas adicionales de una fila; `valores` = {metrica: valor o None}."""
+    for i, (metrica, valor) in enumerate(valores.items()):
+        cell = ws.cell(r, col + i, None if valor is None else a_dolares(valor))
+        cell.fill = fill
+        cell.font = font
+        cell.border = BORDE
+        cell.number_format = NUM if metrica == 'UsageQuantity' else CUR
+        cell.alignment = Alignment(horizontal='right')
+
+
+def _alinear(primario, extra):
+    """Añade con 0 al dict primario las claves que solo aparecen en otra métrica."""
+    for clave, valores in extra.items():
+        for subclave in valores:
+            primario[clave][subclave] += 0
+
+
 # --------------------------------------------------------------------------
 # Hojas
 # --------------------------------------------------------------------------
-def escribir_hoja_servicio(wb, hoja, servicio, datos, total, color):
-    """Hoja simple: Name | Costo, con filtro y estilo."""
+def escribir_hoja_servicio(wb, hoja, servicio, datos, total, color, extras=None):
+    """Hoja simple: Name | Costo, con filtro y estilo.
+
+    extras: {metrica: {name: valor}} -> una columna más por métrica adicional.
+    """
+    extras = extras or {}
     ws = wb.create_sheet(hoja)
     _formato_columnas(ws, {'A': 48, 'B': 18})
     h = _cabecera_hoja(ws, NOMBRES_HOJA.get(servicio, servicio), descripcion(servicio), total, 2, color)
@@ -326,25 +384,33 @@ def escribir_hoja_servicio(wb, hoja, servicio, datos, total, color):
         cell.font = F_HEADER
         cell.alignment = Alignment(horizontal='center', vertical='center')
         cell.border = BORDE
+    _cabeceras_extra(ws, h, 3, extras, fill_header)
 
-    filas = sorted(datos.items(), key=lambda x: x[1], reverse=True)
+    filas = ordenar_por_total(datos)
     for i, (name, costo) in enumerate(filas):
         r = h + 1 + i
         fill = FILL_BANDA if i % 2 else FILL_BLANCO
         cn = ws.cell(r, 1, name); cn.fill = fill; cn.font = F_NORMAL; cn.border = BORDE
-        cc = ws.cell(r, 2, round(costo, 2)); cc.fill = fill; cc.font = F_NORMAL
+        cc = ws.cell(r, 2, a_dolares(costo)); cc.fill = fill; cc.font = F_NORMAL
         cc.number_format = CUR; cc.border = BORDE
         cc.alignment = Alignment(horizontal='right')
+        _celdas_extra(ws, r, 3, {m: v.get(name, 0) for m, v in extras.items()}, fill, F_NORMAL)
 
     ultima = h + len(filas)
-    ws.auto_filter.ref = f'A{h}:B{ultima}'
+    ws.auto_filter.ref = f'A{h}:{get_column_letter(2 + len(extras))}{ultima}'
     ws.freeze_panes = f'A{h + 1}'
 
 
-def escribir_hoja_ec2(wb, ec2_data, total, color):
-    ws = wb.create_sheet('EC2')
+def escribir_hoja_ec2(wb, ec2_data, total, color, extras=None, hoja='EC2', nota=None):
+    """Hoja EC2: Name | Detalle | Costo. extras: {metrica: {name: {categoria: valor}}}.
+
+    hoja: 'EC2 (2)'... en las hojas de continuación (--max-filas); `total` es
+    siempre el de todo EC2. nota: fila de aviso al final (desborde a CSV).
+    """
+    extras = extras or {}
+    ws = wb.create_sheet(hoja)
     _formato_columnas(ws, {'A': 40, 'B': 46, 'C': 16})
-    h = _cabecera_hoja(ws, 'EC2', DESCRIPCIONES['EC2'], total, 3, color)
+    h = _cabecera_hoja(ws, hoja, DESCRIPCIONES['EC2'], total, 3, color)
     fill_header = PatternFill('solid', fgColor=color)
 
     for c, texto in enumerate(['Name', 'Detalle', 'Costo (US$)'], start=1):
@@ -353,12 +419,13 @@ def escribir_hoja_ec2(wb, ec2_data, total, color):
         cell.font = F_HEADER
         cell.alignment = Alignment(horizontal='center', vertical='center')
         cell.border = BORDE
+    _cabeceras_extra(ws, h, 4, extras, fill_header)
 
     r = h + 1
-    grupos = sorted(ec2_data.items(), key=lambda x: sum(x[1].values()), reverse=True)
-    for gi, (name, cats) in enumerate(grupos):
+    for gi, (name, subtotal) in enumerate(ordenar_por_total(totales_de(ec2_data))):
+        cats = ec2_data[name]
         # Fila subtotal del Name (dorada, en negrita)
-        for c, val in enumerate([name, '▸ TOTAL', round(sum(cats.values()), 2)], start=1):
+        for c, val in enumerate([name, '▸ TOTAL', a_dolares(subtotal)], start=1):
             cell = ws.cell(r, c, val)
             cell.fill = FILL_GOLD
             cell.font = F_SUBTOTAL
@@ -366,38 +433,87 @@ def escribir_hoja_ec2(wb, ec2_data, total, color):
             if c == 3:
                 cell.number_format = CUR
                 cell.alignment = Alignment(horizontal='right')
+        _celdas_extra(ws, r, 4, {m: _subtotal_extra(m, v.get(name, {}).values()) for m, v in extras.items()},
+                      FILL_GOLD, F_SUBTOTAL)
         r += 1
         # Categorías (banda por grupo)
         fill = FILL_BANDA if gi % 2 else FILL_BLANCO
-        for cat, costo in sorted(cats.items(), key=lambda x: x[1], reverse=True):
+        for cat, costo in ordenar_por_total(cats):
             cn = ws.cell(r, 1, name); cn.fill = fill; cn.font = F_NORMAL; cn.border = BORDE
             cd = ws.cell(r, 2, cat); cd.fill = fill; cd.font = F_NORMAL; cd.border = BORDE
-            cc = ws.cell(r, 3, round(costo, 2)); cc.fill = fill; cc.font = F_NORMAL
+            cc = ws.cell(r, 3, a_dolares(costo)); cc.fill = fill; cc.font = F_NORMAL
             cc.number_format = CUR; cc.border = BORDE
             cc.alignment = Alignment(horizontal='right')
+            _celdas_extra(ws, r, 4, {m: v.get(name, {}).get(cat, 0) for m, v in extras.items()},
+                          fill, F_NORMAL)
             r += 1
 
-    ws.auto_filter.ref = f'A{h}:C{r - 1}'
+    ws.auto_filter.ref = f'A{h}:{get_column_letter(3 + len(extras))}{r - 1}'
     ws.freeze_panes = f'A{h + 1}'
-
-
-def escribir_hoja_otros(wb, otros, total, color):
-    ws = wb.create_sheet('Otros servicios')
+    if nota:
+        ws.cell(r + 1, 1, nota).font = F_DESC
+
+
+def hojas_ec2(ec2_data, total, color, extras, max_filas, desborde, nombre_archivo):
+    """Trabajos de la hoja EC2 dentro del presupuesto de filas (--max-filas / --desborde)
+
+    Cada Name ocupa su fila de subtotal más una por categoría; los Names que
+    no caben van a hojas 'EC2 (2)', 'EC2 (3)'... o, con desborde 'csv', a
+    <output>_EC2.csv.
+    """
+    from render_paralelo import Hoja
+    nombres = [name for name, _ in ordenar_por_total(totales_de(ec2_data))]
+    # Cabecera (filas 1-6) y, con desborde, una fila en blanco y la nota
+    paginas = presupuesto_filas.paginar([(name, 1 + len(ec2_data[name])) for name in nombres],
+                                        max_filas - 6 - 2)
+    if len(paginas) == 1:
+        return [Hoja(escribir_hoja_ec2, (ec2_data, total, color, extras, 'EC2'))]
+
+    def parte(names):
+        return ({name: ec2_data[name] for name in names},
+                {m: {name: v[name] for name in names if name in v} for m, v in extras.items()})
+
+    if desborde == 'csv':
+        resto = [name for pagina in paginas[1:] for name in pagina]
+        ruta = presupuesto_filas.ruta_desborde(nombre_archivo, 'EC2')
+        presupuesto_filas.escribir_csv(
+            ruta, ['Name', 'Detalle', 'Costo (US$)'] + [ETIQUETAS_METRICA[m] for m in extras],
+            ([name, cat, a_dolares(costo)] + [a_dolares(v.get(name, {}).get(cat, 0)) for v in extras.values()]
+             for name in resto for cat, costo in ordenar_por_total(ec2_data[name])))
+        print(f"   ⚠️  EC2: {len(resto)} Names superan --max-filas -> {ruta}")
+        datos, extras_pagina = parte(paginas[0])
+        return [Hoja(escribir_hoja_ec2, (datos, total, color, extras_pagina, 'EC2',
+                                         presupuesto_filas.nota_desborde(len(resto), ruta)))]
+    print(f"   ⚠️  EC2: {len(paginas)} hojas para no superar --max-filas")
+    return [Hoja(escribir_hoja_ec2, (datos, total, color, extras_pagina,
+                                     presupuesto_filas.titulo_continuacion('EC2', i) if i > 1 else 'EC2'))
+            for i, (datos, extras_pagina) in enumerate(map(parte, paginas), start=1)]
+
+
+def escribir_hoja_grupos(wb, hoja, titulo, desc, cabeceras, grupos, total, color, extras=None,
+                         etiqueta_total='TOTAL DEL SERVICIO'):
+    """Hoja agrupada: <grupo> | Name | Costo, con una fila subtotal dorada por grupo.
+
+    grupos: {grupo: {name: costo}}; extras: {metrica: {grupo: {name: valor}}}.
+    """
+    extras = extras or {}
+    ws = wb.create_sheet(hoja)
     _formato_columnas(ws, {'A': 42, 'B': 42, 'C': 16})
-    h = _cabecera_hoja(ws, 'Otros servicios', DESCRIPCIONES['Otros'], total, 3, color)
+    h = _cabecera_hoja(ws, titulo, desc, total, 3, color, etiqueta_total)
     fill_header = PatternFill('solid', fgColor=color)
 
-    for c, texto in enumerate(['Servicio', 'Name', 'Costo (US$)'], start=1):
+    for c, texto in enumerate(cabeceras, start=1):
         cell = ws.cell(h, c, texto)
         cell.fill = fill_header
         cell.font = F_HEADER
         cell.alignment = Alignment(horizontal='center', vertical='center')
         cell.border = BORDE
+    _cabeceras_extra(ws, h, 4, extras, fill_header)
 
     r = h + 1
-    grupos = sorted(otros.items(), key=lambda kv: sum(kv[1].values()), reverse=True)
-    for gi, (servicio, names) in enumerate(grupos):
-        for c, val in enumerate([servicio, '▸ TOTAL', round(sum(names.values()), 2)], start=1):
+    for gi, (grupo, subtotal) in enumerate(ordenar_por_total(totales_de(grupos))):
+        names = grupos[grupo]
+        for c, val in enumerate([grupo, '▸ TOTAL', a_dolares(subtotal)], start=1):
             cell = ws.cell(r, c, val)
             cell.fill = FILL_GOLD
             cell.font = F_SUBTOTAL
@@ -405,22 +521,43 @@ def escribir_hoja_otros(wb, otros, total, color):
             if c == 3:
                 cell.number_format = CUR
                 cell.alignment = Alignment(horizontal='right')
+        _celdas_extra(ws, r, 4, {m: _subtotal_extra(m, v.get(grupo, {}).values()) for m, v in extras.items()},
+                      FILL_GOLD, F_SUBTOTAL)
         r += 1
         fill = FILL_BANDA if gi % 2 else FILL_BLANCO
-        for name, costo in sorted(names.items(), key=lambda x: x[1], reverse=True):
-            cs = ws.cell(r, 1, servicio); cs.fill = fill; cs.font = F_NORMAL; cs.border = BORDE
+        for name, costo in ordenar_por_total(names):
+            cs = ws.cell(r, 1, grupo); cs.fill = fill; cs.font = F_NORMAL; cs.border = BORDE
             cn = ws.cell(r, 2, name); cn.fill = fill; cn.font = F_NORMAL; cn.border = BORDE
-            cc = ws.cell(r, 3, round(costo, 2)); cc.fill = fill; cc.font = F_NORMAL
+            cc = ws.cell(r, 3, a_dolares(costo)); cc.fill = fill; cc.font = F_NORMAL
             cc.number_format = CUR; cc.border = BORDE
             cc.alignment = Alignment(horizontal='right')
+            _celdas_extra(ws, r, 4, {m: v.get(grupo, {}).get(name, 0) for m, v in extras.items()},
+                          fill, F_NORMAL)
             r += 1
 
-    ws.auto_filter.ref = f'A{h}:C{r - 1}'
+    ws.auto_filter.ref = f'A{h}:{get_column_letter(3 + len(extras))}{r - 1}'
     ws.freeze_panes = f'A{h + 1}'
 
 
+def escribir_hoja_otros(wb, otros, total, color, extras=None):
+    """Hoja Otros: Servicio | Name | Costo. extras: {metrica: {servicio: {name: valor}}}."""
+    escribir_hoja_grupos(wb, 'Otros servicios', 'Otros servicios', DESCRIPCIONES['Otros'],
+                         ['Servicio', 'Name', 'Costo (US$)'], otros, total, color, extras)
+
+
+def escribir_hoja_dimension(wb, hoja, combinacion, cruce, color):
+    """Hoja de --dimensiones: <valores de la combinación> | Name | Costo."""
+    titulo = dimensiones.titulo(combinacion)
+    desc = f'Coste por {titulo} y Name (consulta {titulo} × Name a Cost Explorer).'
+    if len(combinacion) > 1:
+        desc += ' Combinación cruzada por Name: estimación si un Name tiene varios valores.'
+    grupos = {' · '.join(valores): names for valores, names in cruce.items()}
+    escribir_hoja_grupos(wb, hoja, f'Por {titulo}', desc, [titulo, 'Name', 'Costo (US$)'], grupos,
+                         sum(totales_de(grupos).values()), color, etiqueta_total='TOTAL')
+
+
 def escribir_hoja_resumen(wb, totales_servicio, totales_name, fecha_inicio, fecha_fin,
-                          costo_total, es_partner, porcentaje_descuento):
+                          costo_total, es_partner, porcentaje_descuento, totales_metrica=None):
     ws = wb.active
     ws.title = 'Resumen'
     _formato_columnas(ws, {'A': 34, 'B': 18, 'C': 3})
@@ -435,27 +572,36 @@ def escribir_hoja_resumen(wb, totales_servicio, totales_name, fecha_inicio, fech
     # KPIs
     _merge_estilo(ws, 'A4:A4', 'TOTAL GENERAL', FILL_KPI, F_KPI_LBL,
                   Alignment(horizontal='right', vertical='center'))
-    kpi = ws.cell(4, 2, round(costo_total, 2))
+    kpi = ws.cell(4, 2, a_dolares(costo_total))
     kpi.fill = FILL_KPI; kpi.font = F_KPI_VAL; kpi.number_format = CUR
     kpi.alignment = Alignment(horizontal='center', vertical='center')
     ws.row_dimensions[4].height = 24
 
     fila = 5
     if es_partner:
-        monto = costo_total * (porcentaje_descuento / 100)
+        monto = porcentaje(costo_total, porcentaje_descuento)
         _merge_estilo(ws, f'A{fila}:A{fila}', f'Descuento Partner ({porcentaje_descuento}%)',
                       FILL_VERDE, F_SUBTOTAL, Alignment(horizontal='right', vertical='center'))
-        d = ws.cell(fila, 2, round(-monto, 2)); d.fill = FILL_VERDE; d.font = F_SUBTOTAL
+        d = ws.cell(fila, 2, a_dolares(-monto)); d.fill = FILL_VERDE; d.font = F_SUBTOTAL
         d.number_format = CUR; d.alignment = Alignment(horizontal='center')
         fila += 1
         _merge_estilo(ws, f'A{fila}:A{fila}', 'TOTAL CON DESCUENTO', PatternFill('solid', fgColor=C_VERDE),
                       Font(bold=True, size=12, color=C_BLANCO),
                       Alignment(horizontal='right', vertical='center'))
-        td = ws.cell(fila, 2, round(costo_total - monto, 2))
+        td = ws.cell(fila, 2, a_dolares(costo_total - monto))
         td.fill = PatternFill('solid', fgColor=C_VERDE); td.font = Font(bold=True, size=12, color=C_BLANCO)
         td.number_format = CUR; td.alignment = Alignment(horizontal='center')
         fila += 1
 
+    # Totales de las métricas adicionales (--metrics)
+    for metrica, total_m in (totales_metrica or {}).items():
+        _merge_estilo(ws, f'A{fila}:A{fila}', f'Total {ETIQUETAS_METRICA[metrica]}', FILL_DESC, F_SUBTOTAL,
+                      Alignment(horizontal='right', vertical='center'))
+        m = ws.cell(fila, 2, a_dolares(total_m)); m.fill = FILL_DESC; m.font = F_SUBTOTAL
+        m.number_format = NUM if metrica == 'UsageQuantity' else CUR
+        m.alignment = Alignment(horizontal='center')
+        fila += 1
+
     # ---- Tabla: coste por servicio ----
     hs = fila + 1  # fila de cabecera de la tabla de servicios
     for c, texto in enumerate(['Servicio', 'Coste (US$)'], start=1):
@@ -465,13 +611,13 @@ def escribir_hoja_resumen(wb, totales_servicio, totales_name, fecha_inicio, fech
         r = hs + 1 + i
         f = FILL_BANDA if i % 2 else FILL_BLANCO
         a = ws.cell(r, 1, etiqueta); a.fill = f; a.font = F_NORMAL; a.border = BORDE
-        b = ws.cell(r, 2, round(total, 2)); b.fill = f; b.font = F_NORMAL
+        b = ws.cell(r, 2, a_dolares(total)); b.fill = f; b.font = F_NORMAL
         b.number_format = CUR; b.border = BORDE; b.alignment = Alignment(horizontal='right')
     fin_serv = hs + len(totales_servicio)
     ws.auto_filter.ref = f'A{hs}:B{fin_serv}'
 
     # ---- Tabla: Top Names ----
-    top_names = totales_name[:15]
+    top_names = top_n(totales_name, 15)
     hn = fin_serv + 3
     _merge_estilo(ws, f'A{hn - 1}:B{hn - 1}', 'Top 15 recursos por coste (Name)',
                   FILL_DESC, F_SUBTOTAL, Alignment(horizontal='left', indent=1))
@@ -482,7 +628,7 @@ def escribir_hoja_resumen(wb, totales_servicio, totales_name, fecha_inicio, fech
         r = hn + 1 + i
         f = FILL_BANDA if i % 2 else FILL_BLANCO
         a = ws.cell(r, 1, name); a.fill = f; a.font = F_NORMAL; a.border = BORDE
-        b = ws.cell(r, 2, round(total, 2)); b.fill = f; b.font = F_NORMAL
+        b = ws.cell(r, 2, a_dolares(total)); b.fill = f; b.font = F_NORMAL
         b.number_format = CUR; b.border = BORDE; b.alignment = Alignment(horizontal='right')
     fin_name = hn + len(top_names)
 
@@ -534,52 +680,111 @@ def escribir_hoja_resumen(wb, totales_servicio, totales_name, fecha_inicio, fech
 
 
 def crear_excel(ec2_data, con_hoja, otros, totales_name, fecha_inicio, fecha_fin,
-                nombre_archivo, es_partner=False, porcentaje_descuento=5.0):
-    print("\n📝 Creando Excel por servicio (con estilos y gráficas)...")
+                nombre_archivo, es_partner=False, porcentaje_descuento=5.0, metricas_extra=None, cruces=None,
+                variacion=None, anomalias=None, prevision=None, procesos_excel=1,
+                cache_hojas=None, max_filas=presupuesto_filas.LIMITE_FILAS_EXCEL, desborde='hojas'):
+    """metricas_extra: {metrica: {'ec2': {...}, 'servicios': {...}}} para las columnas de --metrics.
+    cruces: [(combinacion, {valores: {name: costo}})] de --dimensiones, una hoja 'Por ...' cada una.
+    variacion: de variacion_mensual.comparar_con_anterior, hoja 'Variación'.
+    anomalias: de anomalias.analizar, hoja 'Anomalías'.
+    prevision: de prevision.PrevisionMes.resultados, hoja 'Previsión'.
+    procesos_excel: procesos para renderizar las hojas de datos (0 = todos los núcleos; 1 = en serie).
+    cache_hojas: directorio de la caché de hojas renderizadas (None = sin caché).
+    max_filas, desborde: presupuesto de filas de la hoja EC2 (ver presupuesto_filas)."""
+    from render_paralelo import Hoja, Renderizador, guardar as guardar_libro
 
-    ec2_total = sum(sum(cats.values()) for cats in ec2_data.values())
+    print("\n📝 Creando Excel por servicio (con estilos y gráficas)...")
+    metricas_extra = metricas_extra or {}
+    extras_ec2 = {m: d['ec2'] for m, d in metricas_extra.items()}
+    extras_servicios = {m: d['servicios'] for m, d in metricas_extra.items()}
+    totales_metrica = {m: (sum(sum(c.values()) for c in d['ec2'].values())
+                           + sum(sum(n.values()) for n in d['servicios'].values()))
+                       for m, d in metricas_extra.items() if m not in METRICAS_NO_ADITIVAS}
+
+    ec2_total = sum(totales_de(ec2_data).values())
+    totales_con_hoja = totales_de(con_hoja)
     totales_servicio = []
     if ec2_data:
         totales_servicio.append(('EC2 (Compute + Other + EBS)', ec2_total))
-    for servicio, names in con_hoja.items():
-        totales_servicio.append((NOMBRES_HOJA.get(servicio, servicio), sum(names.values())))
-    otros_total = sum(sum(n.values()) for n in otros.values())
+    for servicio, total in totales_con_hoja.items():
+        totales_servicio.append((NOMBRES_HOJA.get(servicio, servicio), total))
+    otros_total = sum(totales_de(otros).values())
     if otros_total > 0:
         totales_servicio.append(('Otros servicios', otros_total))
     totales_servicio.sort(key=lambda x: x[1], reverse=True)
     costo_total = sum(t for _, t in totales_servicio)
 
+    # Hojas de datos: EC2 (color fijo), servicios con hoja propia (orden por total desc, cada uno con
+    # su color FIJO), Otros (color neutro) y dimensiones adicionales (--dimensiones)
+    hojas = hojas_ec2(ec2_data, ec2_total, color_de_servicio('EC2'), extras_ec2, max_filas, desborde,
+                      nombre_archivo)
+    usados = {'Resumen'} | {h.argumentos[4] for h in hojas}  # 'EC2' y sus continuaciones
+    for servicio, total in ordenar_por_total(totales_con_hoja):
+        hojas.append(Hoja(escribir_hoja_servicio, (
+            nombre_hoja(servicio, usados), servicio, con_hoja[servicio], total, color_de_servicio(servicio),
+            {m: v.get(servicio, {}) for m, v in extras_servicios.items()})))
+    if otros_total > 0:
+        hojas.append(Hoja(escribir_hoja_otros, (otros, otros_total, COLOR_OTROS, extras_servicios)))
+    usados |= {'Otros servicios'}
+    for combinacion, cruce in cruces or []:
+        hojas.append(Hoja(escribir_hoja_dimension, (dimensiones.nombre_hoja(combinacion, usados), combinacion,
+                                                    cruce, COLOR_DIMENSION)))
+    # --procesos-excel: se renderizan en otros procesos mientras aquí se escribe el Resumen
+    # --cache-hojas: las que no han cambiado desde la última ejecución salen de la caché
+    renderizador = Renderizador(hojas, procesos_excel, cache_hojas).lanzar()
+
     wb = Workbook()
 
     # Resumen (usa la hoja activa) — pestaña en azul marino corporativo
     escribir_hoja_resumen(wb, totales_servicio, totales_name, fecha_inicio, fecha_fin,
-                          costo_total, es_partner, porcentaje_descuento)
+                          costo_total, es_partner, porcentaje_descuento, totales_metrica)
     wb.active.sheet_properties.tabColor = C_TINTA
 
-    # EC2 (color fijo)
-    escribir_hoja_ec2(wb, ec2_data, ec2_total, color_de_servicio('EC2'))
+    renderizador.recoger(wb)
 
-    # Servicios con hoja propia (orden por total desc), cada uno con su color FIJO
-    usados = {'Resumen', 'EC2'}
-    servicios_ordenados = sorted(con_hoja, key=lambda s: sum(con_hoja[s].values()), reverse=True)
-    for servicio in servicios_ordenados:
-        hoja = nombre_hoja(servicio, usados)
-        escribir_hoja_servicio(wb, hoja, servicio, con_hoja[servicio],
-                               sum(con_hoja[servicio].values()), color_de_servicio(servicio))
+    if variacion is not None:
+        escribir_hoja_variacion(wb, variacion).sheet_properties.tabColor = C_NARANJA
+    if anomalias is not None:
+        from anomalias import escribir_hoja_anomalias
+        escribir_hoja_anomalias(wb, anomalias).sheet_properties.tabColor = 'C00000'
+    if prevision is not None:
+        from prevision import escribir_hoja_prevision
+        escribir_hoja_prevision(wb, prevision).sheet_properties.tabColor = '5B2C6F'
 
-    # Otros (color neutro)
-    if otros_total > 0:
-        escribir_hoja_otros(wb, otros, otros_total, COLOR_OTROS)
-
-    wb.save(nombre_archivo)
+    guardar_libro(wb, nombre_archivo)
 
     print(f"\n✅ Excel creado: {nombre_archivo}")
-    print(f"💰 Costo total: ${costo_total:,.2f} USD")
+    print(f"💰 Costo total: ${a_dolares(costo_total):,.2f} USD")
     if es_partner:
-        monto = costo_total * (porcentaje_descuento / 100)
-        print(f"💚 Descuento ({porcentaje_descuento}%): ${monto:,.2f} USD")
-        print(f"💰 Total con descuento: ${costo_total - monto:,.2f} USD")
-    print(f"📄 Hojas: Resumen + EC2 + {len(con_hoja)} servicios" + (" + Otros" if otros_total > 0 else ""))
+        monto = porcentaje(costo_total, porcentaje_descuento)
+        print(f"💚 Descuento ({porcentaje_descuento}%): ${a_dolares(monto):,.2f} USD")
+        print(f"💰 Total con descuento: ${a_dolares(costo_total - monto):,.2f} USD")
+    print(f"📄 Hojas: Resumen + EC2 + {len(con_hoja)} servicios" + (" + Otros" if otros_total > 0 else "")
+          + (f" + {len(cruces)} por dimensión" if cruces else ""))
+    return costo_total
+
+
+def crear_html(ec2_data, con_hoja, otros, fecha_inicio, fecha_fin, nombre_archivo,
+               es_partner=False, porcentaje_descuento=5.0):
+    """Panel HTML (--format html) con el mismo modelo que crear_excel, sin openpyxl; devuelve el total en µ¢"""
+    print("\n🌐 Creando panel HTML...")
+    servicios = {}
+    for servicio, names in list(con_hoja.items()) + list(otros.items()):
+        servicios[NOMBRES_HOJA.get(servicio, servicio)] = names
+    colores = {NOMBRES_HOJA.get(s, s): color_de_servicio(s) for s in list(con_hoja) + list(otros)}
+    colores[informe_html.SERVICIO_EC2] = color_de_servicio('EC2')
+    datos = informe_html.modelo(ec2_data, servicios, colores, fecha_inicio, fecha_fin,
+                                es_partner, porcentaje_descuento)
+    informe_html.escribir_html(nombre_archivo, datos, f'AWS Cost Report por servicio · {fecha_inicio[:7]}')
+    print(f"\n✅ HTML creado: {nombre_archivo} ({len(datos['filas']):,} filas, "
+          f"{os.path.getsize(nombre_archivo) / 1024:,.0f} KB)")
+    costo_total = (sum(sum(c.values()) for c in ec2_data.values())
+                   + sum(sum(n.values()) for n in servicios.values()))
+    print(f"💰 Costo total: ${a_dolares(costo_total):,.2f} USD")
+    if es_partner:
+        monto = porcentaje(costo_total, porcentaje_descuento)
+        print(f"💚 Descuento ({porcentaje_descuento}%): ${a_dolares(monto):,.2f} USD")
+        print(f"💰 Total con descuento: ${a_dolares(costo_total - monto):,.2f} USD")
     return costo_total
 
 
@@ -587,18 +792,137 @@ def main():
     parser = argparse.ArgumentParser(description='Costos AWS con una hoja por servicio (EC2 desglosado)')
     parser.add_argument('--mes', type=int, help='Mes (1-12)')
     parser.add_argument('--anio', type=int, help='Año')
-    parser.add_argument('--output', type=str, default='aws_costos_por_servicio.xlsx', help='Archivo de salida')
+    parser.add_argument('--output', type=str, default='aws_costos_por_servicio.xlsx',
+                        help="Archivo de salida ('-' = stdout con --format csv|jsonl)")
+    parser.add_argument('--format', choices=('xlsx', 'html', 'csv', 'jsonl'), default='xlsx',
+                        help='xlsx (default), html: panel autocontenido con filtros, o csv/jsonl: filas '
+                             'normalizadas en flujo, sin Excel')
+    parser.add_argument('--gzip', action='store_true', help='Comprime la salida csv/jsonl con gzip')
     parser.add_argument('--profile', type=str, help='Perfil AWS')
     parser.add_argument('--region', type=str, default='eu-west-1', help='Región AWS')
     parser.add_argument('--umbral-hoja', type=float, default=20.0,
                         help='Coste mínimo (US$) para que un servicio tenga hoja propia (default: 20)')
     parser.add_argument('--partner', action='store_true', help='Aplicar descuento de partner')
     parser.add_argument('--descuento', type=float, default=5.0, help='Porcentaje de descuento (default: 5.0)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Reutiliza los días ya consultados y solo pide los nuevos (mes en curso)')
+    parser.add_argument('--estado', type=str,
+                        help='Fichero de estado incremental (default: .aws_cost_estado_YYYY-MM.json)')
+    parser.add_argument('--ventana-revision', type=int, default=3,
+                        help='Días recientes que se vuelven a consultar en modo incremental (default: 3)')
+    parser.add_argument('--metrics', nargs='+', choices=METRICAS_DISPONIBLES, metavar='METRICA',
+                        help=f'Métricas adicionales en las mismas consultas ({", ".join(METRICAS_DISPONIBLES)})')
+    parser.add_argument('--max-requests', type=int,
+                        help='Máximo de peticiones (facturadas) a Cost Explorer; se aborta antes de superarlo')
+    parser.add_argument('--resumen-api', type=str,
+                        help='Guarda en este JSON el recuento de peticiones y el coste estimado de la API')
+    grabacion = parser.add_mutually_exclusive_group()
+    grabacion.add_argument('--record', type=str, metavar='DIR',
+                           help='Graba en DIR las respuestas crudas de Cost Explorer (comprimidas)')
+    grabacion.add_argument('--replay', type=str, metavar='DIR',
+                           help='Reproduce las respuestas grabadas en DIR, sin conectar a AWS')
+    grabacion.add_argument('--cur', type=str, metavar='DIR',
+                           help='Lee los costes de los Parquet del CUR en DIR en lugar de Cost Explorer (requiere pyarrow)')
+    grabacion.add_argument('--cubo', type=str, metavar='DIR',
+                           help='Lee el periodo del cubo de costes en disco (ver cubo_costes.py)')
+    parser.add_argument('--procesos', type=int,
+                        help='Procesos para agregar el CUR en paralelo (con --cur; default: todos los núcleos)')
+    parser.add_argument('--procesos-excel', type=int, default=1, metavar='N',
+                        help='Procesos para renderizar las hojas del Excel en paralelo (0 = todos los núcleos; default: 1)')
+    parser.add_argument('--cache-hojas', action='store_true',
+                        help='Reutiliza las hojas ya renderizadas cuyos datos no han cambiado (en <cache>/hojas)')
+    parser.add_argument('--max-filas', type=int, default=presupuesto_filas.LIMITE_FILAS_EXCEL, metavar='N',
+                        help='Filas máximas por hoja; EC2 se parte en hojas de continuación o en CSV '
+                             f'(default: {presupuesto_filas.LIMITE_FILAS_EXCEL}, el límite de Excel)')
+    parser.add_argument('--desborde', choices=presupuesto_filas.DESBORDES, default='hojas',
+                        help='Qué hacer con las filas que superan --max-filas (default: hojas)')
+    parser.add_argument('--atribuir-recursos', action='store_true',
+                        help='Atribuye a los Names los costes EC2 sin etiqueta con datos por recurso (últimos 14 días)')
+    parser.add_argument('--indice-recursos', type=str, default='.aws_recursos_name.json',
+                        help='Índice recurso -> Name en disco para --atribuir-recursos (default: .aws_recursos_name.json)')
+    parser.add_argument('--instantaneas', type=str, metavar='DIR',
+                        help='Guarda en DIR una instantánea del modelo del mes (para --comparar)')
+    parser.add_argument('--comparar', action='store_true',
+                        help='Añade la hoja Variación frente a la instantánea del mes anterior (requiere --instantaneas)')
+    parser.add_argument('--anomalias', action='store_true',
+                        help='Detecta picos en el coste diario por Name (hoja Anomalías y <output>_anomalias.json)')
+    parser.add_argument('--umbral-anomalia', type=float, default=5.0,
+                        help='Puntuación robusta mínima para marcar un día como anómalo (default: 5)')
+    parser.add_argument('--dimensiones', nargs='+', metavar='DIM[,DIM]',
+                        help='Hojas adicionales por dimensión o combinación (ServerGroup, REGION, '
+                             'LINKED_ACCOUNT, USAGE_TYPE, tag:<clave>; p. ej. ServerGroup REGION,ServerGroup)')
+    parser.add_argument('--fragmentos', type=int, metavar='N',
+                        help='Divide la consulta base en N consultas paralelas por Name (cuentas muy grandes)')
+    parser.add_argument('--preflight', action='store_true',
+                        help='Valida credenciales, permisos y etiquetas antes de consultar (respuestas en caché)')
+    parser.add_argument('--prevision', action='store_true',
+                        help='Añade la hoja Previsión con el cierre estimado del mes en curso (get_cost_forecast)')
+    parser.add_argument('--cache', type=str, default='.aws_cost_cache', metavar='DIR',
+                        help='Caché en disco de las respuestas de previsión y validación (default: .aws_cost_cache)')
+    parser.add_argument('--cache-ttl', type=float, default=6, metavar='HORAS',
+                        help='Horas de validez de la caché para periodos abiertos (default: 6)')
+    parser.add_argument('--motor', choices=('hilos', 'async'), default='hilos',
+                        help='Cómo se lanzan las consultas a Cost Explorer: hilos (default) o async, todas a la vez '
+                             'sobre asyncio con un límite global (--concurrencia)')
+    parser.add_argument('--concurrencia', type=int, default=CONCURRENCIA, metavar='N',
+                        help=f'Peticiones simultáneas como máximo con --motor async (default: {CONCURRENCIA})')
+    parser.add_argument('--endpoint-url', type=str, metavar='URL',
+                        help='Endpoint de Cost Explorer alternativo (p. ej. servidor_ce_simulado.py en local)')
     args = parser.parse_args()
 
+    # csv/jsonl: con --output - los datos van a stdout y los mensajes de progreso a stderr
+    estandar = None
+    if args.format in exportacion.FORMATOS:
+        args.output, args.gzip = exportacion.ruta_salida(args.output, args.format, args.gzip)
+        if args.output == exportacion.SALIDA_ESTANDAR:
+            estandar = exportacion.desviar_registro()
+    elif args.gzip:
+        print("❌ --gzip solo se usa con --format csv|jsonl")
+        sys.exit(1)
+    # Opciones que solo van en el Excel: con otro formato sus consultas (facturadas) se tirarían
+    if args.format != 'xlsx':
+        solo_excel = [opcion for opcion, usada in (
+            ('--dimensiones', args.dimensiones), ('--prevision', args.prevision), ('--comparar', args.comparar),
+            ('--partner', args.partner and args.format != 'html'), ('--cache-hojas', args.cache_hojas),
+            ('--procesos-excel', args.procesos_excel != parser.get_default('procesos_excel')),
+            ('--max-filas', args.max_filas != parser.get_default('max_filas')),
+            ('--desborde', args.desborde != parser.get_default('desborde'))) if usada]
+        if solo_excel:
+            print(f"❌ Solo con --format xlsx (no con {args.format}): {', '.join(solo_excel)}")
+            sys.exit(1)
     if (args.mes and not args.anio) or (args.anio and not args.mes):
         print("❌ Debes especificar mes Y año, o ninguno")
         sys.exit(1)
+    if args.incremental and args.metrics:
+        print("❌ --metrics no es compatible con --incremental")
+        sys.exit(1)
+    if args.incremental and (args.cur or args.cubo):
+        print("❌ --cur/--cubo no son compatibles con --incremental")
+        sys.exit(1)
+    if args.comparar and not args.instantaneas:
+        print("❌ --comparar requiere --instantaneas DIR")
+        sys.exit(1)
+    if args.atribuir_recursos and (args.incremental or args.cur or args.cubo):
+        print("❌ --atribuir-recursos solo está disponible con Cost Explorer (no con --incremental/--cur/--cubo)")
+        sys.exit(1)
+    if args.fragmentos is not None and (args.fragmentos < 1 or args.incremental or args.cur or args.cubo):
+        print("❌ --fragmentos necesita N >= 1 y Cost Explorer (no con --incremental/--cur/--cubo)")
+        sys.exit(1)
+    if args.procesos is not None and (args.procesos < 1 or not args.cur):
+        print("❌ --procesos necesita N >= 1 y --cur")
+        sys.exit(1)
+    if args.prevision and (args.cur or args.cubo):
+        print("❌ --prevision solo está disponible con Cost Explorer (no con --cur/--cubo)")
+        sys.exit(1)
+    if args.motor == 'async' and (args.record or args.replay or args.cur or args.cubo or args.concurrencia < 1):
+        print("❌ --motor async necesita --concurrencia N >= 1 y Cost Explorer (no con --record/--replay/--cur/--cubo)")
+        sys.exit(1)
+    presupuesto_filas.validar(args)
+    if args.procesos_excel < 0:
+        print("❌ --procesos-excel necesita N >= 0")
+        sys.exit(1)
+    combinaciones = validar_dimensiones(args)
+    metricas = preparar_metricas(args.metrics)
 
     print("=" * 70)
     print("AWS COST REPORT - Una hoja por servicio (estilos + filtros + gráficas)")
@@ -606,52 +930,175 @@ def main():
         print(f"🤝 Modo Partner activado - Descuento: {args.descuento}%")
     print("=" * 70)
 
-    fecha_inicio, fecha_fin = obtener_rango_fechas(args.mes, args.anio)
+    reproductor = None
+    if args.replay:
+        try:
+            reproductor = ClienteCEReproductor(args.replay)
+        except (OSError, ValueError) as e:
+            print(f"❌ No se puede reproducir: {e}")
+            sys.exit(1)
+
+    if reproductor and not args.mes and reproductor.manifiesto['descripcion'].get('periodo'):
+        # Sin --mes/--anio se reproduce el periodo grabado
+        fecha_inicio, fecha_fin = reproductor.manifiesto['descripcion']['periodo']
+        print(f"📅 Periodo grabado: {fecha_inicio} a {fecha_fin}")
+    else:
+        fecha_inicio, fecha_fin = obtener_rango_fechas(args.mes, args.anio)
 
     session_params = {'region_name': args.region}
     if args.profile:
         session_params['profile_name'] = args.profile
+    ce = None
+    cliente_ec2 = None
+    # El resumen de la API se muestra (y --resumen-api se escribe) también si el informe termina
+    # antes de tiempo: las peticiones hechas hasta entonces ya se han facturado
     try:
-        session = boto3.Session(**session_params)
-        ce = session.client('ce')
-        print(f"✅ Conectado a AWS ({args.region})")
-    except Exception as e:
-        print(f"❌ Error conectando: {e}")
-        sys.exit(1)
-
-    costos_base = obtener_costos_base(ce, fecha_inicio, fecha_fin)
-
-    names_con_ec2 = {name for name, servs in costos_base.items()
-                     if any(s in servs for s in SERVICIOS_EC2)}
-    print(f"   → {len(names_con_ec2)} Names con costos EC2 detectados")
-    desglose_ec2 = obtener_desglose_ec2_completo(ce, fecha_inicio, fecha_fin, names_con_ec2)
-    ec2_data = normalizar_desglose_ec2(costos_base, desglose_ec2)
-
-    servicios_data = reorganizar_por_servicio(costos_base)
-    con_hoja, otros = clasificar_servicios(servicios_data, args.umbral_hoja)
-
-    # Total por Name (para la gráfica Top Names)
-    totales_name = sorted(
-        ((name, sum(servs.values())) for name, servs in costos_base.items()),
-        key=lambda x: x[1], reverse=True)
-
-    print(f"\n📊 {len(con_hoja)} servicios con hoja propia, {len(otros)} agrupados en 'Otros'")
-
-    # Verificación de reconciliación
-    total_base = sum(sum(s.values()) for s in costos_base.values())
-    total_calc = (sum(sum(c.values()) for c in ec2_data.values())
-                  + sum(sum(n.values()) for n in servicios_data.values()))
-    print("\n" + "=" * 70)
-    print("✅ VERIFICACIÓN:")
-    print(f"   Total Cost Explorer (base): ${total_base:,.2f}")
-    print(f"   Total calculado (EC2+resto): ${total_calc:,.2f}")
-    diff = abs(total_base - total_calc)
-    print(f"   {'✅ COINCIDENCIA' if diff < 1 else '⚠️  Diferencia'}: ${diff:,.2f}")
-    print("=" * 70)
-
-    crear_excel(ec2_data, con_hoja, otros, totales_name, fecha_inicio, fecha_fin,
-                args.output, args.partner, args.descuento)
-
+        try:
+            if args.cur or args.cubo:
+                print(f"📦 Fuente de datos: {'CUR' if args.cur else 'cubo'} en {args.cur or args.cubo} "
+                      f"(sin llamadas a Cost Explorer)")
+            elif reproductor:
+                ce = ClienteCEMedido(reproductor, args.max_requests, facturado=False)
+                print(f"📼 Reproduciendo respuestas grabadas en {args.replay} "
+                      f"({reproductor.manifiesto['grabado']}, {reproductor.manifiesto['respuestas']} respuestas)")
+            else:
+                session = boto3.Session(**session_params)
+                cliente = session.client('ce', endpoint_url=args.endpoint_url)
+                if args.record:
+                    cliente = ClienteCEGrabador(cliente, args.record, {
+                        'script': os.path.basename(__file__),
+                        'periodo': [fecha_inicio, fecha_fin],
+                        'argumentos': sys.argv[1:],
+                    })
+                    print(f"⏺️  Grabando respuestas de Cost Explorer en {args.record}")
+                ce = ClienteCEMedido(cliente, args.max_requests)
+                if args.motor == 'async':
+                    ce = MotorCEAsync.desde_sesion(session, cliente, ce, args.concurrencia)
+                    print(f"⚡ Motor asyncio: hasta {args.concurrencia} peticiones simultáneas a {ce.endpoint}")
+                if args.preflight:
+                    from validar_configuracion import preflight
+                    if not preflight(session, args.cache, cliente_ce=ce):
+                        sys.exit(1)
+                if args.atribuir_recursos:
+                    cliente_ec2 = session.client('ec2')
+                print(f"✅ Conectado a AWS ({args.region})")
+        except Exception as e:
+            print(f"❌ Error conectando: {e}")
+            sys.exit(1)
+
+        # Previsión de cierre: arranca ya y corre en paralelo con las consultas de costes
+        prevision_mes = None
+        if args.prevision:
+            from prevision import PrevisionMes
+            prevision_mes = PrevisionMes(ce, fecha_inicio, fecha_fin, args.cache, args.cache_ttl)
+
+        modelo = None
+        if args.incremental:
+            from refresco_incremental import refrescar_mes, ruta_estado_por_defecto
+            costos_base, desglose_ec2, _ = refrescar_mes(
+                ce, fecha_inicio, fecha_fin, args.estado or ruta_estado_por_defecto(fecha_inicio),
+                args.ventana_revision)
+            base_m, desglose_m = {}, {}
+        elif args.cubo:
+            from cubo_costes import obtener_costos_cubo
+            base_m, desglose_m, _ = obtener_costos_cubo(args.cubo, fecha_inicio, fecha_fin, metricas)
+            costos_base = base_m[METRICA_PRINCIPAL]
+            desglose_ec2 = desglose_m[METRICA_PRINCIPAL]
+        elif args.cur:
+            from fuente_cur import obtener_costos_cur
+            base_m, desglose_m, _ = obtener_costos_cur(args.cur, fecha_inicio, fecha_fin,
+                                                       metricas=metricas, procesos=args.procesos)
+            costos_base = base_m[METRICA_PRINCIPAL]
+            desglose_ec2 = desglose_m[METRICA_PRINCIPAL]
+        elif combinaciones:
+            base_m, desglose_m, _, modelo = obtener_costos_informe_dimensiones(
+                ce, fecha_inicio, fecha_fin, combinaciones, metricas, args.fragmentos)
+            costos_base = base_m[METRICA_PRINCIPAL]
+            desglose_ec2 = desglose_m[METRICA_PRINCIPAL]
+        else:
+            # Backup sale de la consulta base sin coste extra; este informe no lo usa
+            base_m, desglose_m, _ = obtener_costos_informe(ce, fecha_inicio, fecha_fin, metricas=metricas,
+                                                           fragmentos=args.fragmentos)
+            costos_base = base_m[METRICA_PRINCIPAL]
+            desglose_ec2 = desglose_m[METRICA_PRINCIPAL]
+        if args.atribuir_recursos:
+            from atribucion_recursos import aplicar_atribucion
+            aplicar_atribucion(ce, cliente_ec2, fecha_inicio, fecha_fin, base_m, desglose_m, metricas,
+                               args.indice_recursos)
+        ec2_data = normalizar_desglose_ec2(costos_base, desglose_ec2)
+        servicios_data = reorganizar_por_servicio(costos_base)
+
+        # Métricas adicionales (--metrics): misma normalización contra su propia base (salvo las que
+        # mezclan unidades: su desglose se muestra tal cual)
+        metricas_extra = {}
+        for metrica in metricas[1:]:
+            print(f"\n📐 Métrica adicional: {metrica}")
+            metricas_extra[metrica] = {
+                'ec2': (desglose_m[metrica] if metrica in METRICAS_NO_ADITIVAS
+                        else normalizar_desglose_ec2(base_m[metrica], desglose_m[metrica])),
+                'servicios': reorganizar_por_servicio(base_m[metrica]),
+            }
+            _alinear(ec2_data, metricas_extra[metrica]['ec2'])
+            _alinear(servicios_data, metricas_extra[metrica]['servicios'])
+
+        con_hoja, otros = clasificar_servicios(servicios_data, args.umbral_hoja)
+
+        # Total por Name (para la gráfica Top Names)
+        totales_name = totales_de(costos_base)
+
+        print(f"\n📊 {len(con_hoja)} servicios con hoja propia, {len(otros)} agrupados en 'Otros'")
+
+        # Verificación de reconciliación
+        total_base = sum(sum(s.values()) for s in costos_base.values())
+        total_calc = (sum(sum(c.values()) for c in ec2_data.values())
+                      + sum(sum(n.values()) for n in servicios_data.values()))
+        print("\n" + "=" * 70)
+        print("✅ VERIFICACIÓN:")
+        print(f"   Total Cost Explorer (base): ${a_dolares(total_base):,.2f}")
+        print(f"   Total calculado (EC2+resto): ${a_dolares(total_calc):,.2f}")
+        diff = abs(total_base - total_calc)
+        print(f"   {'✅ COINCIDENCIA EXACTA' if diff == 0 else '⚠️  Diferencia'}: ${a_dolares(diff):,.2f}")
+        cruces = dimensiones.cruces(modelo, combinaciones, totales_name) if modelo is not None else None
+        if cruces:
+            dimensiones.verificar(cruces, total_base)
+        print("=" * 70)
+
+        # Variación frente al mes anterior (instantáneas en disco, sin llamadas a la API)
+        variacion = None
+        if args.instantaneas:
+            if args.comparar:
+                variacion = comparar_con_anterior(args.instantaneas, fecha_inicio, costos_base)
+            guardar_instantanea(args.instantaneas, fecha_inicio, fecha_fin, costos_base)
+
+        # Anomalías en el coste diario por Name
+        anomalias = None
+        if args.anomalias:
+            # Con --output - (stdout) el JSON va junto al nombre de salida por defecto
+            salida = parser.get_default('output') if args.output == exportacion.SALIDA_ESTANDAR else args.output
+            ruta_anomalias = os.path.splitext(salida)[0] + '_anomalias.json'
+            from anomalias import analizar
+            anomalias = analizar(ce, fecha_inicio, fecha_fin, args.cur, args.cubo, args.procesos,
+                                 args.umbral_anomalia, ruta_anomalias)
+
+        prevision = prevision_mes.resultados(costos_base) if prevision_mes else None
+
+        if args.format in exportacion.FORMATOS:
+            exportacion.exportar(exportacion.filas_por_servicio(ec2_data, servicios_data, metricas_extra), metricas,
+                                 fecha_inicio, fecha_fin, args.format, args.output, args.gzip, estandar)
+        elif args.format == 'html':
+            base, extension = os.path.splitext(args.output)
+            crear_html(ec2_data, con_hoja, otros, fecha_inicio, fecha_fin,
+                       base + '.html' if extension.lower() == '.xlsx' else args.output, args.partner, args.descuento)
+        else:
+            crear_excel(ec2_data, con_hoja, otros, totales_name, fecha_inicio, fecha_fin,
+                        args.output, args.partner, args.descuento, metricas_extra, cruces, variacion, anomalias,
+                        prevision, args.procesos_excel, os.path.join(args.cache, 'hojas') if args.cache_hojas else None,
+                        args.max_filas, args.desborde)
+    finally:
+        if ce:
+            ce.imprimir_resumen(args.resumen_api)
+        if isinstance(ce, MotorCEAsync):
+            ce.cerrar()
     print("=" * 70)
     print("✨ Completado exitosamente")
     print("=" * 70)
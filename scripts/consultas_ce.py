@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Capa de acceso a la API de Cost Explorer
+========================================
+- ClienteCEMedido: envuelve el cliente boto3 'ce', cuenta cada petición (cada
+  página de una consulta paginada es una petición facturada), estima el coste
+  de la API y aplica un presupuesto opcional de peticiones (--max-requests).
+- paginar(): recorre todas las páginas (NextPageToken) de una operación.
+- valores_etiqueta(): todos los valores de una etiqueta en el periodo (get_tags).
+- ClienteCEGrabador / ClienteCEReproductor (--record / --replay): guardan en
+  un directorio las respuestas crudas de la API (cada página, comprimida) y
+  las devuelven después sin red, para repetir un informe con los mismos datos.
+- ClienteCECache: caché en disco con caducidad (TTL) para peticiones que se
+  repiten entre ejecuciones (p. ej. previsiones de --prevision).
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import defaultdict
+import time
+from datetime import date, datetime, timedelta
+
+# AWS factura 0,01 US$ por petición paginada a la API de Cost Explorer
+COSTE_POR_PETICION = 0.01
+
+# Caché de respuestas (ClienteCECache)
+DIRECTORIO_CACHE = '.aws_cost_cache'
+CACHE_TTL_HORAS = 6
+CACHE_DIAS_ASENTADO = 3  # como la ventana de revisión incremental: después los importes ya no cambian
+
+# Operaciones de Cost Explorer que se facturan por petición
+OPERACIONES_FACTURADAS = {
+    'get_cost_and_usage',
+    'get_cost_and_usage_with_resources',
+    'get_cost_forecast',
+    'get_usage_forecast',
+    'get_dimension_values',
+    'get_tags',
+}
+
+
+class PresupuestoPeticionesAgotado(SystemExit):
+    """Se lanza antes de una petición que superaría --max-requests.
+
+    Hereda de SystemExit para que los `except Exception` de las funciones de
+    consulta no lo oculten: la ejecución se corta en ese mismo punto.
+    """
+
+
+class ClienteCEMedido:
+    """Cliente de Cost Explorer que mide (y opcionalmente limita) las peticiones"""
+
+    def __init__(self, cliente, max_peticiones=None, facturado=True):
+        self._cliente = cliente
+        self.max_peticiones = max_peticiones
+        self.facturado = facturado          # False al reproducir respuestas grabadas
+        self.peticiones = defaultdict(int)  # por operación, cada página cuenta
+        self.consultas = defaultdict(int)   # consultas lógicas (primera página)
+        self._lock = threading.Lock()
+
+    def __getattr__(self, nombre):
+        atributo = getattr(self._cliente, nombre)
+        if nombre not in OPERACIONES_FACTURADAS:
+            return atributo
+
+        def llamada(**params):
+            self._registrar(nombre, params)
+            return atributo(**params)
+        return llamada
+
+    def _registrar(self, operacion, params):
+        with self._lock:
+            total = sum(self.peticiones.values())
+            if self.max_peticiones is not None and total >= self.max_peticiones:
+                print(f"\n❌ Presupuesto de peticiones agotado ({total}/{self.max_peticiones}) "
+                      f"antes de llamar a {operacion}")
+                print(f"   Coste de API ya consumido: ${self.coste_estimado():.2f} USD")
+                raise PresupuestoPeticionesAgotado(1)
+            self.peticiones[operacion] += 1
+            if 'NextPageToken' not in params:
+                self.consultas[operacion] += 1
+
+    def total_peticiones(self):
+        return sum(self.peticiones.values())
+
+    def coste_estimado(self):
+        if not self.facturado:
+            return 0.0
+        return self.total_peticiones() * COSTE_POR_PETICION
+
+    def resumen(self):
+        """Resumen serializable (para --resumen-api)"""
+        return {
+            'peticiones': self.total_peticiones(),
+            'consultas': sum(self.consultas.values()),
+            'coste_estimado_usd': round(self.coste_estimado(), 2),
+            'max_peticiones': self.max_peticiones,
+            'facturado': self.facturado,
+            'por_operacion': {op: {'peticiones': n, 'consultas': self.consultas[op]}
+                              for op, n in sorted(self.peticiones.items())},
+        }
+
+    def imprimir_resumen(self, ruta_json=None):
+        resumen = self.resumen()
+        print(f"💸 API Cost Explorer: {resumen['peticiones']} peticiones "
+              f"({resumen['consultas']} consultas + páginas) ≈ ${resumen['coste_estimado_usd']:.2f} USD"
+              + ("" if self.facturado else " (respuestas grabadas, sin coste)"))
+        for operacion, datos in resumen['por_operacion'].items():
+            print(f"   - {operacion}: {datos['peticiones']} peticiones, {datos['consultas']} consultas")
+        if ruta_json:
+            with open(ruta_json, 'w', encoding='utf-8') as f:
+                json.dump(resumen, f, indent=2)
+        return resumen
+
+
+def clave_peticion(operacion, params):
+    """Identificador estable de una petición: hash de la operación y sus parámetros"""
+    canonico = json.dumps([operacion, params], sort_keys=True, separators=(',', ':'), default=str)
+    return f"{operacion}-{hashlib.sha256(canonico.encode('utf-8')).hexdigest()[:20]}"
+
+
+class RespuestaNoGrabada(SystemExit):
+    """La petición no está en la grabación (--replay con otros parámetros).
+
+    Igual que PresupuestoPeticionesAgotado, hereda de SystemExit para que no
+    se convierta en un aviso y un informe incompleto.
+    """
+
+
+class ClienteCEGrabador:
+    """Pasa las peticiones al cliente real y guarda cada respuesta en `directorio`
+
+    Una respuesta por fichero (<operacion>-<hash>.json.gz); las páginas
+    siguientes llevan NextPageToken en los parámetros y tienen su propio hash.
+    manifiesto.json describe la ejecución grabada.
+    """
+
+    def __init__(self, cliente, directorio, descripcion=None):
+        self._cliente = cliente
+        self.directorio = directorio
+        self._lock = threading.Lock()
+        self._manifiesto = {
+            'version': 1,
+            'grabado': datetime.now().isoformat(timespec='seconds'),
+            'descripcion': descripcion or {},
+            'respuestas': 0,
+        }
+        os.makedirs(directorio, exist_ok=True)
+        self._guardar_manifiesto()
+
+    def __getattr__(self, nombre):
+        atributo = getattr(self._cliente, nombre)
+        if nombre not in OPERACIONES_FACTURADAS:
+            return atributo
+
+        def llamada(**params):
+            respuesta = atributo(**params)
+            self._grabar(nombre, params, respuesta)
+            return respuesta
+        return llamada
+
+    def _grabar(self, operacion, params, respuesta):
+        clave = clave_peticion(operacion, params)
+        contenido = {k: v for k, v in respuesta.items() if k != 'ResponseMetadata'}
+        ruta = os.path.join(self.directorio, f'{clave}.json.gz')
+        temporal = f'{ruta}.{threading.get_ident()}.tmp'
+        with gzip.open(temporal, 'wt', encoding='utf-8') as f:
+            json.dump({'operacion': operacion, 'params': params, 'respuesta': contenido},
+                      f, ensure_ascii=False, default=str)
+        os.replace(temporal, ruta)
+        with self._lock:
+            self._manifiesto['respuestas'] += 1
+            self._guardar_manifiesto()
+
+    def _guardar_manifiesto(self):
+        with open(os.path.join(self.directorio, 'manifiesto.json'), 'w', encoding='utf-8') as f:
+            json.dump(self._manifiesto, f, indent=2, ensure_ascii=False)
+
+
+class ClienteCEReproductor:
+    """Sustituye al cliente boto3: responde con lo grabado por ClienteCEGrabador"""
+
+    def __init__(self, directorio):
+        ruta = os.path.join(directorio, 'manifiesto.json')
+        if not os.path.exists(ruta):
+            raise FileNotFoundError(f"{directorio} no contiene una grabación (falta manifiesto.json)")
+        with open(ruta, encoding='utf-8') as f:
+            self.manifiesto = json.load(f)
+        self.directorio = directorio
+
+    def __getattr__(self, nombre):
+        if nombre not in OPERACIONES_FACTURADAS:
+            raise AttributeError(nombre)
+
+        def llamada(**params):
+            return self._leer(nombre, params)
+        return llamada
+
+    def _leer(self, operacion, params):
+        clave = clave_peticion(operacion, params)
+        ruta = os.path.join(self.directorio, f'{clave}.json.gz')
+        if not os.path.exists(ruta):
+            print(f"\n❌ La grabación {self.directorio} no contiene esta petición a {operacion}")
+            print(f"   Parámetros: {json.dumps(params, sort_keys=True, default=str)[:300]}")
+            print("   ¿Mismo periodo y opciones que al grabar?")
+            raise RespuestaNoGrabada(1)
+        with gzip.open(ruta, 'rt', encoding='utf-8') as f:
+            return json.load(f)['respuesta']
+
+
+def paginar(cliente_ce, operacion, **params):
+    """Genera todas las páginas de una operación de Cost Explorer (NextPageToken)"""
+    metodo = getattr(cliente_ce, operacion)
+    while True:
+        respuesta = metodo(**params)
+        yield respuesta
+        token = respuesta.get('NextPageToken')
+        if not token:
+            return
+        params = dict(params, NextPageToken=token)
+
+
+def periodos_ce(cliente_ce, **params):
+    """ResultsByTime de todas las páginas de get_cost_and_usage, en orden
+
+    Un mismo periodo puede repartirse entre varias páginas; los consumidores
+    acumulan con += así que no hace falta fusionarlos.
+    """
+    for respuesta in paginar(cliente_ce, 'get_cost_and_usage', **params):
+        yield from respuesta['ResultsByTime']
+
+
+def valores_etiqueta(cliente_ce, clave, fecha_inicio, fecha_fin):
+    """Valores de la etiqueta `clave` con coste en el periodo (todas las páginas de get_tags)"""
+    valores = []
+    for respuesta in paginar(cliente_ce, 'get_tags', TimePeriod={'Start': fecha_inicio, 'End': fecha_fin},
+                             TagKey=clave):
+        valores.extend(v for v in respuesta.get('Tags', []) if v)
+    return sorted(set(valores))
+
+
+def ttl_peticion(params, ttl_horas=CACHE_TTL_HORAS, hoy=None):
+    """Segundos de validez de una respuesta en caché, o None si no caduca
+
+    Regla común: un periodo que terminó hace más de CACHE_DIAS_ASENTADO días
+    ya no cambia (no caduca); cualquier periodo abierto o reciente (y las
+    previsiones, que siempre miran al futuro) caduca a las `ttl_horas`.
+    """
+    fin = params.get('TimePeriod', {}).get('End')
+    hoy = hoy or date.today()
+    if fin and date.fromisoformat(fin) <= hoy - timedelta(days=CACHE_DIAS_ASENTADO):
+        return None
+    return ttl_horas * 3600
+
+
+class ClienteCECache:
+    """Envuelve un cliente (normalmente ClienteCEMedido) y cachea en disco las operaciones dadas
+
+    Un fichero por petición (<operacion>-<hash>.json.gz, como la grabación);
+    al estar delante del cliente medido, los aciertos no cuentan como
+    peticiones facturadas. Seguro entre hilos (escrituras atómicas por fichero).
+    """
+
+    def __init__(self, cliente, directorio, operaciones, ttl_horas=CACHE_TTL_HORAS):
+        self._cliente = cliente
+        self.directorio = directorio
+        self.operaciones = set(operaciones)
+        self.ttl_horas = ttl_horas
+        self.aciertos = 0
+        self.fallos = 0
+        self._lock = threading.Lock()
+        os.makedirs(directorio, exist_ok=True)
+
+    def __getattr__(self, nombre):
+        atributo = getattr(self._cliente, nombre)
+        if nombre not in self.operaciones:
+            return atributo
+
+        def llamada(**params):
+            ruta = os.path.join(self.directorio, f'{clave_peticion(nombre, params)}.json.gz')
+            respuesta = self._leer(ruta, params)
+            with self._lock:
+                if respuesta is None:
+                    self.fallos += 1
+                else:
+                    self.aciertos += 1
+            if respuesta is None:
+                respuesta = atributo(**params)
+                self._guardar(ruta, respuesta)
+            return respuesta
+        return llamada
+
+    def _leer(self, ruta, params):
+        if not os.path.exists(ruta):
+            return None
+        ttl = ttl_peticion(params, self.ttl_horas)
+        if ttl is not None and time.time() - os.path.getmtime(ruta) > ttl:
+            return None
+        with gzip.open(ruta, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _guardar(self, ruta, respuesta):
+        contenido = {k: v for k, v in respuesta.items() if k != 'ResponseMetadata'}
+        temporal = f'{ruta}.{threading.get_ident()}.tmp'
+        with gzip.open(temporal, 'wt', encoding='utf-8') as f:
+            json.dump(contenido, f, ensure_ascii=False, default=str)
+        os.replace(temporal, ruta)
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Cubo de costes en disco (histórico de varios años)
+==================================================
+Guarda los costes DIARIOS por Name × servicio y Name × usage type de EC2 en
+columnas binarias que se abren con np.memmap: los informes leen solo las
+filas del periodo pedido, sin cargar el histórico en diccionarios.
+
+Estructura del directorio:
+  meta.json                   versión, métricas, filas por tabla y rango de
+                              filas de cada mes ingerido
+  dic_name.json, dic_servicio.json, dic_usage_type.json
+                              diccionarios id -> valor (solo se añaden)
+  base.<columna>.bin          tabla SERVICE × Name
+  ec2.<columna>.bin           tabla USAGE_TYPE × Name (servicios EC2)
+
+Columnas: dia (int32, días desde 1970-01-01), name y clave (int32, ids de
+los diccionarios) y un int64 por métrica en micro-céntimos (ver dinero.py).
+
+La ingesta es mensual y solo añade (append-only): cada mes cerrado se
+ingiere una vez y ocupa un rango contiguo de filas, así que leer un periodo
+es tomar unos pocos rangos del memmap. AWS Backup se deriva de la tabla base.
+
+Uso:
+  python cubo_costes.py --cubo historico --mes 9 --anio 2024
+  python cubo_costes.py --cubo historico --mes 9 --anio 2024 --cur /datos/cur
+  python cubo_costes.py --cubo historico --info
+  python aws_cost_report.py --cubo historico --mes 9 --anio 2024
+"""
+
+import argparse
+import json
+import os
+import sys
+from datetime import date, datetime
+
+import boto3
+import numpy as np
+
+from aws_cost_report import (
+    METRICA_PRINCIPAL, METRICAS_DISPONIBLES, NECESIDAD_BASE, NECESIDAD_EC2, NECESIDAD_BACKUP,
+    obtener_rango_fechas, preparar_metricas, costos_informe_desde_filas,
+)
+from consultas_ce import ClienteCEMedido
+from dinero import a_dolares
+from planificador_consultas import Consulta, demultiplexar, ejecutar_plan
+
+VERSION_CUBO = 1
+EPOCA = date(1970, 1, 1)
+
+# tabla -> dimensión de su segunda clave
+TABLAS = {'base': 'servicio', 'ec2': 'usage_type'}
+DIMENSIONES = ('name', 'servicio', 'usage_type')
+TIPOS = {'dia': np.int32, 'name': np.int32, 'clave': np.int32}
+
+
+def _dia(texto):
+    return (date.fromisoformat(texto) - EPOCA).days
+
+
+def _escribir_json(ruta, contenido):
+    """Escritura atómica (fichero temporal + rename)"""
+    temporal = f'{ruta}.tmp'
+    with open(temporal, 'w', encoding='utf-8') as f:
+        json.dump(contenido, f, ensure_ascii=False)
+    os.replace(temporal, ruta)
+
+
+class CuboCostes:
+    """Cubo de costes diario sobre columnas memmap (ver docstring del módulo)"""
+
+    def __init__(self, directorio, metricas=None):
+        """Abre el cubo; si no existe se crea con `metricas` (default: la principal)"""
+        self.directorio = directorio
+        ruta_meta = self._ruta('meta.json')
+        if os.path.exists(ruta_meta):
+            with open(ruta_meta, encoding='utf-8') as f:
+                self.meta = json.load(f)
+            if self.meta.get('version') != VERSION_CUBO:
+                raise ValueError(f"{directorio}: versión de cubo no soportada ({self.meta.get('version')})")
+        else:
+            self.meta = {'version': VERSION_CUBO, 'metricas': list(metricas or [METRICA_PRINCIPAL]),
+                         'filas': {tabla: 0 for tabla in TABLAS}, 'meses': {}}
+        self.diccionarios = {}
+        for dimension in DIMENSIONES:
+            ruta = self._ruta(f'dic_{dimension}.json')
+            valores = []
+            if os.path.exists(ruta):
+                with open(ruta, encoding='utf-8') as f:
+                    valores = json.load(f)
+            self.diccionarios[dimension] = valores
+        self._ids = {d: {v: i for i, v in enumerate(vs)} for d, vs in self.diccionarios.items()}
+
+    @property
+    def metricas(self):
+        return self.meta['metricas']
+
+    def _ruta(self, nombre):
+        return os.path.join(self.directorio, nombre)
+
+    def _columnas(self):
+        return list(TIPOS.items()) + [(m, np.int64) for m in self.metricas]
+
+    def columna(self, tabla, nombre):
+        """Columna completa como memmap de solo lectura (no carga nada en memoria)"""
+        tipo = TIPOS.get(nombre, np.int64)
+        filas = self.meta['filas'][tabla]
+        if filas == 0:
+            return np.zeros(0, dtype=tipo)
+        return np.memmap(self._ruta(f'{tabla}.{nombre}.bin'), dtype=tipo, mode='r', shape=(filas,))
+
+    def _id(self, dimension, valor):
+        ids = self._ids[dimension]
+        if valor not in ids:
+            ids[valor] = len(self.diccionarios[dimension])
+            self.diccionarios[dimension].append(valor)
+        return ids[valor]
+
+    # ------------------------------------------------------------------
+    # Ingesta
+    # ------------------------------------------------------------------
+    def ingerir_mes(self, fecha_inicio, fecha_fin, filas):
+        """Añade un mes completo: filas = {'base': [...], 'ec2': [...]} DIARIAS del planificador
+
+        Falla si el mes ya está en el cubo (append-only). Orden de escritura:
+        columnas, diccionarios y por último meta.json, que es quien da por
+        válidas las filas; si algo falla antes, la siguiente ingesta descarta
+        los bytes sobrantes.
+        """
+        mes = fecha_inicio[:7]
+        if mes in self.meta['meses']:
+            raise ValueError(f"El mes {mes} ya está en el cubo (la ingesta solo añade)")
+        os.makedirs(self.directorio, exist_ok=True)
+
+        rangos = {}
+        for tabla, dimension in TABLAS.items():
+            ordenadas = sorted(filas[tabla] or [], key=lambda fila: fila[0])
+            datos = {
+                'dia': [_dia(periodo) for periodo, _, _ in ordenadas],
+                'name': [self._id('name', etiqueta) for _, (_, etiqueta), _ in ordenadas],
+                'clave': [self._id(dimension, clave) for _, (clave, _), _ in ordenadas],
+            }
+            for metrica in self.metricas:
+                datos[metrica] = [valores[metrica] for _, _, valores in ordenadas]
+
+            inicio = self.meta['filas'][tabla]
+            for nombre, tipo in self._columnas():
+                ruta = self._ruta(f'{tabla}.{nombre}.bin')
+                with open(ruta, 'ab') as f:
+                    f.truncate(inicio * np.dtype(tipo).itemsize)  # restos de una ingesta fallida
+                    f.write(np.asarray(datos[nombre], dtype=tipo).tobytes())
+            rangos[tabla] = [inicio, inicio + len(ordenadas)]
+
+        for dimension, valores in self.diccionarios.items():
+            _escribir_json(self._ruta(f'dic_{dimension}.json'), valores)
+        for tabla, (_, fin) in rangos.items():
+            self.meta['filas'][tabla] = fin
+        self.meta['meses'][mes] = {'periodo': [fecha_inicio, fecha_fin], **rangos}
+        _escribir_json(self._ruta('meta.json'), self.meta)
+        return {tabla: fin - inicio for tabla, (inicio, fin) in rangos.items()}
+
+    # ------------------------------------------------------------------
+    # Lectura
+    # ------------------------------------------------------------------
+    def meses_del_periodo(self, fecha_inicio, fecha_fin):
+        return sorted(mes for mes, info in self.meta['meses'].items()
+                      if info['periodo'][0] < fecha_fin and info['periodo'][1] > fecha_inicio)
+
+    def _agregar(self, tabla, fecha_inicio, fecha_fin, metricas):
+        """Suma por (name, clave) las filas del periodo; solo toca los rangos de sus meses"""
+        desde, hasta = _dia(fecha_inicio), _dia(fecha_fin)
+        trozos = {c: [] for c in ['name', 'clave'] + list(metricas)}
+        dias = self.columna(tabla, 'dia')
+        columnas = {c: self.columna(tabla, c) for c in trozos}
+        for mes in self.meses_del_periodo(fecha_inicio, fecha_fin):
+            inicio, fin = self.meta['meses'][mes][tabla]
+            # Filas ordenadas por día dentro del mes: búsqueda binaria del subrango
+            a = inicio + int(np.searchsorted(dias[inicio:fin], desde, 'left'))
+            b = inicio + int(np.searchsorted(dias[inicio:fin], hasta, 'left'))
+            for c, columna in columnas.items():
+                trozos[c].append(np.asarray(columna[a:b]))
+
+        if not trozos['name'] or not sum(len(t) for t in trozos['name']):
+            return []
+        names = np.concatenate(trozos['name']).astype(np.int64)
+        claves = np.concatenate(trozos['clave']).astype(np.int64)
+        combinada = names * max(len(self.diccionarios[TABLAS[tabla]]), 1) + claves
+        orden = np.argsort(combinada, kind='stable')
+        combinada = combinada[orden]
+        inicios = np.flatnonzero(np.r_[True, combinada[1:] != combinada[:-1]])
+        sumas = {m: np.add.reduceat(np.concatenate(trozos[m])[orden], inicios) for m in metricas}
+
+        dic_name = self.diccionarios['name']
+        dic_clave = self.diccionarios[TABLAS[tabla]]
+        filas = []
+        for i, posicion in enumerate(inicios):
+            fila = orden[posicion]
+            filas.append((fecha_inicio, (dic_clave[claves[fila]], dic_name[names[fila]]),
+                          {m: int(sumas[m][i]) for m in metricas}))
+        return filas
+
+    def matriz_diaria(self, fecha_inicio, fecha_fin, metrica):
+        """(names, dias, matriz) del periodo: coste diario por Name (tabla base), int64 [name, día]
+
+        `dias` son fechas ISO de fecha_inicio a fecha_fin (excluida); los días
+        sin filas quedan a 0. Se construye con NumPy sin pasar por filas.
+        """
+        desde, hasta = _dia(fecha_inicio), _dia(fecha_fin)
+        trozos = {'dia': [], 'name': [], metrica: []}
+        dias = self.columna('base', 'dia')
+        for mes in self.meses_del_periodo(fecha_inicio, fecha_fin):
+            inicio, fin = self.meta['meses'][mes]['base']
+            a = inicio + int(np.searchsorted(dias[inicio:fin], desde, 'left'))
+            b = inicio + int(np.searchsorted(dias[inicio:fin], hasta, 'left'))
+            for c in trozos:
+                trozos[c].append(np.asarray(self.columna('base', c)[a:b]))
+
+        fechas = [date.fromordinal(EPOCA.toordinal() + d).isoformat() for d in range(desde, hasta)]
+        if not trozos['name']:
+            return [], fechas, np.zeros((0, len(fechas)), dtype=np.int64)
+        ids, fila = np.unique(np.concatenate(trozos['name']), return_inverse=True)
+        matriz = np.zeros((len(ids), len(fechas)), dtype=np.int64)
+        np.add.at(matriz, (fila, np.concatenate(trozos['dia']) - desde), np.concatenate(trozos[metrica]))
+        dic_name = self.diccionarios['name']
+        return [dic_name[i] for i in ids], fechas, matriz
+
+    def primer_dia(self):
+        """Primer día con datos en el cubo (ISO) o None si está vacío"""
+        if not self.meta['meses']:
+            return None
+        return min(info['periodo'][0] for info in self.meta['meses'].values())
+
+    def filas_periodo(self, fecha_inicio, fecha_fin, metricas):
+        """Filas {'base', 'ec2', 'backup'} del periodo, como una consulta MONTHLY del planificador"""
+        faltan = [m for m in metricas if m not in self.metricas]
+        if faltan:
+            raise ValueError(f"el cubo no tiene las métricas: {', '.join(faltan)}")
+        base = self._agregar('base', fecha_inicio, fecha_fin, metricas)
+        return {
+            'base': base,
+            'ec2': self._agregar('ec2', fecha_inicio, fecha_fin, metricas),
+            'backup': demultiplexar(Consulta(NECESIDAD_BASE.agrupar, None), NECESIDAD_BACKUP, base, metricas),
+        }
+
+    def resumen(self):
+        lineas = [f"📦 Cubo {self.directorio}: métricas {', '.join(self.metricas)}",
+                  f"   {len(self.diccionarios['name'])} Names, {len(self.diccionarios['servicio'])} servicios, "
+                  f"{len(self.diccionarios['usage_type'])} usage types"]
+        for mes in sorted(self.meta['meses']):
+            info = self.meta['meses'][mes]
+            lineas.append(f"   - {mes}: {info['base'][1] - info['base'][0]} filas base, "
+                          f"{info['ec2'][1] - info['ec2'][0]} filas EC2")
+        return '\n'.join(lineas)
+
+
+def obtener_costos_cubo(directorio, fecha_inicio, fecha_fin, metricas=None):
+    """Como obtener_costos_informe, pero leyendo el periodo del cubo en disco"""
+    if not os.path.exists(os.path.join(directorio, 'meta.json')):
+        print(f"❌ {directorio} no contiene un cubo de costes")
+        sys.exit(1)
+    cubo = CuboCostes(directorio)
+    meses = cubo.meses_del_periodo(fecha_inicio, fecha_fin)
+    if not meses:
+        print(f"❌ El cubo no tiene datos de {fecha_inicio} a {fecha_fin} (meses: {', '.join(sorted(cubo.meta['meses']))})")
+        sys.exit(1)
+    print(f"📦 Leyendo {fecha_inicio} a {fecha_fin} del cubo {directorio} ({', '.join(meses)})")
+    try:
+        filas = cubo.filas_periodo(fecha_inicio, fecha_fin, metricas or [METRICA_PRINCIPAL])
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    return costos_informe_desde_filas(filas, metricas, por_dia=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cubo de costes diario en disco (ingesta mensual)')
+    parser.add_argument('--cubo', type=str, required=True, help='Directorio del cubo')
+    parser.add_argument('--mes', type=int, help='Mes (1-12) a ingerir')
+    parser.add_argument('--anio', type=int, help='Año')
+    parser.add_argument('--info', action='store_true', help='Muestra el contenido del cubo y termina')
+    parser.add_argument('--cur', type=str, metavar='DIR',
+                        help='Ingerir desde los Parquet del CUR en lugar de Cost Explorer')
+    parser.add_argument('--metrics', nargs='+', choices=METRICAS_DISPONIBLES, metavar='METRICA',
+                        help='Métricas a guardar al crear el cubo (la principal siempre)')
+    parser.add_argument('--profile', type=str, help='Perfil AWS')
+    parser.add_argument('--region', type=str, default='eu-west-1', help='Región AWS')
+    parser.add_argument('--max-requests', type=int,
+                        help='Máximo de peticiones (facturadas) a Cost Explorer; se aborta antes de superarlo')
+    args = parser.parse_args()
+
+    try:
+        cubo = CuboCostes(args.cubo, preparar_metricas(args.metrics))
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    if args.info:
+        print(cubo.resumen())
+        return
+    if not (args.mes and args.anio):
+        print("❌ Indica el mes a ingerir con --mes y --anio")
+        sys.exit(1)
+
+    fecha_inicio, fecha_fin = obtener_rango_fechas(args.mes, args.anio)
+    if fecha_fin > datetime.now().strftime('%Y-%m-%d'):
+        print(f"❌ {fecha_inicio[:7]} no ha terminado: el cubo solo ingiere meses cerrados")
+        sys.exit(1)
+    if fecha_inicio[:7] in cubo.meta['meses']:
+        print(f"❌ {fecha_inicio[:7]} ya está en el cubo (la ingesta solo añade)")
+        sys.exit(1)
+
+    print(f"📥 Ingiriendo {fecha_inicio} a {fecha_fin} en {args.cubo} ({', '.join(cubo.metricas)})")
+    ce = None
+    if args.cur:
+        from fuente_cur import filas_cur
+        filas = filas_cur(args.cur, fecha_inicio, fecha_fin, cubo.metricas, por_dia=True)
+    else:
+        session_params = {'region_name': args.region}
+        if args.profile:
+            session_params['profile_name'] = args.profile
+        ce = ClienteCEMedido(boto3.Session(**session_params).client('ce'), args.max_requests)
+        filas = ejecutar_plan(ce, [NECESIDAD_BASE, NECESIDAD_EC2], fecha_inicio, fecha_fin,
+                              cubo.metricas, 'DAILY')
+        if filas['base'] is None or filas['ec2'] is None:
+            print("❌ Error consultando Cost Explorer; no se ha modificado el cubo")
+            sys.exit(1)
+
+    nuevas = cubo.ingerir_mes(fecha_inicio, fecha_fin, filas)
+    total = sum(valores[METRICA_PRINCIPAL] for _, _, valores in filas['base'])
+    print(f"✅ {nuevas['base']} filas base y {nuevas['ec2']} filas EC2 añadidas "
+          f"(total {fecha_inicio[:7]}: ${a_dolares(total):,.2f})")
+    if ce:
+        ce.imprimir_resumen()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Dimensiones de agrupación adicionales (--dimensiones)
+=====================================================
+Cost Explorer solo agrupa por dos claves a la vez. Para ver los costes por
+ServerGroup, región, cuenta, usage type o cualquier etiqueta, cada dimensión
+se pide junto a Name (consultas D × Name, lanzadas en paralelo por el
+planificador, que reutiliza SERVICE × Name si ya está en el plan) y Name
+hace de clave de unión:
+
+  modelo = {dimensión: {name: {valor: importe}}}
+
+Una combinación de una dimensión (p. ej. ServerGroup) se lee directamente
+de su consulta. Una combinación de varias (p. ej. ServerGroup,REGION) se
+cruza por Name: el coste de cada Name se reparte entre las parejas de
+valores en proporción al producto de sus pesos en cada dimensión (resto
+mayor, al micro-céntimo). Es exacto cuando la dimensión depende del Name
+(ServerGroup suele ser una etiqueta del mismo recurso) y una estimación
+cuando un Name se reparte entre varios valores de varias dimensiones.
+
+El coste de cada Name se normaliza a su total en el informe (resto mayor),
+igual que el desglose EC2, para que cada hoja 'Por ...' sume exactamente el
+total general.
+"""
+
+from collections import defaultdict
+from itertools import product
+
+from dinero import a_dolares, repartir
+from planificador_consultas import Necesidad
+
+ANCLA = 'TAG:Name'
+DIMENSIONES_CE = ('SERVICE', 'LINKED_ACCOUNT', 'REGION', 'USAGE_TYPE')
+ALIAS = {'name': ANCLA, 'servergroup': 'TAG:ServerGroup'}
+
+
+def clave_dimension(texto):
+    """'ServerGroup' / 'tag:Entorno' / 'region' -> clave del planificador ('TAG:...' o dimensión)"""
+    texto = texto.strip()
+    if texto.lower() in ALIAS:
+        return ALIAS[texto.lower()]
+    if texto.lower().startswith('tag:') and len(texto) > 4:
+        return 'TAG:' + texto[4:]
+    if texto.upper() in DIMENSIONES_CE:
+        return texto.upper()
+    raise ValueError(f"dimensión desconocida '{texto}' (usa Name, ServerGroup, tag:<clave>, "
+                     f"{', '.join(DIMENSIONES_CE)})")
+
+
+def parsear_combinaciones(argumentos):
+    """['ServerGroup', 'ServerGroup,REGION'] -> [('TAG:ServerGroup',), ('TAG:ServerGroup', 'REGION')]
+
+    Name no forma parte de la combinación: es siempre el nivel de detalle de la hoja.
+    """
+    combinaciones = []
+    for argumento in argumentos or []:
+        claves = (clave_dimension(p) for p in argumento.split(',') if p.strip())
+        combinacion = tuple(dict.fromkeys(c for c in claves if c != ANCLA))
+        if combinacion and combinacion not in combinaciones:
+            combinaciones.append(combinacion)
+    return combinaciones
+
+
+def claves_a_consultar(combinaciones):
+    return list(dict.fromkeys(c for combinacion in combinaciones for c in combinacion))
+
+
+def necesidad(clave):
+    return Necesidad(f'dim:{clave}', (clave, ANCLA), None)
+
+
+def necesidades(combinaciones):
+    """Una necesidad D × Name por dimensión (el planificador las une a las del informe)"""
+    return [necesidad(clave) for clave in claves_a_consultar(combinaciones)]
+
+
+def nombre(clave):
+    """Nombre legible de la dimensión: 'TAG:ServerGroup' -> 'ServerGroup'"""
+    return clave[4:] if clave.startswith('TAG:') else clave
+
+
+def etiqueta_valor(clave, valor):
+    """Valor de grupo tal como llega de Cost Explorer -> texto para el informe"""
+    if clave.startswith('TAG:'):
+        prefijo = clave[4:] + '$'
+        valor = valor[len(prefijo):] if valor.startswith(prefijo) else valor
+        if not valor:
+            return 'Sin etiqueta' if clave == ANCLA else f'Sin {clave[4:]}'
+        return valor
+    return valor or f'Sin {clave}'
+
+
+def modelo_desde_filas(filas, metrica):
+    """{nombre_necesidad: filas} -> {clave: {name: {valor: importe}}} (solo dimensiones)"""
+    modelo = {}
+    for nombre_necesidad, filas_dim in filas.items():
+        if not nombre_necesidad.startswith('dim:') or filas_dim is None:
+            continue
+        clave = nombre_necesidad[4:]
+        por_name = defaultdict(lambda: defaultdict(int))
+        for _, (valor, etiqueta), valores in filas_dim:
+            por_name[etiqueta_valor(ANCLA, etiqueta)][etiqueta_valor(clave, valor)] += valores[metrica]
+        modelo[clave] = por_name
+    return modelo
+
+
+def cruzar(modelo, combinacion, totales_name=None):
+    """{(valor_1, ..., valor_k): {name: importe}} para una combinación de dimensiones
+
+    Con una sola dimensión es la consulta D × Name tal cual. Con varias, el
+    coste del Name (según la primera dimensión) se reparte entre las
+    combinaciones de valores con peso = producto de sus importes positivos.
+
+    Con totales_name ({name: total en el informe}) cada Name se normaliza a ese
+    total, como el desglose EC2: la consulta D × Name redondea por grupo y su
+    suma puede diferir en céntimos; así la hoja cuadra EXACTAMENTE con el informe.
+    """
+    resultado = defaultdict(lambda: defaultdict(int))
+    primera = modelo[combinacion[0]]
+    sin_valor = tuple(etiqueta_valor(clave, '') for clave in combinacion)
+    for name in (primera if totales_name is None else totales_name):
+        valores_primera = primera.get(name, {})
+        total = sum(valores_primera.values()) if totales_name is None else totales_name[name]
+        if len(combinacion) == 1:
+            pesos = {(valor,): importe for valor, importe in valores_primera.items()}
+        else:
+            ejes = [{v: c for v, c in modelo[clave].get(name, {}).items() if c > 0}
+                    or {etiqueta_valor(clave, ''): 1}
+                    for clave in combinacion]
+            pesos = {}
+            for valores in product(*(eje.items() for eje in ejes)):
+                peso = 1
+                for _, importe in valores:
+                    peso *= importe
+                pesos[tuple(v for v, _ in valores)] = peso
+        if sum(pesos.values()) != 0:
+            partes = repartir(total, pesos)
+        elif pesos and total == 0:
+            partes = pesos
+        else:
+            partes = {sin_valor: total}
+        for valores, importe in partes.items():
+            resultado[valores][name] += importe
+    return resultado
+
+
+def titulo(combinacion):
+    return ' × '.join(nombre(c) for c in combinacion)
+
+
+def nombre_hoja(combinacion, usados):
+    """'Por ServerGroup × REGION', válido para Excel (31 caracteres) y sin repetir"""
+    base = f'Por {titulo(combinacion)}'
+    for ch in '[]:*?/\\':
+        base = base.replace(ch, ' ')
+    base = base[:31].strip()
+    candidato, i = base, 2
+    while candidato in usados:
+        sufijo = f' ({i})'
+        candidato = base[:31 - len(sufijo)] + sufijo
+        i += 1
+    usados.add(candidato)
+    return candidato
+
+
+def cruces(modelo, combinaciones, totales_name=None):
+    """[(combinacion, cruce)] en el orden pedido, listo para las hojas del informe
+
+    Se omiten (con aviso) las combinaciones cuya consulta falló.
+    """
+    resultado = []
+    for combinacion in combinaciones:
+        faltan = [nombre(c) for c in combinacion if c not in modelo]
+        if faltan:
+            print(f"   ⚠️  Sin hoja 'Por {titulo(combinacion)}': no se obtuvo {', '.join(faltan)}")
+            continue
+        resultado.append((combinacion, cruzar(modelo, combinacion, totales_name)))
+    return resultado
+
+
+def verificar(lista_cruces, total_esperado):
+    """Imprime el total de cada combinación frente al total base (deben coincidir)"""
+    for combinacion, cruce in lista_cruces:
+        total = sum(sum(names.values()) for names in cruce.values())
+        estado = '✅' if total == total_esperado else f'⚠️  diferencia ${a_dolares(total - total_esperado):,.2f}'
+        print(f"   Por {titulo(combinacion)}: {len(cruce)} grupos, ${a_dolares(total):,.2f} {estado}")
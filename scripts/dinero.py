@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Importes en enteros (micro-céntimos)
+====================================
+Cost Explorer devuelve los importes como texto decimal ('12.3456789012').
+Convertirlos a float y sumarlos miles de veces acumula error de redondeo, y
+la verificación final tenía que aceptar diferencias de hasta 1 US$.
+
+Aquí los importes se guardan como ENTEROS en micro-céntimos
+(1 US$ = 100 ¢ = 10^8 µ¢): la lectura es exacta hasta 8 decimales, las
+sumas son exactas, la normalización reparte con el método del resto mayor
+(la suma de las partes es exactamente el total) y la conciliación se comprueba
+con igualdad. Solo se pasa a dólares al escribir el Excel o mostrar un total.
+
+La misma escala fija se usa para UsageQuantity (--metrics), que no es dinero;
+como mezcla unidades, no se normaliza ni entra en totales (METRICAS_NO_ADITIVAS).
+"""
+
+from decimal import Decimal, ROUND_HALF_EVEN
+
+DECIMALES = 8
+ESCALA = 10 ** DECIMALES  # micro-céntimos por dólar
+
+
+def importe(texto):
+    """'123.4567' -> 12345670000 µ¢ (exacto; más de 8 decimales se redondean al par)"""
+    texto = texto.strip()
+    entero, punto, fraccion = texto.partition('.')
+    if 'e' in texto or 'E' in texto or len(fraccion) > DECIMALES or not (entero.lstrip('+-') or fraccion):
+        # Notación científica o demasiados decimales: vía Decimal (más lenta, poco frecuente)
+        return int(Decimal(texto).scaleb(DECIMALES).to_integral_value(ROUND_HALF_EVEN))
+    negativo = entero.startswith('-')
+    valor = int(entero.lstrip('+-') or 0) * ESCALA + int(fraccion.ljust(DECIMALES, '0') or 0)
+    return -valor if negativo else valor
+
+
+def desde_dolares(valor):
+    """Cantidad en dólares (argumento de línea de comandos, float) -> µ¢"""
+    return importe(repr(float(valor)))
+
+
+def a_dolares(micro, decimales=2):
+    """µ¢ -> dólares redondeados (al par) a `decimales`, para celdas e impresión"""
+    return round(micro, decimales - DECIMALES) / ESCALA
+
+
+def porcentaje(micro, pct):
+    """`pct` % de un importe, redondeado al µ¢ (descuento de partner)"""
+    return int((Decimal(micro) * Decimal(repr(float(pct))) / 100).to_integral_value(ROUND_HALF_EVEN))
+
+
+def repartir(total, pesos):
+    """Reparte `total` entre las claves de `pesos` en proporción a su peso
+
+    Método del resto mayor: cada clave recibe la parte entera de su cuota y las
+    unidades que faltan van a los mayores restos (a igualdad, por orden de
+    inserción). La suma del resultado es EXACTAMENTE `total`.
+    """
+    suma = sum(pesos.values())
+    if suma == 0:
+        raise ValueError("repartir: la suma de los pesos es 0")
+    if suma < 0:
+        return {clave: -parte for clave, parte in repartir(-total, {k: -p for k, p in pesos.items()}).items()}
+
+    partes = {}
+    restos = []
+    for clave, peso in pesos.items():
+        parte, resto = divmod(total * peso, suma)
+        partes[clave] = parte
+        restos.append((resto, clave))
+
+    pendiente = total - sum(partes.values())  # 0 <= pendiente < len(pesos)
+    restos.sort(key=lambda x: x[0], reverse=True)
+    for _, clave in restos[:pendiente]:
+        partes[clave] += 1
+    return partes
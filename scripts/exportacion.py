@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Exportación en flujo a CSV / JSON Lines (--format csv|jsonl)
+============================================================
+Para alimentar otros sistemas sin tener que leer el .xlsx: una fila
+normalizada por Name, servicio y categoría EC2 con el valor de cada métrica
+consultada, con las mismas columnas en los dos informes:
+
+  periodo_inicio, periodo_fin, name, servicio, categoria, UnblendedCost[, AmortizedCost...]
+
+- servicio: el nombre de AWS; el desglose EC2 va como servicio 'EC2' con su
+  categoría ('EC2 - Instancia (t3.large)', ...); el resto, categoría vacía.
+- Los importes en dólares con toda la precisión del modelo (8 decimales),
+  sin redondear a céntimos: las sumas cuadran con Cost Explorer.
+
+Las filas se generan recorriendo directamente el modelo agregado y se
+escriben según salen (sin libro ni lista intermedia), así que la memoria no
+crece con el tamaño de la salida. Con --output - van a stdout y los mensajes
+de progreso pasan a stderr, para poder encadenar con otras herramientas;
+con --gzip (o un --output terminado en .gz) se comprimen al vuelo. Si quien
+lee cierra la tubería antes de tiempo (| head) la exportación termina sin traza.
+"""
+
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+from contextlib import contextmanager
+
+from dinero import ESCALA
+
+FORMATOS = ('csv', 'jsonl')
+SALIDA_ESTANDAR = '-'
+CAMPOS = ['periodo_inicio', 'periodo_fin', 'name', 'servicio', 'categoria']
+SERVICIO_EC2 = 'EC2'
+
+
+def _valor(micro):
+    """µ¢ -> dólares (o unidades de UsageQuantity) con los 8 decimales del modelo"""
+    return micro / ESCALA
+
+
+def _servicio_y_categoria(servicio):
+    """'EC2 - ...' (categorías del desglose EC2) -> ('EC2', categoría); el resto -> (servicio, '')"""
+    if servicio.startswith('EC2 - '):
+        return SERVICIO_EC2, servicio
+    return servicio, ''
+
+
+def filas_detalle(datos, metricas_extra=None):
+    """Filas de aws_cost_report: datos (procesar_datos) {name: {'servicios': {servicio: µ¢}}}
+
+    metricas_extra: {metrica: datos de esa métrica} (mismo formato), en el orden de las columnas.
+    Rinde (name, servicio, categoria, µ¢ por métrica).
+    """
+    metricas_extra = metricas_extra or {}
+    for name, info in datos.items():
+        for servicio, costo in info['servicios'].items():
+            extras = [datos_m[name]['servicios'].get(servicio, 0) if name in datos_m else 0
+                      for datos_m in metricas_extra.values()]
+            yield (name, *_servicio_y_categoria(servicio), [costo, *extras])
+
+
+def filas_por_servicio(ec2_data, servicios_data, metricas_extra=None):
+    """Filas de aws_cost_report_por_servicio: desglose EC2 {name: {categoria: µ¢}} y
+    servicios {servicio: {name: µ¢}}
+
+    metricas_extra: {metrica: {'ec2': ..., 'servicios': ...}} (mismo formato), en el orden de las columnas.
+    """
+    metricas_extra = metricas_extra or {}
+    for name, categorias in ec2_data.items():
+        for categoria, costo in categorias.items():
+            extras = [d['ec2'].get(name, {}).get(categoria, 0) for d in metricas_extra.values()]
+            yield (name, SERVICIO_EC2, categoria, [costo, *extras])
+    for servicio, names in servicios_data.items():
+        for name, costo in names.items():
+            extras = [d['servicios'].get(servicio, {}).get(name, 0) for d in metricas_extra.values()]
+            yield (name, servicio, '', [costo, *extras])
+
+
+def ruta_salida(output, formato, comprimir):
+    """(ruta, comprimir) de la exportación
+
+    El --output por defecto (.xlsx) se cambia a la extensión del formato
+    (+ .gz con --gzip); un --output terminado en .gz implica --gzip.
+    """
+    if output == SALIDA_ESTANDAR:
+        return output, comprimir
+    base, extension = os.path.splitext(output)
+    if extension.lower() == '.xlsx':
+        return f"{base}.{formato}{'.gz' if comprimir else ''}", comprimir
+    return output, comprimir or extension.lower() == '.gz'
+
+
+def desviar_registro():
+    """Con los datos en stdout, los mensajes de progreso (print) pasan a stderr; devuelve el stdout real"""
+    real = sys.stdout
+    sys.stdout = sys.stderr
+    return real
+
+
+@contextmanager
+def _abrir(ruta, comprimir, estandar):
+    """Destino de texto: el fichero o `estandar` (stdout) con '-', comprimido con gzip si se pide"""
+    if ruta == SALIDA_ESTANDAR:
+        if not comprimir:
+            yield estandar
+            estandar.flush()
+            return
+        binario = gzip.GzipFile(fileobj=estandar.buffer, mode='wb')
+    else:
+        binario = gzip.open(ruta, 'wb') if comprimir else open(ruta, 'wb')
+    with binario, io.TextIOWrapper(binario, encoding='utf-8', newline='') as texto:
+        yield texto
+
+
+def exportar(filas, metricas, fecha_inicio, fecha_fin, formato, ruta, comprimir=False, estandar=None):
+    """Escribe `filas` (filas_detalle / filas_por_servicio) según salen; devuelve el número de filas"""
+    campos = CAMPOS + list(metricas)
+    estandar = estandar or sys.stdout
+    n = 0
+    try:
+        with _abrir(ruta, comprimir, estandar) as f:
+            if formato == 'csv':
+                escritor = csv.writer(f)
+                escritor.writerow(campos)
+                for name, servicio, categoria, valores in filas:
+                    escritor.writerow([fecha_inicio, fecha_fin, name, servicio, categoria, *map(_valor, valores)])
+                    n += 1
+            else:
+                for name, servicio, categoria, valores in filas:
+                    registro = dict(zip(campos, [fecha_inicio, fecha_fin, name, servicio, categoria,
+                                                 *map(_valor, valores)]))
+                    f.write(json.dumps(registro, ensure_ascii=False, separators=(',', ':')) + '\n')
+                    n += 1
+    except BrokenPipeError:
+        # El lector ha cerrado la tubería (| head): stdout a /dev/null para que el flush
+        # al salir no vuelva a fallar, y fin sin traza
+        os.dup2(os.open(os.devnull, os.O_WRONLY), estandar.fileno())
+        print("\n⚠️  Tubería cerrada por el lector: exportación interrumpida")
+        sys.exit(1)
+    destino = 'stdout' if ruta == SALIDA_ESTANDAR else ruta
+    print(f"\n✅ {formato.upper()} escrito en {destino}{' (gzip)' if comprimir else ''}: {n:,} filas")
+    return n
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Cost and Usage Report (CUR) en Parquet como fuente de datos
+===========================================================
+Alternativa a Cost Explorer (--cur DIR) para cuentas grandes: lee los
+ficheros Parquet del CUR exportados en local, sin llamadas a la API, y
+produce las mismas filas que el planificador de consultas, de modo que el
+resto del informe (normalización, Excel) no cambia.
+
+Para trabajar con gigabytes de line items en memoria acotada:
+  - Proyección de columnas: solo se leen las columnas que usa el informe.
+  - Filtro de row groups: con las estadísticas (mín/máx) del periodo de
+    facturación se descartan los row groups de otros meses sin leerlos.
+  - Lectura por lotes (iter_batches) agregados al momento con enteros
+    (micro-céntimos, ver dinero.py): la memoria depende del número de
+    combinaciones día/servicio/usage type/Name, no del número de líneas.
+  - Agregación en paralelo (--procesos): cada row group es una tarea de un
+    pool de procesos que devuelve su agregado parcial; los parciales se
+    suman en el orden de las tareas. Al ser sumas de enteros el resultado es
+    idéntico al de un solo proceso.
+
+Se usa el formato CUR "legacy" (columnas line_item_*, product_*,
+resource_tags_user_*). Los servicios se nombran como en Cost Explorer:
+en AmazonEC2 las horas de instancia son 'Amazon Elastic Compute Cloud -
+Compute' y el resto 'EC2 - Other'; las líneas de impuestos, 'Tax'.
+
+pyarrow es opcional: solo hace falta para --cur.
+"""
+
+import glob
+import os
+import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - dependencia opcional
+    pq = None
+
+from dinero import ESCALA
+from planificador_consultas import Consulta, demultiplexar
+
+COLUMNAS = {
+    'periodo_facturacion': 'bill_billing_period_start_date',
+    'fecha': 'line_item_usage_start_date',
+    'tipo_linea': 'line_item_line_item_type',
+    'codigo': 'line_item_product_code',
+    'producto': 'product_product_name',
+    'usage_type': 'line_item_usage_type',
+    'name': 'resource_tags_user_name',
+}
+
+# Métrica de Cost Explorer -> columna del CUR
+COLUMNAS_METRICA = {
+    'UnblendedCost': 'line_item_unblended_cost',
+    'NetUnblendedCost': 'line_item_net_unblended_cost',
+    'UsageQuantity': 'line_item_usage_amount',
+}
+
+# Usage types de AmazonEC2 que Cost Explorer cuenta como '... - Compute'
+PATRON_COMPUTE = r'BoxUsage|SpotUsage|DedicatedUsage|HostUsage|ReservedHostUsage'
+
+TAMANO_LOTE = 256 * 1024
+
+# Las filas agregadas equivalen a una consulta SERVICE × USAGE_TYPE × Name,
+# de la que se derivan base, desglose EC2 y Backup con el planificador
+CONSULTA_CUR = Consulta(('SERVICE', 'USAGE_TYPE', 'TAG:Name'), None)
+
+
+def ficheros_cur(directorio):
+    """Ficheros .parquet bajo `directorio` (recursivo), en orden estable"""
+    return sorted(glob.glob(os.path.join(directorio, '**', '*.parquet'), recursive=True))
+
+
+def _fecha(valor):
+    """Estadística de Parquet (datetime, date o texto) -> Timestamp sin zona"""
+    ts = pd.Timestamp(valor)
+    return ts.tz_convert(None) if ts.tzinfo else ts
+
+
+def _row_groups_del_periodo(metadatos, fecha_inicio, fecha_fin):
+    """Índices de row groups que pueden tener líneas del periodo
+
+    Se usan las estadísticas del periodo de facturación (o, si no hay, de la
+    fecha de uso); un row group sin estadísticas se lee siempre.
+    """
+    nombres = metadatos.schema.names
+    if COLUMNAS['periodo_facturacion'] in nombres:
+        columna = nombres.index(COLUMNAS['periodo_facturacion'])
+        # Periodos de facturación que empiezan desde el mes de fecha_inicio hasta fecha_fin
+        desde = _fecha(fecha_inicio[:7] + '-01')
+    else:
+        columna = nombres.index(COLUMNAS['fecha'])
+        desde = _fecha(fecha_inicio)
+    hasta = _fecha(fecha_fin)
+
+    seleccion = []
+    for i in range(metadatos.num_row_groups):
+        estadisticas = metadatos.row_group(i).column(columna).statistics
+        if estadisticas is None or not estadisticas.has_min_max:
+            seleccion.append(i)
+            continue
+        if _fecha(estadisticas.max) >= desde and _fecha(estadisticas.min) < hasta:
+            seleccion.append(i)
+    return seleccion
+
+
+def fragmentos_cur(rutas, fecha_inicio, fecha_fin):
+    """[(ruta, [row groups])] con lo que hay que leer; también el total de row groups"""
+    fragmentos = []
+    total = 0
+    for ruta in rutas:
+        metadatos = pq.ParquetFile(ruta).metadata
+        total += metadatos.num_row_groups
+        seleccion = _row_groups_del_periodo(metadatos, fecha_inicio, fecha_fin)
+        if seleccion:
+            fragmentos.append((ruta, seleccion))
+    return fragmentos, total
+
+
+def _servicio_ce(tipo_linea, codigo, producto, usage_type):
+    """Nombre de servicio como lo agrupa Cost Explorer (vectorizado sobre Series)"""
+    servicio = producto.where(producto.notna() & (producto != ''), codigo)
+    es_ec2 = codigo == 'AmazonEC2'
+    compute = es_ec2 & usage_type.str.contains(PATRON_COMPUTE, regex=True, na=False)
+    servicio = servicio.mask(es_ec2, 'EC2 - Other').mask(compute, 'Amazon Elastic Compute Cloud - Compute')
+    return servicio.mask(tipo_linea == 'Tax', 'Tax')
+
+
+def agregar_fragmento(ruta, row_groups, fecha_inicio, fecha_fin, metricas, por_dia):
+    """Lee los row groups de un fichero por lotes y los agrega
+
+    Devuelve {(periodo, servicio, usage_type, 'Name$valor'): [importe por métrica]}
+    con los importes en micro-céntimos.
+    """
+    fichero = pq.ParquetFile(ruta)
+    disponibles = set(fichero.schema_arrow.names)
+    columnas = [COLUMNAS[c] for c in ('fecha', 'tipo_linea', 'codigo', 'producto', 'usage_type', 'name')
+                if COLUMNAS[c] in disponibles]
+    columnas += [COLUMNAS_METRICA[m] for m in metricas]
+    faltan = [c for c in [COLUMNAS['fecha'], COLUMNAS['codigo']] + [COLUMNAS_METRICA[m] for m in metricas]
+              if c not in disponibles]
+    if faltan:
+        raise ValueError(f"{ruta}: faltan columnas del CUR: {', '.join(faltan)}")
+
+    inicio, fin = _fecha(fecha_inicio), _fecha(fecha_fin)
+    claves = ['periodo', 'tipo_linea', 'codigo', 'producto', 'usage_type', 'name']
+    acumulado = defaultdict(lambda: [0] * len(metricas))
+
+    for lote in fichero.iter_batches(batch_size=TAMANO_LOTE, row_groups=row_groups, columns=columnas):
+        df = lote.to_pandas()
+        fechas = pd.to_datetime(df[COLUMNAS['fecha']], utc=True).dt.tz_localize(None)
+        en_periodo = (fechas >= inicio) & (fechas < fin)
+        if not en_periodo.any():
+            continue
+        df, fechas = df[en_periodo], fechas[en_periodo]
+
+        # Periodo como en Cost Explorer: el día, o el inicio del mes recortado al rango pedido
+        if por_dia:
+            periodo = fechas.dt.strftime('%Y-%m-%d')
+        else:
+            periodo = fechas.dt.to_period('M').dt.start_time.clip(lower=inicio).dt.strftime('%Y-%m-%d')
+
+        texto = lambda c: (df[COLUMNAS[c]].fillna('').astype(str) if COLUMNAS[c] in df
+                           else pd.Series('', index=df.index))
+        parcial = pd.DataFrame({
+            'periodo': periodo, 'tipo_linea': texto('tipo_linea'), 'codigo': texto('codigo'),
+            'producto': texto('producto'), 'usage_type': texto('usage_type'), 'name': texto('name'),
+        })
+        for i, metrica in enumerate(metricas):
+            valores = pd.to_numeric(df[COLUMNAS_METRICA[metrica]], errors='coerce').fillna(0).to_numpy(float)
+            parcial[i] = np.rint(valores * ESCALA).astype(np.int64)
+
+        sumas = parcial.groupby(claves, sort=False)[list(range(len(metricas)))].sum()
+        if sumas.empty:
+            continue
+        indice = sumas.index.to_frame(index=False)
+        servicios = _servicio_ce(indice['tipo_linea'], indice['codigo'], indice['producto'], indice['usage_type'])
+        for periodo_, servicio, usage_type, name, importes in zip(
+                indice['periodo'], servicios, indice['usage_type'], indice['name'],
+                sumas.to_numpy().tolist()):
+            destino = acumulado[(periodo_, servicio, usage_type, f'Name${name}')]
+            for i, importe in enumerate(importes):
+                destino[i] += importe
+    return dict(acumulado)
+
+
+def fusionar(agregados):
+    """Suma agregados parciales (de varios fragmentos) en uno"""
+    total = {}
+    for agregado in agregados:
+        for clave, importes in agregado.items():
+            destino = total.get(clave)
+            if destino is None:
+                total[clave] = list(importes)
+            else:
+                for i, importe in enumerate(importes):
+                    destino[i] += importe
+    return total
+
+
+def agregar_cur(fragmentos, fecha_inicio, fecha_fin, metricas, por_dia=False, procesos=None):
+    """Agrega todos los fragmentos, repartidos por row group entre `procesos` procesos
+
+    procesos=None usa todos los núcleos; con 1 (o una sola tarea) no se crea
+    el pool. Las tareas se fusionan en orden, así que el resultado (también
+    el orden de las claves) no depende del número de procesos.
+    """
+    tareas = [(ruta, [row_group]) for ruta, row_groups in fragmentos for row_group in row_groups]
+    procesos = min(procesos or os.cpu_count() or 1, len(tareas))
+    rutas = [ruta for ruta, _ in tareas]
+    row_groups = [rg for _, rg in tareas]
+    argumentos = (repeat(fecha_inicio), repeat(fecha_fin), repeat(metricas), repeat(por_dia))
+
+    if procesos <= 1:
+        return fusionar(map(agregar_fragmento, rutas, row_groups, *argumentos))
+    print(f"   → {len(tareas)} row groups repartidos en {procesos} procesos")
+    with ProcessPoolExecutor(max_workers=procesos) as pool:
+        return fusionar(pool.map(agregar_fragmento, rutas, row_groups, *argumentos))
+
+
+def filas_cur(directorio, fecha_inicio, fecha_fin, metricas, por_dia=False, procesos=None):
+    """Filas {'base', 'ec2', 'backup'} en el formato del planificador, leídas del CUR"""
+    from aws_cost_report import NECESIDAD_BASE, NECESIDAD_EC2, NECESIDAD_BACKUP
+
+    if pq is None:
+        print("❌ --cur necesita pyarrow: pip install pyarrow")
+        sys.exit(1)
+    no_soportadas = [m for m in metricas if m not in COLUMNAS_METRICA]
+    if no_soportadas:
+        print(f"❌ Métricas no disponibles desde el CUR: {', '.join(no_soportadas)}")
+        sys.exit(1)
+
+    rutas = ficheros_cur(directorio)
+    if not rutas:
+        print(f"❌ No hay ficheros .parquet en {directorio}")
+        sys.exit(1)
+
+    print(f"📦 Leyendo CUR de {directorio} ({len(rutas)} ficheros)...")
+    inicio = datetime.now()
+    fragmentos, total_row_groups = fragmentos_cur(rutas, fecha_inicio, fecha_fin)
+    leidos = sum(len(rg) for _, rg in fragmentos)
+    print(f"   → {leidos}/{total_row_groups} row groups del periodo {fecha_inicio} a {fecha_fin}")
+
+    agregado = agregar_cur(fragmentos, fecha_inicio, fecha_fin, metricas, por_dia, procesos)
+    print(f"   → {len(agregado)} combinaciones agregadas en {(datetime.now() - inicio).total_seconds():.1f}s")
+
+    filas = [(periodo, (servicio, usage_type, etiqueta), dict(zip(metricas, importes)))
+             for (periodo, servicio, usage_type, etiqueta), importes in agregado.items()]
+    return {n.nombre: demultiplexar(CONSULTA_CUR, n, filas, metricas)
+            for n in (NECESIDAD_BASE, NECESIDAD_EC2, NECESIDAD_BACKUP)}
+
+
+def obtener_costos_cur(directorio, fecha_inicio, fecha_fin, por_dia=False, metricas=None, procesos=None):
+    """Como obtener_costos_informe, pero desde los Parquet del CUR (sin llamadas a la API)"""
+    from aws_cost_report import METRICA_PRINCIPAL, costos_informe_desde_filas
+
+    filas = filas_cur(directorio, fecha_inicio, fecha_fin, metricas or [METRICA_PRINCIPAL], por_dia, procesos)
+    return costos_informe_desde_filas(filas, metricas, por_dia)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Panel HTML autocontenido (--format html)
+========================================
+Alternativa ligera al Excel: un único .html sin dependencias externas que
+se abre al instante en cualquier navegador. Los agregados (por servicio, por
+Name y por categoría EC2) se calculan aquí y van embebidos como JSON
+compacto junto con las filas Name × servicio/categoría en céntimos; el
+navegador solo filtra (por Name y por servicio) y vuelve a sumar.
+
+Se genera del mismo modelo que el Excel por servicio (desglose EC2
+normalizado y costes por servicio), sin estilos ni gráficas de openpyxl.
+"""
+
+import html
+import json
+
+from dinero import ESCALA, porcentaje, repartir
+
+SERVICIO_EC2 = 'EC2'
+
+
+def centimos(micro):
+    """µ¢ -> céntimos enteros (JSON compacto; el navegador divide entre 100)"""
+    return round(micro * 100 / ESCALA)
+
+
+def _indice(valores):
+    return {v: i for i, v in enumerate(valores)}
+
+
+def modelo(ec2_data, servicios, colores, fecha_inicio, fecha_fin, es_partner=False, porcentaje_descuento=5.0):
+    """Datos del panel: agregados precalculados + filas [name, servicio, categoría, céntimos]
+
+    ec2_data: {name: {categoria: µ¢}}; servicios: {servicio: {name: µ¢}} (sin EC2);
+    colores: {servicio: 'RRGGBB'} (incluido 'EC2').
+    Los céntimos de las filas se reparten desde el total (dinero.repartir):
+    cualquier suma que haga el navegador al filtrar cuadra con los agregados.
+    """
+    detalle = []  # (name, servicio, categoria o None, µ¢)
+    for name, categorias in ec2_data.items():
+        for categoria, costo in categorias.items():
+            detalle.append((name, SERVICIO_EC2, categoria, costo))
+    for servicio, names in servicios.items():
+        for name, costo in names.items():
+            detalle.append((name, servicio, None, costo))
+    detalle.sort(key=lambda f: f[3], reverse=True)
+    total = sum(f[3] for f in detalle)
+    pesos = {i: f[3] for i, f in enumerate(detalle)}
+    filas_centimos = repartir(centimos(total), pesos) if total else {i: centimos(c) for i, c in pesos.items()}
+
+    por_servicio, por_name, por_categoria = {}, {}, {}
+    for i, (name, servicio, categoria, _) in enumerate(detalle):
+        c = filas_centimos[i]
+        por_servicio[servicio] = por_servicio.get(servicio, 0) + c
+        por_name[name] = por_name.get(name, 0) + c
+        if categoria is not None:
+            por_categoria[categoria] = por_categoria.get(categoria, 0) + c
+
+    orden = lambda totales: sorted(totales, key=lambda k: totales[k], reverse=True)
+    lista_servicios, lista_names, lista_categorias = orden(por_servicio), orden(por_name), orden(por_categoria)
+    i_servicio, i_name, i_categoria = _indice(lista_servicios), _indice(lista_names), _indice(lista_categorias)
+    return {
+        'periodo': [fecha_inicio, fecha_fin],
+        'total': centimos(total),
+        'descuento': ({'porcentaje': porcentaje_descuento, 'importe': centimos(porcentaje(total, porcentaje_descuento))}
+                      if es_partner else None),
+        'servicios': lista_servicios,
+        'colores': [colores.get(s, '5D6D7E') for s in lista_servicios],
+        'names': lista_names,
+        'categorias': lista_categorias,
+        'por_servicio': [por_servicio[s] for s in lista_servicios],
+        'por_name': [por_name[n] for n in lista_names],
+        'por_categoria': [por_categoria[c] for c in lista_categorias],
+        'filas': [[i_name[n], i_servicio[s], -1 if c is None else i_categoria[c], filas_centimos[i]]
+                  for i, (n, s, c, _) in enumerate(detalle)],
+    }
+
+
+def escribir_html(ruta, datos, titulo='AWS Cost Report'):
+    """Escribe el panel con `datos` (de modelo()) embebidos; devuelve la ruta"""
+    carga = json.dumps(datos, ensure_ascii=False, separators=(',', ':')).replace('</', '<\\/')
+    with open(ruta, 'w', encoding='utf-8') as f:
+        f.write(PLANTILLA.replace('{{TITULO}}', html.escape(titulo)).replace('{{DATOS}}', carga))
+    return ruta
+
+
+PLANTILLA = '''<!DOCTYPE html>
+<html lang="es">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{{TITULO}}</title>
+<style>
+  body { font-family: Calibri, "Segoe UI", Arial, sans-serif; margin: 0; background: #F2F4F7; color: #232F3E; }
+  header { background: #232F3E; color: #fff; padding: 14px 24px; }
+  header h1 { margin: 0; font-size: 22px; }
+  header p { margin: 4px 0 0; color: #C9D1DB; font-size: 13px; }
+  main { padding: 16px 24px; }
+  .kpis, .paneles { display: flex; flex-wrap: wrap; gap: 16px; margin-bottom: 16px; }
+  .kpi { background: #fff; border-left: 6px solid #FF9900; padding: 10px 16px; min-width: 180px; }
+  .kpi b { display: block; font-size: 22px; }
+  .kpi span { font-size: 12px; color: #44546A; }
+  .panel { background: #fff; padding: 12px 16px; flex: 1 1 420px; min-width: 320px; }
+  .panel h2 { font-size: 15px; margin: 0 0 8px; }
+  .filtros { background: #fff; padding: 10px 16px; margin-bottom: 16px; display: flex; gap: 12px; align-items: center; }
+  input, select { font: inherit; padding: 4px 6px; }
+  .barra { display: grid; grid-template-columns: 38% 1fr 110px; gap: 8px; align-items: center; font-size: 13px;
+           padding: 2px 0; cursor: pointer; }
+  .barra div.fondo { background: #EAF1F8; height: 14px; }
+  .barra div.fondo div { height: 14px; }
+  .barra .v { text-align: right; font-variant-numeric: tabular-nums; }
+  .nombre { overflow: hidden; text-overflow: ellipsis; white-space: nowrap; }
+  table { border-collapse: collapse; width: 100%; font-size: 13px; }
+  th { background: #146EB4; color: #fff; text-align: left; padding: 4px 6px; position: sticky; top: 0; }
+  td { padding: 3px 6px; border-bottom: 1px solid #EAF1F8; }
+  td.v { text-align: right; font-variant-numeric: tabular-nums; }
+  .tabla { max-height: 480px; overflow: auto; }
+  .nota { font-size: 12px; color: #44546A; }
+</style>
+</head>
+<body>
+<header><h1>{{TITULO}}</h1><p id="periodo"></p></header>
+<main>
+  <div class="kpis" id="kpis"></div>
+  <div class="filtros">
+    <label>Name <input id="filtro-name" type="search" placeholder="contiene..."></label>
+    <label>Servicio <select id="filtro-servicio"><option value="-1">Todos</option></select></label>
+    <span class="nota" id="resumen-filtro"></span>
+  </div>
+  <div class="paneles">
+    <div class="panel"><h2>Coste por servicio</h2><div id="servicios"></div></div>
+    <div class="panel"><h2>Top 25 Names</h2><div id="names"></div></div>
+  </div>
+  <div class="paneles">
+    <div class="panel"><h2>EC2 por categoría</h2><div id="categorias"></div></div>
+    <div class="panel"><h2>Detalle</h2><div class="tabla"><table>
+      <thead><tr><th>Name</th><th>Servicio</th><th>Categoría EC2</th><th>Costo (US$)</th></tr></thead>
+      <tbody id="detalle"></tbody></table></div>
+      <p class="nota" id="nota-detalle"></p></div>
+  </div>
+</main>
+<script type="application/json" id="datos">{{DATOS}}</script>
+<script>
+const D = JSON.parse(document.getElementById('datos').textContent);
+const usd = new Intl.NumberFormat('es-ES', {style: 'currency', currency: 'USD'});
+const fmt = c => usd.format(c / 100);
+const esc = s => s.replace(/[&<>"]/g, ch => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'}[ch]));
+const MAX_DETALLE = 500;
+
+document.getElementById('periodo').textContent = 'Periodo: ' + D.periodo[0] + ' a ' + D.periodo[1];
+const kpis = [['Coste total', fmt(D.total)], ['Names', D.names.length.toLocaleString('es-ES')],
+              ['Servicios', D.servicios.length]];
+if (D.descuento) {
+  kpis.push(['Descuento partner (' + D.descuento.porcentaje + '%)', fmt(-D.descuento.importe)]);
+  kpis.push(['Total con descuento', fmt(D.total - D.descuento.importe)]);
+}
+document.getElementById('kpis').innerHTML = kpis.map(([t, v]) => `<div class="kpi"><b>${v}</b><span>${t}</span></div>`).join('');
+const selector = document.getElementById('filtro-servicio');
+D.servicios.forEach((s, i) => selector.add(new Option(s, i)));
+
+function barras(id, etiquetas, valores, colores, alHacerClic) {
+  const max = Math.max(1, ...valores);
+  const el = document.getElementById(id);
+  el.innerHTML = etiquetas.map((e, i) => `<div class="barra" data-i="${i}"><span class="nombre" title="${esc(e)}">${esc(e)}</span>
+    <div class="fondo"><div style="width:${(100 * valores[i] / max).toFixed(1)}%;background:#${colores(i)}"></div></div>
+    <span class="v">${fmt(valores[i])}</span></div>`).join('') || '<p class="nota">Sin datos</p>';
+  if (alHacerClic) el.querySelectorAll('.barra').forEach(b => b.onclick = () => alHacerClic(+b.dataset.i));
+}
+
+function ordenar(totales) {
+  return [...totales.keys()].sort((a, b) => totales.get(b) - totales.get(a));
+}
+
+function pintar() {
+  const texto = document.getElementById('filtro-name').value.trim().toLowerCase();
+  const servicio = +selector.value;
+  const sinFiltro = !texto && servicio < 0;
+  let servicios, names, categorias, filas;
+  if (sinFiltro) {  // agregados precalculados
+    servicios = D.servicios.map((_, i) => i); names = D.names.map((_, i) => i).slice(0, 25);
+    categorias = D.categorias.map((_, i) => i); filas = D.filas;
+    var totS = i => D.por_servicio[i], totN = i => D.por_name[i], totC = i => D.por_categoria[i];
+  } else {
+    const okName = D.names.map(n => !texto || n.toLowerCase().includes(texto));
+    filas = D.filas.filter(f => okName[f[0]] && (servicio < 0 || f[1] === servicio));
+    const s = new Map(), n = new Map(), c = new Map();
+    for (const [iN, iS, iC, v] of filas) {
+      s.set(iS, (s.get(iS) || 0) + v); n.set(iN, (n.get(iN) || 0) + v);
+      if (iC >= 0) c.set(iC, (c.get(iC) || 0) + v);
+    }
+    servicios = ordenar(s); names = ordenar(n).slice(0, 25); categorias = ordenar(c);
+    var totS = i => s.get(i), totN = i => n.get(i), totC = i => c.get(i);
+  }
+  const total = filas.reduce((a, f) => a + f[3], 0);
+  document.getElementById('resumen-filtro').textContent =
+    sinFiltro ? '' : `${filas.length.toLocaleString('es-ES')} filas · ${fmt(total)}`;
+  barras('servicios', servicios.map(i => D.servicios[i]), servicios.map(totS), i => D.colores[servicios[i]],
+         i => { selector.value = servicios[i]; pintar(); });
+  barras('names', names.map(i => D.names[i]), names.map(totN), () => '146EB4',
+         i => { document.getElementById('filtro-name').value = D.names[names[i]]; pintar(); });
+  barras('categorias', categorias.map(i => D.categorias[i]), categorias.map(totC), () => 'FF9900');
+  document.getElementById('detalle').innerHTML = filas.slice(0, MAX_DETALLE).map(([iN, iS, iC, v]) =>
+    `<tr><td>${esc(D.names[iN])}</td><td>${esc(D.servicios[iS])}</td><td>${iC >= 0 ? esc(D.categorias[iC]) : ''}</td>
+     <td class="v">${fmt(v)}</td></tr>`).join('');
+  document.getElementById('nota-detalle').textContent = filas.length > MAX_DETALLE ?
+    `Se muestran las ${MAX_DETALLE} filas de mayor coste de ${filas.length.toLocaleString('es-ES')}; filtra para ver más.` : '';
+}
+
+document.getElementById('filtro-name').addEventListener('input', pintar);
+selector.addEventListener('change', pintar);
+pintar();
+</script>
+</body>
+</html>
+'''
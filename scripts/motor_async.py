@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Motor de consultas asyncio para Cost Explorer (--motor async)
+============================================================
+El motor por defecto lanza las consultas del plan en hilos (4 a la vez);
+con cuentas muy grandes (--fragmentos, muchos lotes de Names) o con varias
+cuentas y meses, un hilo por petición pesa y limita la concurrencia. Este
+motor las lanza TODAS a la vez en un bucle asyncio, con un semáforo global
+que acota las peticiones en vuelo (--concurrencia, 100 por defecto).
+
+- Cada consulta recorre sus páginas (NextPageToken) en orden; las consultas
+  entre sí van en paralelo y comparten el semáforo y las conexiones HTTP
+  (keep-alive) del motor.
+- Las peticiones se firman con SigV4 de botocore (mismas credenciales que la
+  sesión de boto3) y van por HTTP/1.1 sobre asyncio: sin dependencias nuevas.
+- Limitación de la API (LimitExceededException, 429, 5xx) y errores de red se
+  reintentan con espera exponencial con jitter.
+- Cada página pasa por el ClienteCEMedido: cuenta en el resumen de la API y
+  respeta --max-requests igual que en el motor de hilos.
+
+Solo se usa para las consultas del planificador (ejecutar_plan,
+ejecutar_por_etiqueta: base, desglose EC2, Backup, dimensiones y
+fragmentos); el resto de llamadas (get_tags, previsión, ...) pasan al
+cliente síncrono. servidor_ce_simulado.py sirve para probarlo en local.
+
+No pasa por proxies: si hay uno configurado para el endpoint (HTTPS_PROXY /
+HTTP_PROXY sin NO_PROXY que lo excluya, o proxies en la configuración del
+cliente) desde_sesion() se niega a crear el motor y hay que usar --motor hilos.
+"""
+
+import asyncio
+import json
+import random
+import ssl
+import threading
+from urllib.parse import urlsplit
+
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.httpsession import get_cert_path
+from botocore.utils import get_environ_proxies
+
+CONCURRENCIA = 100  # peticiones en vuelo como máximo (todas las consultas)
+REINTENTOS = 8
+ESPERA_BASE = 0.5  # segundos; se dobla en cada reintento (con jitter)
+ESPERA_MAXIMA = 20
+TIMEOUT_PETICION = 60
+PREFIJO_OBJETIVO = 'AWSInsightsIndexService'  # X-Amz-Target de la API de Cost Explorer
+ERRORES_REINTENTABLES = {'LimitExceededException', 'ThrottlingException', 'TooManyRequestsException',
+                         'RequestLimitExceeded', 'ServiceUnavailable', 'InternalFailure', 'RequestTimeout'}
+
+
+class ErrorCE(Exception):
+    """Error devuelto por la API (o la red) tras agotar los reintentos"""
+
+    def __init__(self, codigo, mensaje, operacion):
+        super().__init__(f"{codigo} en {operacion}: {mensaje}")
+        self.codigo = codigo
+        self.mensaje = mensaje
+
+
+def nombre_api(operacion):
+    """'get_cost_and_usage' -> 'GetCostAndUsage'"""
+    return ''.join(parte.capitalize() for parte in operacion.split('_'))
+
+
+async def _leer_respuesta(lector):
+    """(estado, cabeceras, cuerpo) de una respuesta HTTP/1.1 (Content-Length o chunked)"""
+    linea = await lector.readline()
+    if not linea:
+        raise ConnectionError('conexión cerrada por el servidor')
+    estado = int(linea.split()[1])
+    cabeceras = {}
+    while True:
+        linea = await lector.readline()
+        if linea in (b'\r\n', b'\n', b''):
+            break
+        clave, _, valor = linea.decode('latin-1').partition(':')
+        cabeceras[clave.strip().lower()] = valor.strip()
+    if cabeceras.get('transfer-encoding', '').lower() == 'chunked':
+        partes = []
+        while True:
+            tamano = int((await lector.readline()).split(b';')[0], 16)
+            if tamano == 0:
+                while (await lector.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            partes.append(await lector.readexactly(tamano))
+            await lector.readline()
+        return estado, cabeceras, b''.join(partes)
+    return estado, cabeceras, await lector.readexactly(int(cabeceras.get('content-length', 0)))
+
+
+class MotorCEAsync:
+    """Cliente de Cost Explorer que ejecuta lotes de consultas paginadas sobre asyncio
+
+    Las llamadas normales (cliente.get_tags(...), imprimir_resumen()...) van
+    al ClienteCEMedido síncrono; periodos_consultas() ejecuta un lote en el
+    bucle del motor, que corre en su propio hilo y se comparte entre lotes.
+    """
+
+    def __init__(self, medido, credenciales, endpoint, region_firma, concurrencia=CONCURRENCIA):
+        self._medido = medido
+        self._credenciales = credenciales
+        self.endpoint = endpoint
+        self.region_firma = region_firma
+        self.concurrencia = concurrencia
+        url = urlsplit(endpoint)
+        self._tls = ssl.create_default_context(cafile=get_cert_path(True)) if url.scheme == 'https' else None
+        self._servidor = url.hostname
+        self._puerto = url.port or (443 if self._tls else 80)
+        self._host = url.netloc
+        self._ruta = url.path or '/'
+        self._libres = []  # conexiones keep-alive (lector, escritor) sin usar
+        self._semaforo = None
+        self._detenido = None  # SystemExit (presupuesto agotado): las demás consultas paran sin más peticiones
+        self._en_vuelo = 0
+        self.max_en_vuelo = 0
+        self.reintentos = 0
+        self.consultas = 0
+        self._bucle = asyncio.new_event_loop()
+        threading.Thread(target=self._bucle.run_forever, name='motor-ce-async', daemon=True).start()
+
+    @classmethod
+    def desde_sesion(cls, sesion, cliente, medido, concurrencia=CONCURRENCIA):
+        """Motor con las credenciales de la sesión boto3 y el endpoint (y región de firma) de su cliente 'ce'"""
+        credenciales = sesion.get_credentials()
+        if credenciales is None:
+            raise ErrorCE('NoCredentials', 'no hay credenciales de AWS configuradas', 'motor async')
+        endpoint = cliente.meta.endpoint_url
+        # Misma elección de proxy que botocore: la del cliente o, si no hay, la del entorno
+        proxies = getattr(cliente.meta.config, 'proxies', None) or get_environ_proxies(endpoint)
+        proxy = proxies.get(urlsplit(endpoint).scheme)
+        if proxy:
+            raise ErrorCE('ProxyNoSoportado', f'hay un proxy configurado para {endpoint} ({proxy}) y el motor '
+                          f'async no lo usa: quita --motor async o exclúyelo con NO_PROXY', 'motor async')
+        region = getattr(getattr(cliente, '_request_signer', None), '_region_name', None) or cliente.meta.region_name
+        return cls(medido, credenciales, endpoint, region, concurrencia)
+
+    def __getattr__(self, nombre):
+        return getattr(self._medido, nombre)
+
+    def imprimir_resumen(self, ruta_json=None):
+        resumen = self._medido.imprimir_resumen(ruta_json)
+        print(f"⚡ Motor asyncio: {self.consultas} consultas, máximo {self.max_en_vuelo} peticiones simultáneas "
+              f"(límite {self.concurrencia}), {self.reintentos} reintentos")
+        return resumen
+
+    # ------------------------------------------------------------------
+    # API síncrona para el planificador
+    # ------------------------------------------------------------------
+    def periodos_consultas(self, lista_params):
+        """ResultsByTime (todas las páginas) de cada consulta de get_cost_and_usage, en el mismo orden
+
+        Una consulta que falla devuelve la excepción en su posición (el
+        planificador la convierte en aviso); PresupuestoPeticionesAgotado y
+        demás SystemExit se relanzan aquí.
+        """
+        resultados = asyncio.run_coroutine_threadsafe(self._lote(lista_params), self._bucle).result()
+        for resultado in resultados:
+            if isinstance(resultado, SystemExit):
+                raise resultado
+        return resultados
+
+    def cerrar(self):
+        """Cierra las conexiones keep-alive y para el bucle (el motor ya no se puede usar)"""
+        if not self._bucle.is_running():
+            return
+        asyncio.run_coroutine_threadsafe(self._cerrar_conexiones(), self._bucle).result()
+        self._bucle.call_soon_threadsafe(self._bucle.stop)
+
+    # ------------------------------------------------------------------
+    # Dentro del bucle
+    # ------------------------------------------------------------------
+    async def _lote(self, lista_params):
+        if self._semaforo is None:
+            self._semaforo = asyncio.Semaphore(self.concurrencia)
+        self.consultas += len(lista_params)
+        return await asyncio.gather(*(self._capturar(self._periodos(p)) for p in lista_params))
+
+    async def _capturar(self, corrutina):
+        try:
+            return await corrutina
+        except SystemExit as e:  # presupuesto de peticiones agotado
+            self._detenido = e
+            return e
+        except Exception as e:
+            return e
+
+    async def _periodos(self, params):
+        periodos = []
+        while True:
+            respuesta = await self.llamar('get_cost_and_usage', params)
+            periodos.extend(respuesta['ResultsByTime'])
+            token = respuesta.get('NextPageToken')
+            if not token:
+                return periodos
+            params = dict(params, NextPageToken=token)
+
+    async def llamar(self, operacion, params):
+        """Una petición (una página) con reintentos; devuelve la respuesta JSON decodificada"""
+        if self._detenido is not None:
+            raise self._detenido
+        self._medido._registrar(operacion, params)
+        cuerpo = json.dumps(params, separators=(',', ':')).encode('utf-8')
+        for intento in range(REINTENTOS + 1):
+            async with self._semaforo:
+                self._en_vuelo += 1
+                self.max_en_vuelo = max(self.max_en_vuelo, self._en_vuelo)
+                try:
+                    estado, datos = await asyncio.wait_for(self._enviar(operacion, cuerpo), TIMEOUT_PETICION)
+                    error = None
+                except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError) as e:
+                    estado, datos, error = None, None, ErrorCE(type(e).__name__, str(e) or 'error de red',
+                                                               nombre_api(operacion))
+                finally:
+                    self._en_vuelo -= 1
+            if estado == 200:
+                return json.loads(datos)
+            if estado is not None:
+                error = self._error_api(estado, datos, operacion)
+            reintentable = estado is None or estado == 429 or estado >= 500 or error.codigo in ERRORES_REINTENTABLES
+            if not reintentable or intento == REINTENTOS:
+                raise error
+            self.reintentos += 1
+            await asyncio.sleep(random.uniform(0, min(ESPERA_MAXIMA, ESPERA_BASE * 2 ** intento)))
+
+    @staticmethod
+    def _error_api(estado, datos, operacion):
+        try:
+            cuerpo = json.loads(datos or b'{}')
+        except ValueError:
+            cuerpo = {}
+        codigo = (cuerpo.get('__type') or f'HTTP{estado}').rsplit('#', 1)[-1]
+        mensaje = cuerpo.get('message') or cuerpo.get('Message') or f'HTTP {estado}'
+        return ErrorCE(codigo, mensaje, nombre_api(operacion))
+
+    def _firmar(self, operacion, cuerpo):
+        peticion = AWSRequest(method='POST', url=self.endpoint, data=cuerpo, headers={
+            'Host': self._host,
+            'Content-Type': 'application/x-amz-json-1.1',
+            'X-Amz-Target': f'{PREFIJO_OBJETIVO}.{nombre_api(operacion)}',
+        })
+        SigV4Auth(self._credenciales.get_frozen_credentials(), 'ce', self.region_firma).add_auth(peticion)
+        return peticion.headers.items()
+
+    async def _conectar(self):
+        return await asyncio.open_connection(self._servidor, self._puerto, ssl=self._tls,
+                                             server_hostname=self._servidor if self._tls else None)
+
+    async def _enviar(self, operacion, cuerpo):
+        """POST firmado por una conexión keep-alive (o nueva); (estado, cuerpo de la respuesta)"""
+        lector, escritor = self._libres.pop() if self._libres else await self._conectar()
+        try:
+            cabeceras = ''.join(f'{clave}: {valor}\r\n' for clave, valor in self._firmar(operacion, cuerpo))
+            escritor.write(f'POST {self._ruta} HTTP/1.1\r\n{cabeceras}Content-Length: {len(cuerpo)}\r\n\r\n'
+                           .encode('latin-1') + cuerpo)
+            await escritor.drain()
+            estado, cabeceras_respuesta, datos = await _leer_respuesta(lector)
+        except BaseException:
+            escritor.close()
+            raise
+        if cabeceras_respuesta.get('connection', '').lower() == 'close':
+            escritor.close()
+        else:
+            self._libres.append((lector, escritor))
+        return estado, datos
+
+    async def _cerrar_conexiones(self):
+        while self._libres:
+            _, escritor = self._libres.pop()
+            escritor.close()
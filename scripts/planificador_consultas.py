@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Planificador de consultas a Cost Explorer
+=========================================
+El informe necesita varias agregaciones (base SERVICE × Name, desglose EC2
+USAGE_TYPE × Name, Backup por Name...). Cada una se describe como una
+Necesidad y el planificador elige el MÍNIMO de consultas que las cubren:
+
+  - Una necesidad limitada a varios servicios se pide con un único filtro
+    multi-valor en lugar de una consulta por servicio.
+  - Una necesidad se deriva en memoria de otra consulta si esa consulta ya
+    agrupa por sus claves (más SERVICE, si hay que filtrar por servicio) y su
+    filtro la incluye. Ej.: Backup por Name sale de la consulta SERVICE × Name.
+
+Cost Explorer admite como máximo dos claves de GroupBy por consulta.
+Después, ejecutar_plan() lanza las consultas EN PARALELO (hilos; el cliente
+medido es seguro entre hilos) y reparte (demultiplexa) las filas entre las
+necesidades, sumando cuando una necesidad agrupa por menos claves que la
+consulta que la sirve.
+
+ejecutar_por_etiqueta() sirve una necesidad limitada en el servidor a unos
+valores de etiqueta (p. ej. los Names con EC2): Cost Explorer solo devuelve
+esas filas. Los valores van en lotes, una consulta por lote, en paralelo.
+
+Con el motor asyncio (motor_async.MotorCEAsync, --motor async) las consultas
+de cada lote se lanzan todas a la vez en su bucle en lugar de en hilos.
+"""
+
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from consultas_ce import periodos_ce
+from dinero import importe
+
+MAX_CLAVES_GROUP_BY = 2
+HILOS_CONSULTAS = 4  # consultas simultáneas a Cost Explorer
+LOTE_VALORES_ETIQUETA = 400  # valores por filtro Tags (acota el tamaño de la petición)
+
+# agrupar: tupla de claves ('SERVICE', 'USAGE_TYPE', 'TAG:Name', ...)
+# servicios: frozenset de servicios a los que se limita, o None (todos)
+Necesidad = namedtuple('Necesidad', ['nombre', 'agrupar', 'servicios'])
+Consulta = namedtuple('Consulta', ['agrupar', 'servicios'])
+
+
+def group_by(agrupar):
+    """Claves del planificador -> parámetro GroupBy de Cost Explorer"""
+    return [{'Type': 'TAG', 'Key': clave[4:]} if clave.startswith('TAG:')
+            else {'Type': 'DIMENSION', 'Key': clave}
+            for clave in agrupar]
+
+
+def filtro_servicios(servicios):
+    if servicios is None:
+        return None
+    return {'Dimensions': {'Key': 'SERVICE', 'Values': sorted(servicios)}}
+
+
+def filtro_etiqueta(clave, valores):
+    """Filtro Tags para 'TAG:<clave>'; [''] (sin etiqueta) se pide con MatchOptions ABSENT"""
+    if list(valores) == ['']:
+        return {'Tags': {'Key': clave[4:], 'MatchOptions': ['ABSENT']}}
+    return {'Tags': {'Key': clave[4:], 'Values': sorted(valores)}}
+
+
+def combinar_filtros(*filtros):
+    """Y lógico de los filtros no vacíos (None si no queda ninguno)"""
+    filtros = [f for f in filtros if f]
+    if len(filtros) > 1:
+        return {'And': filtros}
+    return filtros[0] if filtros else None
+
+
+def cubre(consulta, necesidad):
+    """¿Se puede obtener la necesidad a partir de las filas de la consulta?"""
+    claves = set(necesidad.agrupar)
+    if necesidad.servicios is not None and necesidad.servicios != consulta.servicios:
+        # Habrá que filtrar por servicio en memoria: la consulta debe traer SERVICE
+        claves.add('SERVICE')
+    if not claves <= set(consulta.agrupar):
+        return False
+    if consulta.servicios is None:
+        return True
+    return necesidad.servicios is not None and necesidad.servicios <= consulta.servicios
+
+
+def _candidatas(necesidades):
+    """La consulta propia de cada necesidad y, para las que agrupan por SERVICE
+    con las mismas claves, una consulta fusionada con la unión de sus filtros."""
+    candidatas = [Consulta(n.agrupar, n.servicios) for n in necesidades]
+    por_claves = defaultdict(list)
+    for n in necesidades:
+        if 'SERVICE' in n.agrupar:
+            por_claves[n.agrupar].append(n.servicios)
+    for agrupar, filtros in por_claves.items():
+        if len(filtros) > 1:
+            union = None if None in filtros else frozenset().union(*filtros)
+            candidatas.append(Consulta(agrupar, union))
+    return list(dict.fromkeys(candidatas))
+
+
+def planificar(necesidades):
+    """Devuelve (consultas, asignacion) con asignacion = {nombre_necesidad: índice de consulta}
+
+    Cobertura voraz (greedy set cover): se elige la consulta que cubre más
+    necesidades pendientes; a igualdad, la que agrupa por menos claves.
+    """
+    for n in necesidades:
+        if len(n.agrupar) > MAX_CLAVES_GROUP_BY:
+            raise ValueError(f"{n.nombre}: Cost Explorer admite como máximo {MAX_CLAVES_GROUP_BY} claves de GroupBy")
+
+    candidatas = _candidatas(necesidades)
+    pendientes = list(necesidades)
+    consultas = []
+    while pendientes:
+        mejor = max(candidatas, key=lambda c: (sum(cubre(c, n) for n in pendientes), -len(c.agrupar)))
+        consultas.append(mejor)
+        pendientes = [n for n in pendientes if not cubre(mejor, n)]
+
+    asignacion = {}
+    for n in necesidades:
+        # Preferir la consulta exacta (sin re-agregar en memoria) si está en el plan
+        indices = [i for i, c in enumerate(consultas) if cubre(c, n)]
+        exactas = [i for i in indices if consultas[i] == Consulta(n.agrupar, n.servicios)]
+        asignacion[n.nombre] = (exactas or indices)[0]
+    return consultas, asignacion
+
+
+def describir(consulta):
+    claves = ' × '.join(k[4:] if k.startswith('TAG:') else k for k in consulta.agrupar)
+    if consulta.servicios:
+        return f"{claves} [{', '.join(sorted(consulta.servicios))}]"
+    return claves
+
+
+def ejecutar_plan(cliente_ce, necesidades, fecha_inicio, fecha_fin, metricas,
+                  granularidad='MONTHLY', hilos=HILOS_CONSULTAS):
+    """Lanza las consultas del plan y reparte las filas entre las necesidades
+
+    Devuelve {nombre_necesidad: [(inicio_periodo, claves, {metrica: valor})]} con
+    los valores en micro-céntimos (enteros, ver dinero.py), las claves en el orden de `necesidad.agrupar` y los valores SIN filtrar por
+    importe (cada consumidor aplica su criterio). Si una consulta falla, sus
+    necesidades quedan a None y se muestra el aviso.
+    """
+    consultas, asignacion = planificar(necesidades)
+    print(f"🧭 Plan: {len(consultas)} consultas a Cost Explorer para {len(necesidades)} agregaciones")
+
+    for consulta in consultas:
+        print(f"   → {describir(consulta)}")
+
+    filas_consulta = _ejecutar_consultas(cliente_ce, [(c, None) for c in consultas], fecha_inicio, fecha_fin,
+                                         metricas, granularidad, hilos)
+
+    resultado = {}
+    for n in necesidades:
+        indice = asignacion[n.nombre]
+        resultado[n.nombre] = demultiplexar(consultas[indice], n, filas_consulta[indice], metricas)
+    return resultado
+
+
+def _params_consulta(consulta, fecha_inicio, fecha_fin, metricas, granularidad, filtro_extra=None):
+    """Parámetros de get_cost_and_usage para una consulta del plan"""
+    params = {
+        'TimePeriod': {'Start': fecha_inicio, 'End': fecha_fin},
+        'Granularity': granularidad,
+        'Metrics': list(metricas),
+        'GroupBy': group_by(consulta.agrupar),
+    }
+    filtro = combinar_filtros(filtro_servicios(consulta.servicios), filtro_extra)
+    if filtro:
+        params['Filter'] = filtro
+    return params
+
+
+def _filas_periodos(periodos, metricas):
+    """ResultsByTime -> filas [(inicio_periodo, claves, {metrica: µ¢})]"""
+    filas = []
+    for periodo in periodos:
+        for grupo in periodo['Groups']:
+            valores = {m: importe(grupo['Metrics'][m]['Amount']) for m in metricas}
+            filas.append((periodo['TimePeriod']['Start'], tuple(grupo['Keys']), valores))
+    return filas
+
+
+def _filas_consulta(cliente_ce, consulta, fecha_inicio, fecha_fin, metricas, granularidad, filtro_extra=None):
+    """Filas [(inicio_periodo, claves, {metrica: µ¢})] de una consulta, o None (con aviso) si falla"""
+    params = _params_consulta(consulta, fecha_inicio, fecha_fin, metricas, granularidad, filtro_extra)
+    try:
+        return _filas_periodos(periodos_ce(cliente_ce, **params), metricas)
+    except Exception as e:
+        print(f"   ⚠️  {describir(consulta)}: {e}")
+        return None
+
+
+def _ejecutar_consultas(cliente_ce, trabajos, fecha_inicio, fecha_fin, metricas, granularidad, hilos):
+    """[(consulta, filtro_extra)] -> filas de cada una (None si falla), en el mismo orden
+
+    Con el motor asyncio van todas a la vez; si no, en `hilos` hilos.
+    """
+    if hasattr(cliente_ce, 'periodos_consultas'):
+        resultados = cliente_ce.periodos_consultas(
+            [_params_consulta(c, fecha_inicio, fecha_fin, metricas, granularidad, f) for c, f in trabajos])
+        filas = []
+        for (consulta, _), resultado in zip(trabajos, resultados):
+            if isinstance(resultado, Exception):
+                print(f"   ⚠️  {describir(consulta)}: {resultado}")
+                filas.append(None)
+            else:
+                filas.append(_filas_periodos(resultado, metricas))
+        return filas
+
+    def lanzar(trabajo):
+        consulta, filtro_extra = trabajo
+        return _filas_consulta(cliente_ce, consulta, fecha_inicio, fecha_fin, metricas, granularidad, filtro_extra)
+
+    if hilos <= 1 or len(trabajos) == 1:
+        return [lanzar(t) for t in trabajos]
+    with ThreadPoolExecutor(max_workers=min(hilos, len(trabajos))) as pool:
+        return list(pool.map(lanzar, trabajos))
+
+
+def lotes_etiqueta(valores, lote=LOTE_VALORES_ETIQUETA):
+    """Valores de etiqueta -> lotes ordenados; '' (sin etiqueta) va en su propio lote"""
+    ordenados = sorted(v for v in set(valores) if v)
+    lotes = [ordenados[i:i + lote] for i in range(0, len(ordenados), lote)]
+    if '' in valores:
+        lotes.append([''])
+    return lotes
+
+
+def ejecutar_por_etiqueta(cliente_ce, necesidad, clave, valores, fecha_inicio, fecha_fin, metricas,
+                          granularidad='MONTHLY', lote=LOTE_VALORES_ETIQUETA, hilos=HILOS_CONSULTAS):
+    """Filas de UNA necesidad limitadas en el servidor a `valores` de la etiqueta `clave`
+
+    `clave` ('TAG:Name') debe estar entre las claves de la necesidad. Los lotes
+    no se solapan, así que sus filas se concatenan sin re-agregar. Devuelve
+    las filas con la forma de ejecutar_plan, o None si falla algún lote.
+    """
+    if clave not in necesidad.agrupar:
+        raise ValueError(f"{necesidad.nombre}: no agrupa por {clave}")
+    consulta = Consulta(necesidad.agrupar, necesidad.servicios)
+    lotes = lotes_etiqueta(valores, lote)
+    print(f"🧭 {describir(consulta)}: {len(lotes)} consultas filtradas por {clave[4:]} "
+          f"({len(set(valores))} valores)")
+    if not lotes:
+        return []
+
+    filas_lote = _ejecutar_consultas(cliente_ce, [(consulta, filtro_etiqueta(clave, v)) for v in lotes],
+                                     fecha_inicio, fecha_fin, metricas, granularidad, hilos)
+    if any(filas is None for filas in filas_lote):
+        return None
+    return [fila for filas in filas_lote for fila in filas]
+
+
+def demultiplexar(consulta, necesidad, filas, metricas):
+    """Filas de `consulta` -> filas de `necesidad` (filtro por servicio y re-agregado)"""
+    if filas is None:
+        return None
+    if consulta == Consulta(necesidad.agrupar, necesidad.servicios):
+        return filas
+
+    posicion = {clave: i for i, clave in enumerate(consulta.agrupar)}
+    filtrar = necesidad.servicios is not None and necesidad.servicios != consulta.servicios
+    acumulado = defaultdict(lambda: dict.fromkeys(metricas, 0))
+    for periodo, claves, valores in filas:
+        if filtrar and claves[posicion['SERVICE']] not in necesidad.servicios:
+            continue
+        destino = acumulado[(periodo, tuple(claves[posicion[k]] for k in necesidad.agrupar))]
+        for metrica, valor in valores.items():
+            destino[metrica] += valor
+    return [(periodo, claves, valores) for (periodo, claves), valores in acumulado.items()]
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Presupuesto de filas por hoja (--max-filas, --desborde)
+=======================================================
+Excel admite 1.048.576 filas por hoja. Las hojas que repiten el Name en
+cada fila (EC2 en el informe por servicio, 'Detalle de Costos' con su fila
+de total, una por servicio y una en blanco por Name) se acercan al límite en
+las cuentas más grandes y el libro deja de abrirse.
+
+Las filas se reparten en bloques (un Name con todas sus filas) y nunca se
+parte un bloque:
+
+- 'hojas' (por defecto): hojas de continuación "EC2 (2)", "EC2 (3)"...
+- 'csv': la hoja llega hasta el presupuesto y la cola larga (los Names de
+  menor coste) va a un CSV junto al Excel (<output>_<hoja>.csv); la hoja
+  termina con una fila de aviso.
+
+Los totales (KPI de cada hoja, Resumen, gráficas) se calculan siempre con
+todos los datos, no con la parte que cabe en la hoja.
+"""
+
+import csv
+import os
+import re
+import sys
+
+LIMITE_FILAS_EXCEL = 1_048_576
+MIN_FILAS = 100  # por debajo no caben las cabeceras y un Name con todos sus servicios
+DESBORDES = ('hojas', 'csv')
+
+
+def paginar(bloques, capacidad):
+    """[(clave, n_filas)] -> [[clave]]: páginas de como mucho `capacidad` filas sin partir bloques
+
+    Un bloque mayor que la capacidad va solo en su página. Siempre hay al
+    menos una página (vacía si no hay bloques).
+    """
+    paginas, actual, usadas = [], [], 0
+    for clave, filas in bloques:
+        if actual and usadas + filas > capacidad:
+            paginas.append(actual)
+            actual, usadas = [], 0
+        actual.append(clave)
+        usadas += filas
+    if actual or not paginas:
+        paginas.append(actual)
+    return paginas
+
+
+def titulo_continuacion(hoja, numero):
+    """'EC2', 2 -> 'EC2 (2)' (máximo 31 caracteres, el límite de Excel)"""
+    sufijo = f' ({numero})'
+    return hoja[:31 - len(sufijo)] + sufijo
+
+
+def ruta_desborde(nombre_archivo, hoja):
+    """CSV de desborde junto al Excel: informe.xlsx, 'Detalle de Costos' -> informe_Detalle_de_Costos.csv"""
+    return f"{os.path.splitext(nombre_archivo)[0]}_{re.sub(r'[^0-9A-Za-z]+', '_', hoja).strip('_')}.csv"
+
+
+def escribir_csv(ruta, cabeceras, filas):
+    with open(ruta, 'w', newline='', encoding='utf-8') as f:
+        escritor = csv.writer(f)
+        escritor.writerow(cabeceras)
+        escritor.writerows(filas)
+    return ruta
+
+
+def nota_desborde(n_names, ruta):
+    return f'… {n_names} Names más (los de menor coste) en {os.path.basename(ruta)}'
+
+
+def validar(args):
+    """--max-filas dentro de los límites de Excel (sale con ❌ si no)"""
+    if not MIN_FILAS <= args.max_filas <= LIMITE_FILAS_EXCEL:
+        print(f"❌ --max-filas debe estar entre {MIN_FILAS} y {LIMITE_FILAS_EXCEL:,}")
+        sys.exit(1)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Previsión de cierre del mes en curso (--prevision)
+==================================================
+Con el mes abierto el informe solo muestra lo gastado hasta hoy. Aquí se
+pide a Cost Explorer (get_cost_forecast) lo que falta hasta fin de mes, del
+total, de cada servicio y de los Top Names, y se suma a lo real:
+
+  previsión fin de mes = real a fecha + previsión de hoy a fin de mes
+
+Para no añadir latencia, las previsiones del total y de los servicios se
+lanzan en hilos ANTES de las consultas de costes reales y corren a la vez
+que ellas (la lista de servicios sale de get_dimension_values, no de los
+costes). La lista de servicios se pide en un hilo aparte que reparte sus
+previsiones en el pool y espera por ellas sin ocupar un hilo del pool. Las
+de los Top Names necesitan el ranking real, así que se lanzan en cuanto
+llegan los costes, también en paralelo entre sí.
+
+Las respuestas se guardan en la caché de disco (ClienteCECache) con la
+regla de caducidad común (ttl_peticion): repetir el informe en las
+siguientes horas no vuelve a pedir (ni pagar) las previsiones.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from consultas_ce import CACHE_TTL_HORAS, DIRECTORIO_CACHE, ClienteCECache
+from dinero import a_dolares, importe
+from ranking import ordenar_por_total, top_n
+
+TOP_NAMES = 15          # como la gráfica Top 15 del Resumen
+HILOS_PREVISION = 4
+METRICA_PREVISION = 'UNBLENDED_COST'  # métrica de get_cost_forecast para UnblendedCost
+OPERACIONES_CACHEADAS = ('get_cost_forecast', 'get_dimension_values')
+
+
+def ventana_prevision(fecha_inicio, fecha_fin, hoy=None):
+    """(desde, hasta) a prever si el periodo está abierto hoy, o None"""
+    hoy = hoy or date.today()
+    if not (date.fromisoformat(fecha_inicio) <= hoy < date.fromisoformat(fecha_fin)):
+        return None
+    # Cost Explorer prevé desde hoy; el último día del mes ya no tiene "resto" útil
+    if hoy + timedelta(days=1) >= date.fromisoformat(fecha_fin):
+        return None
+    return hoy.isoformat(), fecha_fin
+
+
+class PrevisionMes:
+    """Previsiones lanzadas en segundo plano; se recogen con resultados()"""
+
+    def __init__(self, cliente_ce, fecha_inicio, fecha_fin, directorio_cache=DIRECTORIO_CACHE,
+                 ttl_horas=CACHE_TTL_HORAS, hilos=HILOS_PREVISION, hoy=None):
+        self.ventana = ventana_prevision(fecha_inicio, fecha_fin, hoy)
+        self.fecha_inicio, self.fecha_fin = fecha_inicio, fecha_fin
+        self._pool = self._listado = None
+        if self.ventana is None:
+            print("ℹ️  Periodo cerrado: sin previsión de cierre")
+            return
+        self.cliente = ClienteCECache(cliente_ce, directorio_cache, OPERACIONES_CACHEADAS, ttl_horas)
+        self._pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix='prevision')
+        # Espera por las previsiones de servicios fuera del pool (con hilos=1 se bloquearía)
+        self._listado = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prevision-servicios')
+        print(f"🔮 Previsión {self.ventana[0]} a {self.ventana[1]} en segundo plano...")
+        self._total = self._pool.submit(self._prever, None)
+        self._servicios = self._listado.submit(self._prever_servicios)
+
+    def _prever(self, filtro):
+        """Importe previsto (µ¢) de la ventana con el filtro dado, o None si AWS no puede prever"""
+        params = {
+            'TimePeriod': {'Start': self.ventana[0], 'End': self.ventana[1]},
+            'Metric': METRICA_PREVISION,
+            'Granularity': 'MONTHLY',
+        }
+        if filtro:
+            params['Filter'] = filtro
+        try:
+            respuesta = self.cliente.get_cost_forecast(**params)
+        except Exception as e:
+            # DataUnavailableException: poco histórico para prever (Names recientes); no es un error
+            if 'DataUnavailable' not in f'{type(e).__name__} {e}':
+                print(f"   ⚠️  Previsión no disponible ({filtro or 'total'}): {e}")
+            return None
+        return importe(respuesta['Total']['Amount'])
+
+    def _prever_servicios(self):
+        try:
+            respuesta = self.cliente.get_dimension_values(
+                TimePeriod={'Start': self.fecha_inicio, 'End': self.ventana[0]}, Dimension='SERVICE')
+        except Exception as e:
+            print(f"   ⚠️  Sin previsión por servicio: {e}")
+            return {}
+        servicios = [v['Value'] for v in respuesta['DimensionValues']]
+        futuros = {s: self._pool.submit(self._prever, {'Dimensions': {'Key': 'SERVICE', 'Values': [s]}})
+                   for s in servicios}
+        return {s: f.result() for s, f in futuros.items()}
+
+    def resultados(self, costos_base, n_names=TOP_NAMES):
+        """{'total', 'servicios', 'names'} con (real, previsto_resto) en µ¢; None si no hay previsión
+
+        costos_base: {name: {servicio: µ¢}} real a fecha (el del informe).
+        """
+        if self._pool is None:
+            return None
+        real_servicio = {}
+        for servicios in costos_base.values():
+            for servicio, costo in servicios.items():
+                real_servicio[servicio] = real_servicio.get(servicio, 0) + costo
+        real_name = {name: sum(servicios.values()) for name, servicios in costos_base.items()}
+
+        top = [name for name, _ in top_n(real_name, n_names)]
+        futuros = {name: self._pool.submit(self._prever, {'Tags': {
+            'Key': 'Name', 'Values': [''] if name == 'Sin etiqueta' else [name],
+            **({'MatchOptions': ['ABSENT']} if name == 'Sin etiqueta' else {})}}) for name in top}
+        try:
+            previsto_servicio = self._servicios.result()
+            resultado = {
+                'ventana': self.ventana,
+                'total': (sum(real_name.values()), self._total.result()),
+                'servicios': {s: (real_servicio.get(s, 0), previsto_servicio.get(s))
+                              for s, _ in ordenar_por_total(real_servicio)},
+                'names': {name: (real_name[name], futuros[name].result()) for name in top},
+            }
+        finally:
+            self._listado.shutdown(wait=True)
+            self._pool.shutdown(wait=True)
+            self._pool = self._listado = None
+        print(f"🔮 Previsión: {len(resultado['servicios'])} servicios y {len(top)} Names "
+              f"(caché: {self.cliente.aciertos} aciertos, {self.cliente.fallos} peticiones)")
+        real, previsto = resultado['total']
+        if previsto is not None:
+            print(f"   Real a fecha ${a_dolares(real):,.2f} + previsto ${a_dolares(previsto):,.2f} "
+                  f"= cierre estimado ${a_dolares(real + previsto):,.2f}")
+        return resultado
+
+    def cancelar(self):
+        if self._pool is not None:
+            self._listado.shutdown(wait=False, cancel_futures=True)
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = self._listado = None
+
+
+def escribir_hoja_prevision(wb, prevision):
+    """Hoja 'Previsión' (openpyxl): servicios y Top Names con real, resto previsto y cierre"""
+    from openpyxl.styles import Font, PatternFill
+    from openpyxl.utils import get_column_letter
+
+    fill_cabecera = PatternFill(start_color='5B2C6F', end_color='5B2C6F', fill_type='solid')
+    fill_total = PatternFill(start_color='FFD966', end_color='FFD966', fill_type='solid')
+    ws = wb.create_sheet('Previsión')
+    desde, hasta = prevision['ventana']
+    ws['A1'] = f'Previsión de cierre (resto previsto del {desde} al {hasta})'
+    ws['A1'].font = Font(bold=True, size=14)
+
+    def tabla(filas, columna_inicial, titulo):
+        cabeceras = [titulo, 'Real a fecha (US$)', 'Resto previsto (US$)', 'Previsión fin de mes (US$)']
+        for i, texto in enumerate(cabeceras):
+            cell = ws.cell(3, columna_inicial + i, texto)
+            cell.fill = fill_cabecera
+            cell.font = Font(bold=True, color='FFFFFF')
+        real_total, previsto_total = prevision['total']
+        filas = [('*** TOTAL ***', real_total, previsto_total)] + [(k, r, p) for k, (r, p) in filas.items()]
+        for r, (clave, real, previsto) in enumerate(filas, start=4):
+            valores = [clave, a_dolares(real), None if previsto is None else a_dolares(previsto),
+                       None if previsto is None else a_dolares(real + previsto)]
+            for i, valor in enumerate(valores):
+                cell = ws.cell(r, columna_inicial + i, valor)
+                if i:
+                    cell.number_format = '#,##0.00'
+                if r == 4:
+                    cell.fill = fill_total
+                    cell.font = Font(bold=True)
+        for i, ancho in enumerate([42, 18, 20, 24]):
+            ws.column_dimensions[get_column_letter(columna_inicial + i)].width = ancho
+
+    tabla(prevision['servicios'], 1, 'Servicio')
+    tabla(prevision['names'], 6, f'Top {len(prevision["names"])} Names')
+    ws.freeze_panes = 'A4'
+    return ws
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Rankings de costes
+==================
+Los informes ordenan Names, servicios y categorías por su total. Aquí cada
+total se calcula UNA sola vez y se ordena sobre ese valor; las vistas que
+solo necesitan los primeros (Top Names del Resumen, diagnósticos) usan
+selección parcial con un heap en lugar de ordenar la lista completa.
+
+El orden coincide con sorted(..., reverse=True): a igual total se conserva
+el orden de inserción.
+"""
+
+import heapq
+from operator import itemgetter
+
+
+def totales_de(grupos, total=None):
+    """{clave: total} de un diccionario de grupos
+
+    Por defecto cada grupo es {subclave: importe} y su total es la suma;
+    `total` permite otra función (p. ej. lambda info: sum(info['servicios'].values())).
+    """
+    if total is None:
+        return {clave: sum(valores.values()) for clave, valores in grupos.items()}
+    return {clave: total(valores) for clave, valores in grupos.items()}
+
+
+def ordenar_por_total(totales):
+    """[(clave, total)] de mayor a menor"""
+    return sorted(totales.items(), key=itemgetter(1), reverse=True)
+
+
+def top_n(totales, n, clave=itemgetter(1)):
+    """Los n mayores [(clave, total)], sin ordenar el resto (heapq.nlargest)"""
+    return heapq.nlargest(n, totales.items(), key=clave)
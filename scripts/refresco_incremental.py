@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Refresco incremental del mes en curso
+=====================================
+Guarda en disco los costes DIARIOS ya consultados (base, desglose EC2 y Backup)
+y en cada ejecución solo pide a Cost Explorer los días desde la última
+consulta, más una ventana de revisión: Cost Explorer reajusta los importes de
+los últimos días, así que esos días se vuelven a pedir y se sustituyen.
+
+Los días nuevos se fusionan con lo guardado y se devuelven los totales del mes
+con la misma forma que obtener_costos_informe, de modo que el resto del
+informe no cambia.
+"""
+
+import json
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from aws_cost_report import categorizar_desglose, costos_informe_desde_filas, filas_informe
+
+VERSION_ESTADO = 2  # 2: importes en micro-céntimos (enteros)
+VENTANA_REVISION_DIAS = 3
+
+
+def ruta_estado_por_defecto(fecha_inicio):
+    """Fichero de estado por mes: .aws_cost_estado_YYYY-MM.json"""
+    return f'.aws_cost_estado_{fecha_inicio[:7]}.json'
+
+
+def cargar_estado(ruta, fecha_inicio, fecha_fin):
+    """Carga el estado guardado; None si no existe, es de otro periodo o está dañado"""
+    if not os.path.exists(ruta):
+        return None
+    try:
+        with open(ruta, encoding='utf-8') as f:
+            estado = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"⚠️  Estado incremental ilegible ({e}), se hará una consulta completa")
+        return None
+    if estado.get('version') != VERSION_ESTADO:
+        print("⚠️  El estado guardado es de otra versión, se hará una consulta completa")
+        return None
+    if estado.get('periodo') != [fecha_inicio, fecha_fin]:
+        print("⚠️  El estado guardado es de otro periodo, se hará una consulta completa")
+        return None
+    return estado
+
+
+def guardar_estado(ruta, estado):
+    """Escritura atómica (fichero temporal + rename) para no dejar estados a medias"""
+    temporal = f'{ruta}.tmp'
+    with open(temporal, 'w', encoding='utf-8') as f:
+        json.dump(estado, f, ensure_ascii=False)
+    os.replace(temporal, ruta)
+
+
+def _sumar_base(diario):
+    costos = defaultdict(lambda: defaultdict(int))
+    for names in diario.values():
+        for name, servicios in names.items():
+            for servicio, costo in servicios.items():
+                costos[name][servicio] += costo
+    # Mismo criterio que la consulta mensual: solo importes positivos en el mes
+    return defaultdict(lambda: defaultdict(int), {
+        name: defaultdict(int, {s: c for s, c in servicios.items() if c > 0})
+        for name, servicios in costos.items()
+        if any(c > 0 for c in servicios.values())
+    })
+
+
+def _sumar_ec2(diario):
+    por_usage_type = defaultdict(lambda: defaultdict(int))
+    for names in diario.values():
+        for name, usage_types in names.items():
+            for usage_type, costo in usage_types.items():
+                por_usage_type[name][usage_type] += costo
+    return categorizar_desglose(por_usage_type)
+
+
+def _sumar_backup(diario):
+    backup = defaultdict(int)
+    for names in diario.values():
+        for name, costo in names.items():
+            backup[name] += costo
+    return {name: costo for name, costo in backup.items() if costo > 0}
+
+
+def refrescar_mes(cliente_ce, fecha_inicio, fecha_fin, ruta_estado, ventana_dias=VENTANA_REVISION_DIAS):
+    """Actualiza el estado con los días pendientes y devuelve los totales del mes
+
+    Devuelve (costos_base, desglose_ec2, backup_costs) con la misma forma que
+    las funciones de consulta mensual. Backup se refresca siempre, aunque el
+    informe no lo use, para que el estado sirva a los dos scripts. El estado
+    solo se guarda si todas las consultas del refresco responden; si falla la
+    de EC2 o la de Backup se avisa y el fichero se queda como estaba.
+    """
+    estado = cargar_estado(ruta_estado, fecha_inicio, fecha_fin)
+    manana = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+    hasta = min(fecha_fin, manana)
+
+    if estado is None:
+        estado = {'version': VERSION_ESTADO, 'periodo': [fecha_inicio, fecha_fin],
+                  'consultado_hasta': fecha_inicio, 'base': {}, 'ec2': {}, 'backup': {}}
+        desde = fecha_inicio
+    else:
+        revision = datetime.strptime(estado['consultado_hasta'], '%Y-%m-%d') - timedelta(days=ventana_dias)
+        desde = max(fecha_inicio, revision.strftime('%Y-%m-%d'))
+
+    reutilizados = sum(1 for dia in estado['base'] if dia < desde)
+    print(f"♻️  Refresco incremental: {reutilizados} días reutilizados, consultando {desde} → {hasta}")
+
+    if desde < hasta:
+        # Los días de la ventana se sustituyen enteros por la nueva respuesta
+        nuevo = dict(estado, **{clave: {dia: v for dia, v in estado[clave].items() if dia < desde}
+                                for clave in ('base', 'ec2', 'backup')})
+
+        print("📊 Obteniendo costos base, desglose EC2 y AWS Backup...")
+        filas = filas_informe(cliente_ce, desde, hasta, True, None)
+        base, ec2, backup = costos_informe_desde_filas(filas, por_dia=True)
+        nuevo['base'].update(base)
+        nuevo['ec2'].update(ec2)
+        nuevo['backup'].update(backup)
+
+        if filas['ec2'] is None or filas['backup'] is None:
+            # Guardar días sin EC2/Backup los daría por consultados: pasada la
+            # ventana de revisión ya no se volverían a pedir
+            print(f"⚠️  Consultas incompletas: el estado no se actualiza y la próxima ejecución "
+                  f"volverá a pedir desde {desde}")
+        else:
+            nuevo['consultado_hasta'] = hasta
+            guardar_estado(ruta_estado, nuevo)
+        estado = nuevo
+
+    return _sumar_base(estado['base']), _sumar_ec2(estado['ec2']), _sumar_backup(estado['backup'])
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Renderizado de hojas en paralelo (--procesos-excel)
+===================================================
+openpyxl construye y serializa cada hoja en un solo hilo: con muchas hojas
+de servicio el Excel tarda más que las consultas. Aquí cada hoja de datos
+se renderiza en un proceso del pool:
+
+  1. El proceso crea un libro vacío, llama al escritor de la hoja (las
+     mismas funciones escribir_hoja_* del informe) y serializa la hoja a su
+     XML (la parte xl/worksheets/sheetN.xml del .xlsx).
+  2. Devuelve ese XML y sus estilos resueltos (fuente, relleno, borde,
+     formato, alineación...). Los índices de estilo del XML son los de SU
+     libro.
+  3. El proceso principal registra esos estilos en el libro final (una
+     única tabla de estilos compartida), traduce los índices s="N" del XML
+     y lo inserta tal cual al guardar.
+
+El Resumen (con sus gráficas) y las hojas pequeñas se escriben en el
+proceso principal mientras tanto. openpyxl escribe los textos en línea
+(inlineStr), así que no hay tabla de cadenas compartidas que fusionar.
+
+Los pasos 1-3 usan partes internas de openpyxl (tablas de estilos del libro,
+WorksheetWriter, ExcelWriter.write_worksheet). requirements.txt fija la
+versión menor probada; con otra versión, o si faltan esas partes, las hojas
+se escriben en serie en el propio libro (internos_compatibles).
+
+Con caché de hojas (--cache-hojas) cada hoja renderizada se guarda en disco
+con una clave que es el hash de sus datos, sus parámetros de estilo (color,
+título, métricas...) y el código que la escribe. Al regenerar un informe
+solo se renderizan las hojas cuyos datos han cambiado; el resto se toma de
+la caché tal cual.
+"""
+
+import datetime
+import functools
+import gzip
+import hashlib
+import os
+import pickle
+import re
+import sys
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from io import BytesIO
+from zipfile import ZIP_DEFLATED, ZipFile
+
+import openpyxl
+from openpyxl import Workbook
+from openpyxl.packaging.relationship import RelationshipList
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.styles.numbers import BUILTIN_FORMATS, BUILTIN_FORMATS_MAX_SIZE, BUILTIN_FORMATS_REVERSE
+
+try:
+    from openpyxl.worksheet._writer import WorksheetWriter
+    from openpyxl.writer.excel import ExcelWriter
+except ImportError:
+    WorksheetWriter = ExcelWriter = None
+
+# Versiones de openpyxl probadas con el renderizado por XML: [desde, hasta)
+VERSION_MINIMA = (3, 1)
+VERSION_MAXIMA = (3, 2)
+_TABLAS_ESTILO = ('_fonts', '_fills', '_borders', '_number_formats', '_protections', '_alignments', '_cell_styles')
+
+# escritor(wb, *argumentos) crea UNA hoja en wb; debe ser una función de módulo (se envía al proceso)
+Hoja = namedtuple('Hoja', ['escritor', 'argumentos'])
+
+# Índices de estilo en celdas (<c s="N">), filas (<row s="N">) y columnas (<col style="N">)
+_INDICE_ESTILO = re.compile(rb'(<(?:c|row) [^>]*?\bs="|<col [^>]*?\bstyle=")(\d+)"')
+
+
+@functools.lru_cache(maxsize=None)
+def internos_compatibles():
+    """¿Es esta una versión probada de openpyxl y tiene las partes internas que se usan aquí?"""
+    version = tuple(int(n) for n in re.findall(r'\d+', openpyxl.__version__)[:2])
+    if not VERSION_MINIMA <= version < VERSION_MAXIMA or WorksheetWriter is None:
+        return False
+    wb = Workbook()
+    return (all(hasattr(wb, tabla) for tabla in _TABLAS_ESTILO)
+            and all(hasattr(WorksheetWriter, m) for m in ('write', 'read'))
+            and all(hasattr(ExcelWriter, m) for m in ('write_worksheet', 'save')))
+
+
+def plano(valor):
+    """defaultdict anidados (con lambdas, no serializables) -> dict normales"""
+    if isinstance(valor, dict):
+        return {clave: plano(v) for clave, v in valor.items()}
+    return valor
+
+
+def _estilo_resuelto(wb, estilo):
+    """StyleArray (índices del libro) -> tupla de objetos de estilo independiente del libro"""
+    if estilo.numFmtId < BUILTIN_FORMATS_MAX_SIZE:
+        formato = BUILTIN_FORMATS.get(estilo.numFmtId, 'General')
+    else:
+        formato = wb._number_formats[estilo.numFmtId - BUILTIN_FORMATS_MAX_SIZE]
+    return (wb._fonts[estilo.fontId], wb._fills[estilo.fillId], wb._borders[estilo.borderId], formato,
+            wb._protections[estilo.protectionId], wb._alignments[estilo.alignmentId],
+            estilo.pivotButton, estilo.quotePrefix, estilo.xfId)
+
+
+def _registrar_estilo(wb, resuelto):
+    """Tupla de _estilo_resuelto -> índice del estilo en el libro final"""
+    font, fill, border, formato, protection, alignment, pivot, quote, xf = resuelto
+    if formato in BUILTIN_FORMATS_REVERSE:
+        formato_id = BUILTIN_FORMATS_REVERSE[formato]
+    else:
+        formato_id = wb._number_formats.add(formato) + BUILTIN_FORMATS_MAX_SIZE
+    return wb._cell_styles.add(StyleArray([
+        wb._fonts.add(font), wb._fills.add(fill), wb._borders.add(border), formato_id,
+        wb._protections.add(protection), wb._alignments.add(alignment), pivot, quote, xf,
+    ]))
+
+
+def renderizar_hoja(trabajo):
+    """(En el proceso) Hoja -> (título, XML de la hoja, estilos resueltos, rango del autofiltro)"""
+    wb = Workbook()
+    wb.remove(wb.active)
+    trabajo.escritor(wb, *trabajo.argumentos)
+    ws = wb.worksheets[0]
+    ws.sheet_view.tabSelected = None  # solo la hoja activa del libro final va seleccionada
+    escritor = WorksheetWriter(ws, out=BytesIO())
+    escritor.write()
+    return ws.title, escritor.read(), [_estilo_resuelto(wb, e) for e in wb._cell_styles], ws.auto_filter.ref
+
+
+def _reindexar(xml, mapa):
+    if mapa == list(range(len(mapa))):
+        return xml
+    return _INDICE_ESTILO.sub(lambda m: m.group(1) + str(mapa[int(m.group(2))]).encode() + b'"', xml)
+
+
+def incorporar(wb, renderizada):
+    """Añade al libro una hoja renderizada en otro proceso (se escribe al guardar con guardar())"""
+    titulo, xml, estilos, autofiltro = renderizada
+    ws = wb.create_sheet(titulo)
+    ws._xml_renderizado = _reindexar(xml, [_registrar_estilo(wb, e) for e in estilos])
+    # El nombre definido _FilterDatabase de workbook.xml sale del autofiltro de la hoja
+    ws.auto_filter.ref = autofiltro
+    return ws
+
+
+def _ordenado(valor):
+    """Forma canónica de los datos de una hoja (dicts ordenados por clave) para el hash"""
+    if isinstance(valor, dict):
+        return sorted(((repr(k), _ordenado(v)) for k, v in valor.items()), key=lambda kv: kv[0])
+    if isinstance(valor, (list, tuple)):
+        return [_ordenado(v) for v in valor]
+    return valor
+
+
+def _huella_codigo(escritor):
+    """Hash del código que da estilo a las hojas: los módulos cargados de la carpeta del escritor y openpyxl"""
+    carpeta = os.path.dirname(os.path.abspath(sys.modules[escritor.__module__].__file__))
+    ficheros = {os.path.abspath(m.__file__) for m in list(sys.modules.values())
+                if getattr(m, '__file__', None) and m.__file__.endswith('.py')}
+    h = hashlib.sha256(openpyxl.__version__.encode())
+    for ruta in sorted(f for f in ficheros if os.path.dirname(f) == carpeta):
+        with open(ruta, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def clave_hoja(trabajo, huella):
+    """Identificador de la hoja renderizada: hash de sus datos, parámetros de estilo y código"""
+    canonico = repr([trabajo.escritor.__qualname__, _ordenado(trabajo.argumentos), huella])
+    return f"hoja-{hashlib.sha256(canonico.encode('utf-8')).hexdigest()[:24]}"
+
+
+class CacheHojas:
+    """Hojas renderizadas en disco (<clave>.pkl.gz), direccionadas por su contenido
+
+    Una hoja con los mismos datos y el mismo código de estilos tiene la misma
+    clave, así que nunca caduca: si algo cambia, cambia la clave.
+    """
+
+    def __init__(self, directorio):
+        self.directorio = directorio
+        self.aciertos = 0
+        self.fallos = 0
+        self._huellas = {}  # escritor -> huella del código
+        os.makedirs(directorio, exist_ok=True)
+
+    def _ruta(self, trabajo):
+        escritor = trabajo.escritor
+        if escritor not in self._huellas:
+            self._huellas[escritor] = _huella_codigo(escritor)
+        return os.path.join(self.directorio, f'{clave_hoja(trabajo, self._huellas[escritor])}.pkl.gz')
+
+    def leer(self, trabajo):
+        ruta = self._ruta(trabajo)
+        if not os.path.exists(ruta):
+            self.fallos += 1
+            return None
+        with gzip.open(ruta, 'rb') as f:
+            renderizada = pickle.load(f)
+        self.aciertos += 1
+        return renderizada
+
+    def guardar(self, trabajo, renderizada):
+        ruta = self._ruta(trabajo)
+        temporal = f'{ruta}.{os.getpid()}.tmp'
+        with gzip.open(temporal, 'wb') as f:
+            pickle.dump(renderizada, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporal, ruta)
+
+
+class Renderizador:
+    """Renderiza las hojas en un pool de procesos y/o desde la caché de hojas
+
+    lanzar() al principio, recoger() cuando toque añadirlas al libro. Sin
+    procesos ni caché las hojas se escriben directamente en el libro.
+    """
+
+    def __init__(self, trabajos, procesos=None, directorio_cache=None):
+        self.trabajos = list(trabajos)
+        self.procesos = procesos or os.cpu_count() or 1
+        self.cache = CacheHojas(directorio_cache) if directorio_cache else None
+        self._pool = None
+        self._resultados = []
+
+    def lanzar(self):
+        if (self.cache is not None or self.procesos > 1) and not internos_compatibles():
+            print(f"   ⚠️  openpyxl {openpyxl.__version__} no es una versión probada para --procesos-excel/"
+                  f"--cache-hojas: las hojas se escriben en serie")
+            self.cache, self.procesos = None, 1
+        if self.cache is None and self.procesos <= 1:
+            return self
+        # Para enviarlas a los procesos (y guardarlas) las hojas no pueden llevar defaultdict con lambdas
+        self.trabajos = [Hoja(t.escritor, tuple(map(plano, t.argumentos))) for t in self.trabajos]
+        if self.cache is not None:
+            self._resultados = [self.cache.leer(t) for t in self.trabajos]
+            print(f"   → Caché de hojas: {self.cache.aciertos} reutilizadas, {self.cache.fallos} por renderizar")
+        else:
+            self._resultados = [None] * len(self.trabajos)
+        pendientes = self._resultados.count(None)
+        procesos = min(self.procesos, pendientes)
+        if procesos > 1:
+            print(f"   → {pendientes} hojas renderizándose en {procesos} procesos")
+            self._pool = ProcessPoolExecutor(max_workers=procesos)
+            self._resultados = [self._pool.submit(renderizar_hoja, t) if r is None else r
+                                for t, r in zip(self.trabajos, self._resultados)]
+        return self
+
+    def recoger(self, wb):
+        """Añade las hojas al libro en el orden de los trabajos"""
+        if not self._resultados:
+            for trabajo in self.trabajos:
+                trabajo.escritor(wb, *trabajo.argumentos)
+            return
+        try:
+            for trabajo, resultado in zip(self.trabajos, self._resultados):
+                if resultado is None or isinstance(resultado, Future):
+                    resultado = renderizar_hoja(trabajo) if resultado is None else resultado.result()
+                    if self.cache is not None:
+                        self.cache.guardar(trabajo, resultado)
+                incorporar(wb, resultado)
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+if ExcelWriter is not None:
+    class _EscritorLibro(ExcelWriter):
+        """ExcelWriter que inserta el XML ya renderizado de las hojas incorporadas"""
+
+        def write_worksheet(self, ws):
+            xml = getattr(ws, '_xml_renderizado', None)
+            if xml is None:
+                return super().write_worksheet(ws)
+            ws._drawing = None
+            ws._rels = RelationshipList()
+            self._archive.writestr(ws.path[1:], xml)
+            self.manifest.append(ws)
+
+
+def guardar(wb, ruta):
+    """Como Workbook.save(), válido también para libros con hojas incorporadas"""
+    if not internos_compatibles():
+        wb.save(ruta)  # no hay hojas incorporadas: Renderizador las ha escrito en serie
+        return
+    archivo = ZipFile(ruta, 'w', ZIP_DEFLATED, allowZip64=True)
+    wb.properties.modified = datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+    _EscritorLibro(wb, archivo).save()
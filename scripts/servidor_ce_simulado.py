@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Servidor simulado de Cost Explorer (pruebas locales, sin AWS ni coste)
+======================================================================
+Habla el protocolo JSON de la API real (POST con X-Amz-Target
+AWSInsightsIndexService.<Operación>) sobre un dataset sintético y
+determinista, para ejecutar los informes contra él con --endpoint-url con
+cualquiera de los dos motores (hilos o --motor async) y comparar:
+
+    python servidor_ce_simulado.py --puerto 8123 --names 3000 --latencia 0.2 --limitacion 0.05
+
+    export AWS_ACCESS_KEY_ID=prueba AWS_SECRET_ACCESS_KEY=prueba
+    python aws_cost_report.py --mes 10 --anio 2024 --endpoint-url http://127.0.0.1:8123 \\
+        --motor async --fragmentos 200 --output async.xlsx
+    python aws_cost_report.py --mes 10 --anio 2024 --endpoint-url http://127.0.0.1:8123 \\
+        --fragmentos 200 --output hilos.xlsx
+
+Implementa GetCostAndUsage (GroupBy de hasta dos claves, filtros Dimensions,
+Tags con Values o ABSENT, And/Or/Not, granularidad DAILY y MONTHLY,
+paginación con NextPageToken), GetTags y GetDimensionValues; el resto de
+operaciones responde un error como la API. Exige la cabecera Authorization
+(firma SigV4), aunque no la verifica.
+
+--latencia simula el tiempo de respuesta de la API y --limitacion responde
+LimitExceededException a esa fracción de peticiones, para probar los
+reintentos. Al terminar (Ctrl+C o kill) muestra las peticiones servidas y el
+máximo de peticiones atendidas a la vez.
+"""
+
+import argparse
+import json
+import random
+import signal
+import threading
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SERVICIOS = {  # servicio: tipos de uso
+    'Amazon Elastic Compute Cloud - Compute': ['EUW1-BoxUsage:t3.large', 'EUW1-BoxUsage:t3.micro'],
+    'EC2 - Other': ['EUW1-EBS:VolumeUsage.gp3', 'EUW1-NatGateway-Hours', 'EUW1-DataTransfer-Out-Bytes',
+                    'EUW1-EBS:SnapshotUsage'],
+    'Amazon Elastic Block Store': ['EUW1-EBS:VolumeUsage.gp2'],
+    'AWS Backup': ['EUW1-WarmStorage-ByteHrs'],
+    'Amazon Simple Storage Service': ['EUW1-TimedStorage-ByteHrs', 'EUW1-Requests-Tier1'],
+    'Amazon Relational Database Service': ['EUW1-InstanceUsage:db.t3.medium'],
+    'Amazon CloudWatch': ['EUW1-CW:MetricMonitorUsage'],
+    'AWS Lambda': ['EUW1-Lambda-GB-Second'],
+    'Amazon Route 53': ['HostedZone'],
+    'Tax': ['Tax'],
+}
+GRUPOS = ['Web', 'DB', 'Red', '']
+REGIONES = ['eu-west-1', 'us-east-1']
+CUENTAS = ['111111111111', '222222222222']
+FACTORES_METRICA = {'UnblendedCost': 1.0, 'AmortizedCost': 1.1, 'NetUnblendedCost': 0.95, 'UsageQuantity': 3.0}
+
+
+class ErrorAPI(Exception):
+    def __init__(self, codigo, mensaje, estado=400):
+        super().__init__(mensaje)
+        self.codigo = codigo
+        self.estado = estado
+
+
+def crear_dataset(n_names, semilla=7):
+    """[(dimensiones, etiquetas, importe diario)] con un registro por Name, servicio y tipo de uso"""
+    rnd = random.Random(semilla)
+    registros = []
+    for i in range(n_names + 1):
+        name = f'srv-{i:05d}' if i < n_names else ''  # el último: recursos sin etiqueta
+        etiquetas = {'Name': name, 'ServerGroup': rnd.choice(GRUPOS) if name else ''}
+        region, cuenta = rnd.choice(REGIONES), rnd.choice(CUENTAS)
+        for servicio in rnd.sample(sorted(SERVICIOS), rnd.randint(2, 6)):
+            for tipo_uso in SERVICIOS[servicio]:
+                if rnd.random() < 0.3:
+                    continue
+                dimensiones = {'SERVICE': servicio, 'USAGE_TYPE': tipo_uso, 'REGION': region,
+                               'LINKED_ACCOUNT': cuenta}
+                registros.append((dimensiones, etiquetas, rnd.uniform(0.01, 30)))
+    return registros
+
+
+def factor_dia(dia):
+    """Variación diaria determinista (entre 0,75 y 1,25) común a todos los registros"""
+    return 0.75 + ((dia.toordinal() * 2654435761) % 1000) / 2000
+
+
+def periodos(inicio, fin, granularidad):
+    """[(inicio, fin)] de cada periodo DAILY o MONTHLY en [inicio, fin)"""
+    resultado, dia = [], inicio
+    while dia < fin:
+        if granularidad == 'DAILY':
+            siguiente = dia + timedelta(days=1)
+        else:
+            siguiente = min(date(dia.year + dia.month // 12, dia.month % 12 + 1, 1), fin)
+        resultado.append((dia, siguiente))
+        dia = siguiente
+    return resultado
+
+
+def cumple(registro, filtro):
+    if not filtro:
+        return True
+    dimensiones, etiquetas, _ = registro
+    if 'And' in filtro:
+        return all(cumple(registro, f) for f in filtro['And'])
+    if 'Or' in filtro:
+        return any(cumple(registro, f) for f in filtro['Or'])
+    if 'Not' in filtro:
+        return not cumple(registro, filtro['Not'])
+    if 'Dimensions' in filtro:
+        return dimensiones.get(filtro['Dimensions']['Key']) in filtro['Dimensions']['Values']
+    if 'Tags' in filtro:
+        valor = etiquetas.get(filtro['Tags']['Key'], '')
+        if 'ABSENT' in filtro['Tags'].get('MatchOptions', []):
+            return valor == ''
+        return valor in filtro['Tags']['Values']
+    raise ErrorAPI('ValidationException', f'Filtro no soportado: {sorted(filtro)}')
+
+
+class CostExplorerSimulado:
+    def __init__(self, registros, pagina=100):
+        self.registros = registros
+        self.pagina = pagina
+
+    @staticmethod
+    def _rango(params):
+        periodo = params['TimePeriod']
+        inicio, fin = date.fromisoformat(periodo['Start']), date.fromisoformat(periodo['End'])
+        if fin <= inicio:
+            raise ErrorAPI('ValidationException', 'Start debe ser anterior a End')
+        return inicio, fin
+
+    @staticmethod
+    def _paginar(elementos, params, tamano):
+        inicio = int(params.get('NextPageToken') or 0)
+        fin = inicio + tamano
+        return elementos[inicio:fin], (str(fin) if fin < len(elementos) else None)
+
+    def get_cost_and_usage(self, params):
+        inicio, fin = self._rango(params)
+        metricas = params['Metrics']
+        agrupar = params.get('GroupBy', [])
+        if len(agrupar) > 2:
+            raise ErrorAPI('ValidationException', 'GroupBy admite como máximo 2 claves')
+        if any(m not in FACTORES_METRICA for m in metricas):
+            raise ErrorAPI('ValidationException', f'Métrica no soportada: {metricas}')
+        filtrados = [r for r in self.registros if cumple(r, params.get('Filter'))]
+
+        resultados, planos = [], []  # planos: (índice del periodo, grupo o None) para paginar
+        for a, b in periodos(inicio, fin, params['Granularity']):
+            factor = sum(factor_dia(a + timedelta(days=d)) for d in range((b - a).days))
+            grupos = defaultdict(float)
+            for dimensiones, etiquetas, diario in filtrados:
+                claves = tuple(f"{g['Key']}${etiquetas.get(g['Key'], '')}" if g['Type'] == 'TAG'
+                               else dimensiones[g['Key']] for g in agrupar)
+                grupos[claves] += diario * factor
+
+            def valores(importe):
+                return {m: {'Amount': repr(round(importe * FACTORES_METRICA[m], 10)),
+                            'Unit': 'N/A' if m == 'UsageQuantity' else 'USD'} for m in metricas}
+            resultados.append({'TimePeriod': {'Start': a.isoformat(), 'End': b.isoformat()},
+                               'Total': {} if agrupar else valores(sum(grupos.values())),
+                               'Groups': [], 'Estimated': False})
+            if agrupar:
+                planos.extend((len(resultados) - 1, {'Keys': list(k), 'Metrics': valores(v)})
+                              for k, v in sorted(grupos.items()))
+            else:
+                planos.append((len(resultados) - 1, None))
+
+        pagina, token = self._paginar(planos, params, self.pagina)
+        por_periodo = {}
+        for indice, grupo in pagina:
+            periodo = por_periodo.setdefault(indice, dict(resultados[indice], Groups=[]))
+            if grupo:
+                periodo['Groups'].append(grupo)
+        respuesta = {'ResultsByTime': list(por_periodo.values()), 'DimensionValueAttributes': [],
+                     'GroupDefinitions': agrupar}
+        if token:
+            respuesta['NextPageToken'] = token
+        return respuesta
+
+    def get_tags(self, params):
+        self._rango(params)
+        valores = sorted({etiquetas.get(params.get('TagKey'), '') for _, etiquetas, _ in self.registros} - {''})
+        pagina, token = self._paginar(valores, params, self.pagina * 10)
+        respuesta = {'Tags': pagina, 'ReturnSize': len(pagina), 'TotalSize': len(valores)}
+        if token:
+            respuesta['NextPageToken'] = token
+        return respuesta
+
+    def get_dimension_values(self, params):
+        self._rango(params)
+        valores = sorted({dimensiones.get(params['Dimension']) for dimensiones, _, _ in self.registros} - {None})
+        return {'DimensionValues': [{'Value': v, 'Attributes': {}} for v in valores],
+                'ReturnSize': len(valores), 'TotalSize': len(valores)}
+
+
+def crear_servidor(puerto, ce, latencia=0.0, limitacion=0.0, anfitrion='127.0.0.1'):
+    """ThreadingHTTPServer (keep-alive) que sirve `ce`; .estadisticas con peticiones y concurrencia"""
+    estadisticas = {'peticiones': 0, 'limitadas': 0, 'en_curso': 0, 'max_simultaneas': 0}
+    cerrojo = threading.Lock()
+    operaciones = {'GetCostAndUsage': ce.get_cost_and_usage, 'GetTags': ce.get_tags,
+                   'GetDimensionValues': ce.get_dimension_values}
+
+    class Manejador(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _responder(self, estado, cuerpo):
+            datos = json.dumps(cuerpo).encode('utf-8')
+            self.send_response(estado)
+            self.send_header('Content-Type', 'application/x-amz-json-1.1')
+            self.send_header('Content-Length', str(len(datos)))
+            self.end_headers()
+            self.wfile.write(datos)
+
+        def do_POST(self):
+            params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            with cerrojo:
+                estadisticas['peticiones'] += 1
+                estadisticas['en_curso'] += 1
+                estadisticas['max_simultaneas'] = max(estadisticas['max_simultaneas'], estadisticas['en_curso'])
+            try:
+                if latencia:
+                    time.sleep(latencia * random.uniform(0.5, 1.5))
+                if 'Authorization' not in self.headers:
+                    raise ErrorAPI('MissingAuthenticationTokenException', 'Petición sin firmar', 403)
+                operacion = self.headers.get('X-Amz-Target', '').rpartition('.')[2]
+                if operacion not in operaciones:
+                    raise ErrorAPI('UnknownOperationException', f'Operación no simulada: {operacion}')
+                if random.random() < limitacion:
+                    with cerrojo:
+                        estadisticas['limitadas'] += 1
+                    raise ErrorAPI('LimitExceededException', 'Rate exceeded')
+                self._responder(200, operaciones[operacion](params))
+            except ErrorAPI as e:
+                self._responder(e.estado, {'__type': e.codigo, 'message': str(e)})
+            except (KeyError, ValueError) as e:
+                self._responder(400, {'__type': 'ValidationException', 'message': f'Parámetro no válido: {e}'})
+            finally:
+                with cerrojo:
+                    estadisticas['en_curso'] -= 1
+
+    ThreadingHTTPServer.request_queue_size = 1024  # cientos de conexiones a la vez
+    servidor = ThreadingHTTPServer((anfitrion, puerto), Manejador)
+    servidor.daemon_threads = True
+    servidor.estadisticas = estadisticas
+    return servidor
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Servidor simulado de Cost Explorer para pruebas locales')
+    parser.add_argument('--puerto', type=int, default=8123, help='Puerto (default: 8123)')
+    parser.add_argument('--names', type=int, default=500, help='Names del dataset sintético (default: 500)')
+    parser.add_argument('--semilla', type=int, default=7, help='Semilla del dataset (default: 7)')
+    parser.add_argument('--pagina', type=int, default=100, help='Grupos por página (default: 100)')
+    parser.add_argument('--latencia', type=float, default=0.0, help='Segundos de respuesta por petición (±50%%)')
+    parser.add_argument('--limitacion', type=float, default=0.0,
+                        help='Fracción de peticiones que responden LimitExceededException (0-1)')
+    args = parser.parse_args()
+
+    registros = crear_dataset(args.names, args.semilla)
+    servidor = crear_servidor(args.puerto, CostExplorerSimulado(registros, args.pagina), args.latencia,
+                              args.limitacion)
+    print(f"🧪 Cost Explorer simulado en http://127.0.0.1:{args.puerto} "
+          f"({args.names} Names, {len(registros)} registros; Ctrl+C para terminar)", flush=True)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # kill: como Ctrl+C, con estadísticas
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+        e = servidor.estadisticas
+        print(f"\n📊 {e['peticiones']} peticiones ({e['limitadas']} limitadas), "
+              f"máximo {e['max_simultaneas']} simultáneas")
+
+
+if __name__ == '__main__':
+    main()
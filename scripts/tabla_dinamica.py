@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Tablas dinámicas nativas de Excel (--tabla-dinamica)
+====================================================
+En lugar de expandir cada vista en filas ('Detalle de Costos' repite un
+bloque por Name con una fila por servicio), el dataset normalizado se
+escribe una sola vez en la hoja 'Datos' (una fila por Name y servicio o
+categoría EC2) y encima se definen tablas dinámicas de Excel que comparten
+la misma caché:
+
+  - 'Por Name':     filas Name, suma del coste
+  - 'Por Servicio': filas Grupo > Servicio (EC2 se abre en sus categorías)
+
+La caché (pivotCacheDefinition + pivotCacheRecords) lleva los registros ya
+indexados y las tablas su disposición calculada, así que el libro se ve bien
+sin actualizar; con refreshOnLoad Excel la recalcula al abrir y el usuario
+puede reordenar, filtrar o cambiar campos sin regenerar el informe.
+"""
+
+from datetime import datetime
+from xml.sax.saxutils import quoteattr
+
+from openpyxl.pivot.cache import CacheDefinition, CacheField, CacheSource, SharedItems, WorksheetSource
+from openpyxl.pivot.fields import Index, Text
+from openpyxl.pivot.record import RecordList
+from openpyxl.pivot.table import (DataField, FieldItem, Location, PivotField, PivotTableStyle, RowColField,
+                                  RowColItem, TableDefinition)
+from openpyxl.styles import Font, PatternFill
+
+from dinero import a_dolares
+from ranking import ordenar_por_total
+
+HOJA_DATOS = 'Datos'
+GRUPO_EC2 = 'EC2'
+CAMPOS = ['Name', 'Grupo', 'Servicio', 'Costo (US$)']
+NAME, GRUPO, SERVICIO, COSTO = range(4)
+FORMATO_MONEDA = 4  # '#,##0.00' (formato integrado de Excel)
+ESTILO = 'PivotStyleMedium9'
+
+
+def grupo_de(servicio):
+    """Las categorías del desglose EC2 ('EC2 - ...') se agrupan bajo EC2; el resto es su propio grupo"""
+    return GRUPO_EC2 if servicio.startswith('EC2 - ') else servicio
+
+
+def filas_dataset(datos, metricas_extra, columnas_extra):
+    """(name, grupo, servicio, costo US$, *métricas) por Name y servicio, de mayor a menor coste"""
+    totales = {name: sum(info['servicios'].values()) for name, info in datos.items()}
+    for name, _ in ordenar_por_total(totales):
+        for servicio, costo in ordenar_por_total(datos[name]['servicios']):
+            extras = [a_dolares(metricas_extra[m][name]['servicios'].get(servicio, 0)
+                                if name in metricas_extra[m] else 0) for m in columnas_extra]
+            yield (name, grupo_de(servicio), servicio, a_dolares(costo), *extras)
+
+
+class _Registros(RecordList):
+    """pivotCacheRecords escrito directamente como texto (una fila <r> por registro del dataset)
+
+    Con cientos de miles de registros, construir un objeto openpyxl por
+    valor es mucho más lento que el propio XML.
+    """
+
+    def __init__(self, filas, indices):
+        super().__init__()
+        self._filas = filas
+        self._indices = indices  # por campo de texto: {valor: posición en sharedItems}
+
+    @property
+    def count(self):
+        return len(self._filas)
+
+    def _write(self, archive, manifest):
+        partes = [f'<pivotCacheRecords xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+                  f'count="{len(self._filas)}">']
+        for fila in self._filas:
+            celdas = [f'<x v="{self._indices[i][v]}"/>' if i in self._indices else f'<n v={quoteattr(repr(v))}/>'
+                      for i, v in enumerate(fila)]
+            partes.append(f"<r>{''.join(celdas)}</r>")
+        partes.append('</pivotCacheRecords>')
+        archive.writestr(self.path[1:], ''.join(partes).encode('utf-8'))
+        manifest.append(self)
+
+
+def _cache(filas, campos, ref):
+    """CacheDefinition con los valores de texto indexados (sharedItems) y los registros"""
+    indices, cache_fields = {}, []
+    for i, campo in enumerate(campos):
+        if i in (NAME, GRUPO, SERVICIO):
+            valores = list(dict.fromkeys(fila[i] for fila in filas))
+            indices[i] = {v: j for j, v in enumerate(valores)}
+            compartidos = SharedItems(_fields=[Text(v=v) for v in valores])
+        else:
+            numeros = [fila[i] for fila in filas] or [0]
+            compartidos = SharedItems(containsSemiMixedTypes=False, containsString=False, containsNumber=True,
+                                      minValue=min(numeros), maxValue=max(numeros))
+        cache_fields.append(CacheField(name=campo, numFmtId=0, sharedItems=compartidos))
+    cache = CacheDefinition(
+        refreshOnLoad=True, refreshedBy='aws_cost_report', refreshedDate=datetime.now().timestamp() / 86400 + 25569,
+        createdVersion=6, refreshedVersion=6, minRefreshableVersion=3, recordCount=len(filas),
+        cacheSource=CacheSource(type='worksheet', worksheetSource=WorksheetSource(ref=ref, sheet=HOJA_DATOS)),
+        cacheFields=cache_fields)
+    cache.records = _Registros(filas, indices)
+    # openpyxl reconoce la caché compartida por su hash, que incluye `id`: se fija ya a la relación
+    # que le asignará al escribirla para que las dos tablas apunten a la misma
+    cache.id = 'rId1'
+    return cache, indices
+
+
+def _tabla(ws, nombre, cache, indices, filas, niveles, n_campos, encabezado):
+    """Tabla dinámica en A3 de `ws` con los campos `niveles` en filas (compacta) y la suma del coste
+
+    Las celdas se rellenan con el resultado (mismo orden: de mayor a menor
+    coste) para que la hoja se vea también en visores que no recalculan.
+    """
+    totales = [{} for _ in niveles]
+    for fila in filas:
+        for n, campo in enumerate(niveles):
+            clave = tuple(fila[c] for c in niveles[:n + 1])
+            totales[n][clave] = totales[n].get(clave, 0) + fila[COSTO]
+
+    # Filas de la tabla: cada nivel bajo su padre, de mayor a menor coste
+    salida = []  # (nivel, clave)
+
+    def expandir(n, padre):
+        hijos = [(clave, total) for clave, total in totales[n].items() if clave[:n] == padre]
+        for clave, _ in sorted(hijos, key=lambda kv: kv[1], reverse=True):
+            salida.append((n, clave))
+            if n + 1 < len(niveles):
+                expandir(n + 1, clave)
+    expandir(0, ())
+
+    orden = {}  # campo -> valores en el orden en que aparecen en la tabla
+    for n, clave in salida:
+        orden.setdefault(niveles[n], {})[clave[-1]] = None
+    campos = []
+    for i in range(n_campos):
+        if i in niveles:
+            items = [FieldItem(x=indices[i][v]) for v in orden[i]] + [FieldItem(t='default')]
+            campos.append(PivotField(axis='axisRow', showAll=False, items=items))
+        else:
+            campos.append(PivotField(dataField=True if i == COSTO else None, showAll=False))
+
+    fila_items = [RowColItem(r=n, x=[Index(v=indices[niveles[n]][clave[-1]])]) for n, clave in salida]
+    fila_items.append(RowColItem(t='grand', x=[Index()]))
+    ultima = 3 + len(fila_items)
+    tabla = TableDefinition(
+        name=nombre, cacheId=1, dataCaption='Valores', grandTotalCaption='Total general',
+        rowHeaderCaption=encabezado, updatedVersion=6, minRefreshableVersion=3, createdVersion=6,
+        useAutoFormatting=True, itemPrintTitles=True, indent=0, outline=True, outlineData=True,
+        multipleFieldFilters=False, applyNumberFormats=False,
+        location=Location(ref=f'A3:B{ultima}', firstHeaderRow=1, firstDataRow=1, firstDataCol=1),
+        pivotFields=campos, rowFields=[RowColField(x=campo) for campo in niveles], rowItems=fila_items,
+        colItems=[RowColItem()],
+        dataFields=[DataField(name=f'Suma de {CAMPOS[COSTO]}', fld=COSTO, baseField=0, baseItem=0,
+                              numFmtId=FORMATO_MONEDA)],
+        pivotTableStyleInfo=PivotTableStyle(name=ESTILO, showRowHeaders=True, showColHeaders=True,
+                                            showRowStripes=False, showColStripes=False, showLastColumn=True))
+    tabla.cache = cache
+    ws._pivots.append(tabla)
+
+    # Resultado en las celdas
+    ws['A3'] = encabezado
+    ws['B3'] = f'Suma de {CAMPOS[COSTO]}'
+    for r, (n, clave) in enumerate(salida, start=4):
+        ws.cell(r, 1, clave[-1])
+        ws.cell(r, 2, round(totales[n][clave], 2)).number_format = '#,##0.00'
+        if n + 1 < len(niveles):
+            ws.cell(r, 1).font = ws.cell(r, 2).font = Font(bold=True)
+    ws.cell(ultima, 1, 'Total general').font = Font(bold=True)
+    total = ws.cell(ultima, 2, round(sum(totales[0].values()), 2))
+    total.number_format = '#,##0.00'
+    total.font = Font(bold=True)
+    ws.column_dimensions['A'].width = 55
+    ws.column_dimensions['B'].width = 22
+
+
+def escribir_tablas_dinamicas(wb, datos, metricas_extra=None, columnas_extra=None, titulo=None):
+    """Hoja 'Datos' y hojas 'Por Name' y 'Por Servicio' con sus tablas dinámicas
+
+    datos: {name: {'servicios': {servicio: µ¢}}} (procesar_datos).
+    metricas_extra / columnas_extra ({metrica: cabecera}): columnas más en el
+    dataset (no en las tablas: se pueden añadir desde Excel).
+    """
+    metricas_extra = metricas_extra or {}
+    columnas_extra = columnas_extra or {}
+    campos = CAMPOS + list(columnas_extra.values())
+    filas = list(filas_dataset(datos, metricas_extra, columnas_extra))
+
+    ws = wb.create_sheet(HOJA_DATOS)
+    ws.append(campos)
+    for fila in filas:
+        ws.append(fila)
+    fill_cabecera = PatternFill(start_color='FFD966', end_color='FFD966', fill_type='solid')
+    for cell in ws[1]:
+        cell.font = Font(bold=True)
+        cell.fill = fill_cabecera
+    for letra, ancho in zip('ABCDEFG', [40, 16, 50, 15, 17, 17, 17]):
+        ws.column_dimensions[letra].width = ancho
+    ws.freeze_panes = 'A2'
+    ref = f'A1:{chr(ord("A") + len(campos) - 1)}{len(filas) + 1}'
+    ws.auto_filter.ref = ref
+
+    cache, indices = _cache(filas, campos, ref)
+    for hoja, nombre, niveles, encabezado in [('Por Name', 'TablaPorName', [NAME], 'Name'),
+                                               ('Por Servicio', 'TablaPorServicio', [GRUPO, SERVICIO], 'Servicio')]:
+        ws_tabla = wb.create_sheet(hoja)
+        if titulo:
+            ws_tabla['A1'] = titulo
+            ws_tabla['A1'].font = Font(bold=True, size=12)
+        _tabla(ws_tabla, nombre, cache, indices, filas, niveles, len(campos), encabezado)
@@ -1,173 +1,233 @@
 #!/usr/bin/env python3
 """
 Script para validar la configuración de AWS y permisos necesarios
+
+Las cuatro comprobaciones (credenciales, permisos de Cost Explorer,
+etiquetas Name y etiquetas AWSBackup) se lanzan a la vez sobre una misma
+sesión; cada una devuelve su resultado y se muestran en orden al terminar.
+Las etiquetas se cuentan con todas las páginas de get_tags.
+
+Las respuestas de Cost Explorer se guardan en la caché de disco
+(ClienteCECache) durante VALIDEZ_CACHE_HORAS: los informes pueden validar
+antes de empezar (--preflight) sin añadir latencia ni coste. Las
+credenciales (STS, sin coste) se comprueban siempre en vivo.
+
+Con --json el resultado se escribe como JSON en la salida estándar.
 """
 
-import boto3
+import argparse
+import json
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import boto3
 from botocore.exceptions import ClientError, NoCredentialsError
 
-def validar_credenciales():
+from consultas_ce import DIRECTORIO_CACHE, ClienteCECache, valores_etiqueta
+
+VALIDEZ_CACHE_HORAS = 1
+DIAS_ETIQUETAS = 30
+VALORES_BACKUP = ['BackupDia', 'BackupSemana', 'BackupMes']
+OPERACIONES_CACHEADAS = ('get_cost_and_usage', 'get_tags')
+
+
+def _periodo(dias):
+    fin = date.today()
+    return (fin - timedelta(days=dias)).isoformat(), fin.isoformat()
+
+
+def _resultado(nombre, critica, ok, lineas, **detalle):
+    return {'comprobacion': nombre, 'critica': critica, 'ok': ok, 'lineas': lineas, 'detalle': detalle}
+
+
+def validar_credenciales(sts):
     """Valida que las credenciales de AWS estén configuradas"""
-    print("🔍 Validando credenciales de AWS...")
     try:
-        session = boto3.Session()
-        sts = session.client('sts')
         identity = sts.get_caller_identity()
-        
-        print("✅ Credenciales válidas")
-        print(f"   Account ID: {identity['Account']}")
-        print(f"   ARN: {identity['Arn']}")
-        print(f"   User ID: {identity['UserId']}")
-        return True
+        return _resultado('credenciales', True, True, [
+            "✅ Credenciales válidas",
+            f"   Account ID: {identity['Account']}",
+            f"   ARN: {identity['Arn']}",
+            f"   User ID: {identity['UserId']}",
+        ], cuenta=identity['Account'], arn=identity['Arn'])
     except NoCredentialsError:
-        print("❌ No se encontraron credenciales de AWS")
-        print("   Ejecuta: aws configure")
-        return False
+        return _resultado('credenciales', True, False, [
+            "❌ No se encontraron credenciales de AWS",
+            "   Ejecuta: aws configure",
+        ])
     except Exception as e:
-        print(f"❌ Error al validar credenciales: {e}")
-        return False
+        return _resultado('credenciales', True, False, [f"❌ Error al validar credenciales: {e}"])
 
-def validar_permisos_cost_explorer():
+
+def validar_permisos_cost_explorer(ce):
     """Valida que el usuario tenga permisos para Cost Explorer"""
-    print("\n🔍 Validando permisos de Cost Explorer...")
+    inicio, fin = _periodo(7)
     try:
-        from datetime import datetime, timedelta
-        
-        ce = boto3.client('ce', region_name='us-east-1')
-        
-        # Intentar una consulta simple
-        end_date = datetime.now().date()
-        start_date = end_date - timedelta(days=7)
-        
         response = ce.get_cost_and_usage(
-            TimePeriod={
-                'Start': start_date.strftime('%Y-%m-%d'),
-                'End': end_date.strftime('%Y-%m-%d')
-            },
+            TimePeriod={'Start': inicio, 'End': fin},
             Granularity='DAILY',
             Metrics=['UnblendedCost']
         )
-        
-        print("✅ Permisos de Cost Explorer configurados correctamente")
-        
-        # Mostrar un ejemplo de costo
-        if response['ResultsByTime']:
-            ultimo_dia = response['ResultsByTime'][-1]
-            costo = float(ultimo_dia['Total']['UnblendedCost']['Amount'])
-            fecha = ultimo_dia['TimePeriod']['Start']
-            print(f"   Último costo registrado: ${costo:.2f} US$ ({fecha})")
-        
-        return True
     except ClientError as e:
-        error_code = e.response['Error']['Code']
-        if error_code == 'AccessDeniedException':
-            print("❌ No tienes permisos para acceder a Cost Explorer")
-            print("   Necesitas los permisos: ce:GetCostAndUsage")
-            print("   Ver archivo: iam_policy.json")
-        else:
-            print(f"❌ Error: {e.response['Error']['Message']}")
-        return False
+        if e.response['Error']['Code'] == 'AccessDeniedException':
+            return _resultado('cost_explorer', True, False, [
+                "❌ No tienes permisos para acceder a Cost Explorer",
+                "   Necesitas los permisos: ce:GetCostAndUsage",
+                "   Ver archivo: iam_policy.json",
+            ], error='AccessDeniedException')
+        return _resultado('cost_explorer', True, False, [f"❌ Error: {e.response['Error']['Message']}"],
+                          error=e.response['Error']['Code'])
     except Exception as e:
-        print(f"❌ Error inesperado: {e}")
-        return False
+        return _resultado('cost_explorer', True, False, [f"❌ Error inesperado: {e}"], error=str(e))
+
+    lineas = ["✅ Permisos de Cost Explorer configurados correctamente"]
+    detalle = {}
+    # Mostrar un ejemplo de costo
+    if response['ResultsByTime']:
+        ultimo_dia = response['ResultsByTime'][-1]
+        costo = float(ultimo_dia['Total']['UnblendedCost']['Amount'])
+        fecha = ultimo_dia['TimePeriod']['Start']
+        lineas.append(f"   Último costo registrado: ${costo:.2f} US$ ({fecha})")
+        detalle = {'ultimo_costo': round(costo, 2), 'fecha': fecha}
+    return _resultado('cost_explorer', True, True, lineas, **detalle)
 
-def validar_etiquetas():
-    """Verifica si hay recursos con etiquetas Name"""
-    print("\n🔍 Verificando recursos con etiqueta Name...")
+
+def validar_etiquetas(ce):
+    """Verifica si hay recursos con etiqueta Name (todas las páginas de get_tags)"""
     try:
-        from datetime import datetime, timedelta
-        
-        ce = boto3.client('ce', region_name='us-east-1')
-        
-        end_date = datetime.now().date()
-        start_date = end_date - timedelta(days=30)
-        
-        response = ce.get_tags(
-            TimePeriod={
-                'Start': start_date.strftime('%Y-%m-%d'),
-                'End': end_date.strftime('%Y-%m-%d')
-            },
-            TagKey='Name'
-        )
-        
-        if response['Tags']:
-            print(f"✅ Se encontraron {len(response['Tags'])} etiquetas Name activas")
-            print("   Ejemplos:")
-            for tag in response['Tags'][:5]:
-                print(f"   - {tag}")
-            if len(response['Tags']) > 5:
-                print(f"   ... y {len(response['Tags']) - 5} más")
-        else:
-            print("⚠️  No se encontraron recursos con etiqueta Name")
-            print("   Asegúrate de etiquetar tus recursos con la clave 'Name'")
-        
-        return True
+        etiquetas = valores_etiqueta(ce, 'Name', *_periodo(DIAS_ETIQUETAS))
     except Exception as e:
-        print(f"⚠️  No se pudieron verificar las etiquetas: {e}")
-        return False
+        return _resultado('etiquetas_name', False, False, [f"⚠️  No se pudieron verificar las etiquetas: {e}"])
+
+    if not etiquetas:
+        return _resultado('etiquetas_name', False, True, [
+            "⚠️  No se encontraron recursos con etiqueta Name",
+            "   Asegúrate de etiquetar tus recursos con la clave 'Name'",
+        ], total=0)
+    lineas = [f"✅ Se encontraron {len(etiquetas)} etiquetas Name activas", "   Ejemplos:"]
+    lineas += [f"   - {tag}" for tag in etiquetas[:5]]
+    if len(etiquetas) > 5:
+        lineas.append(f"   ... y {len(etiquetas) - 5} más")
+    return _resultado('etiquetas_name', False, True, lineas, total=len(etiquetas), ejemplos=etiquetas[:5])
 
-def validar_backup_tags():
+
+def validar_backup_tags(ce):
     """Verifica si hay recursos con etiquetas AWSBackup"""
-    print("\n🔍 Verificando recursos con etiquetas AWS Backup...")
     try:
-        from datetime import datetime, timedelta
-        
-        ce = boto3.client('ce', region_name='us-east-1')
-        
-        end_date = datetime.now().date()
-        start_date = end_date - timedelta(days=30)
-        
-        response = ce.get_tags(
-            TimePeriod={
-                'Start': start_date.strftime('%Y-%m-%d'),
-                'End': end_date.strftime('%Y-%m-%d')
-            },
-            TagKey='AWSBackup'
-        )
-        
-        if response['Tags']:
-            print(f"✅ Se encontraron {len(response['Tags'])} etiquetas AWSBackup")
-            valores_esperados = ['BackupDia', 'BackupSemana', 'BackupMes']
-            for valor in response['Tags']:
-                if valor in valores_esperados:
-                    print(f"   ✓ {valor}")
-        else:
-            print("⚠️  No se encontraron etiquetas AWSBackup")
-            print("   Valores esperados: BackupDia, BackupSemana, BackupMes")
-        
-        return True
+        etiquetas = valores_etiqueta(ce, 'AWSBackup', *_periodo(DIAS_ETIQUETAS))
     except Exception as e:
-        print(f"⚠️  No se pudieron verificar las etiquetas de Backup: {e}")
-        return False
+        return _resultado('etiquetas_backup', False, False,
+                          [f"⚠️  No se pudieron verificar las etiquetas de Backup: {e}"])
+
+    if not etiquetas:
+        return _resultado('etiquetas_backup', False, True, [
+            "⚠️  No se encontraron etiquetas AWSBackup",
+            f"   Valores esperados: {', '.join(VALORES_BACKUP)}",
+        ], valores=[])
+    lineas = [f"✅ Se encontraron {len(etiquetas)} etiquetas AWSBackup"]
+    lineas += [f"   ✓ {valor}" for valor in etiquetas if valor in VALORES_BACKUP]
+    return _resultado('etiquetas_backup', False, True, lineas, valores=etiquetas)
+
+
+def validar(session=None, directorio_cache=DIRECTORIO_CACHE, ttl_horas=VALIDEZ_CACHE_HORAS, cliente_ce=None):
+    """Lanza las comprobaciones en paralelo y devuelve {'valida', 'advertencias', 'comprobaciones'}
+
+    Con directorio_cache=None no se usa la caché. cliente_ce: cliente ya creado
+    (p. ej. el ClienteCEMedido del informe, para que cuente las peticiones).
+    """
+    session = session or boto3.Session()
+    # Clientes creados aquí y compartidos entre hilos (los clientes boto3 lo permiten; la sesión no)
+    try:
+        sts = session.client('sts')
+        ce = cliente_ce or session.client('ce', region_name='us-east-1')
+    except Exception as e:  # perfil inexistente, región sin configurar...
+        return {'valida': False, 'advertencias': False, 'cache': None, 'comprobaciones': [
+            _resultado('credenciales', True, False, [f"❌ Error al validar credenciales: {e}"])]}
+    if directorio_cache:
+        ce = ClienteCECache(ce, directorio_cache, OPERACIONES_CACHEADAS, ttl_horas)
+    tareas = [
+        (validar_credenciales, sts),
+        (validar_permisos_cost_explorer, ce),
+        (validar_etiquetas, ce),
+        (validar_backup_tags, ce),
+    ]
+    with ThreadPoolExecutor(max_workers=len(tareas)) as pool:
+        comprobaciones = list(pool.map(lambda tarea: tarea[0](tarea[1]), tareas))
+    return {
+        'valida': all(c['ok'] for c in comprobaciones if c['critica']),
+        'advertencias': not all(c['ok'] for c in comprobaciones if not c['critica']),
+        'cache': {'aciertos': ce.aciertos, 'peticiones': ce.fallos} if directorio_cache else None,
+        'comprobaciones': comprobaciones,
+    }
+
+
+def imprimir(resultado):
+    titulos = {
+        'credenciales': "🔍 Validando credenciales de AWS...",
+        'cost_explorer': "🔍 Validando permisos de Cost Explorer...",
+        'etiquetas_name': "🔍 Verificando recursos con etiqueta Name...",
+        'etiquetas_backup': "🔍 Verificando recursos con etiquetas AWS Backup...",
+    }
+    for i, comprobacion in enumerate(resultado['comprobaciones']):
+        print(("\n" if i else "") + titulos[comprobacion['comprobacion']])
+        for linea in comprobacion['lineas']:
+            print(linea)
+
+
+def preflight(session, directorio_cache=DIRECTORIO_CACHE, ttl_horas=VALIDEZ_CACHE_HORAS, cliente_ce=None):
+    """Validación previa de los informes (--preflight): resumen de una línea, True si se puede seguir"""
+    resultado = validar(session, directorio_cache, ttl_horas, cliente_ce)
+    fallidas = [c for c in resultado['comprobaciones'] if not c['ok']]
+    if resultado['valida']:
+        print("✅ Validación previa correcta" + (f" ({len(fallidas)} advertencias)" if fallidas else ""))
+    else:
+        print("❌ Validación previa fallida:")
+    for comprobacion in fallidas:
+        print(f"   {comprobacion['lineas'][0]}")
+    return resultado['valida']
+
 
 def main():
+    parser = argparse.ArgumentParser(description='Valida la configuración de AWS para los informes de costes')
+    parser.add_argument('--profile', type=str, help='Perfil AWS')
+    parser.add_argument('--json', action='store_true', help='Escribe el resultado como JSON en la salida estándar')
+    parser.add_argument('--cache', type=str, default=DIRECTORIO_CACHE, metavar='DIR',
+                        help=f'Caché en disco de las respuestas de Cost Explorer (default: {DIRECTORIO_CACHE})')
+    parser.add_argument('--cache-ttl', type=float, default=VALIDEZ_CACHE_HORAS, metavar='HORAS',
+                        help=f'Horas de validez de la caché (default: {VALIDEZ_CACHE_HORAS})')
+    parser.add_argument('--sin-cache', action='store_true', help='Consulta siempre Cost Explorer')
+    args = parser.parse_args()
+
+    session = boto3.Session(profile_name=args.profile) if args.profile else boto3.Session()
+    resultado = validar(session, None if args.sin_cache else args.cache, args.cache_ttl)
+
+    if args.json:
+        json.dump(resultado, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+        sys.exit(0 if resultado['valida'] else 1)
+
     print("=" * 70)
     print("AWS Cost Report - Validación de Configuración")
     print("=" * 70)
     print()
-    
-    validaciones = [
-        validar_credenciales(),
-        validar_permisos_cost_explorer(),
-        validar_etiquetas(),
-        validar_backup_tags()
-    ]
-    
+    imprimir(resultado)
+
     print("\n" + "=" * 70)
-    if all(validaciones[:2]):  # Las dos primeras son críticas
+    if resultado['valida']:  # Credenciales y Cost Explorer son críticas
         print("✅ CONFIGURACIÓN VÁLIDA - El script aws_cost_report.py está listo para usar")
     else:
         print("❌ CONFIGURACIÓN INCOMPLETA - Revisa los errores anteriores")
         sys.exit(1)
-    
-    if not all(validaciones[2:]):  # Las otras son advertencias
+
+    if resultado['advertencias']:  # Las etiquetas son advertencias
         print("⚠️  Hay algunas advertencias, pero el script funcionará")
-    
+
     print("=" * 70)
     print("\n💡 Siguiente paso: Ejecutar el script principal")
     print("   python aws_cost_report.py")
     print("   python aws_cost_report.py --mes 10 --anio 2024")
 
+
 if __name__ == '__main__':
     main()
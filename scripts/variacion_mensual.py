@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Variación respecto al mes anterior (--instantaneas DIR --comparar)
+==================================================================
+Cada informe guarda en DIR una instantánea de su modelo ya normalizado
+(coste base por Name y servicio, en micro-céntimos): DIR/YYYY-MM.json. Con
+--comparar se carga la instantánea del mes anterior (sin llamadas a la API)
+y se calculan las variaciones por Name y por servicio con pandas, en
+columnas enteras: una unión externa de las dos tablas, diferencia y
+porcentaje vectorizados.
+
+La hoja "Variación" ordena de mayor subida a mayor bajada y marca los Names
+y servicios nuevos o desaparecidos.
+"""
+
+import json
+import os
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+
+from dinero import a_dolares
+
+VERSION_INSTANTANEA = 1
+
+
+def ruta_instantanea(directorio, fecha_inicio):
+    return os.path.join(directorio, f'{fecha_inicio[:7]}.json')
+
+
+def mes_anterior(fecha_inicio):
+    """'2024-10-01' -> '2024-09-01'"""
+    inicio = date.fromisoformat(fecha_inicio)
+    return (date(inicio.year - 1, 12, 1) if inicio.month == 1
+            else date(inicio.year, inicio.month - 1, 1)).isoformat()
+
+
+def guardar_instantanea(directorio, fecha_inicio, fecha_fin, costos_base):
+    """Guarda {name: {servicio: µ¢}} del periodo (sobrescribe la del mismo mes)"""
+    os.makedirs(directorio, exist_ok=True)
+    ruta = ruta_instantanea(directorio, fecha_inicio)
+    parcial = fecha_inicio[:7] == date.today().isoformat()[:7]
+    temporal = ruta + '.tmp'
+    with open(temporal, 'w', encoding='utf-8') as f:
+        json.dump({
+            'version': VERSION_INSTANTANEA,
+            'periodo': [fecha_inicio, fecha_fin],
+            'parcial': parcial,
+            'guardado': datetime.now().isoformat(timespec='seconds'),
+            'costos': {name: dict(servicios) for name, servicios in costos_base.items()},
+        }, f, sort_keys=True)
+    os.replace(temporal, ruta)
+    print(f"💾 Instantánea guardada: {ruta}" + (" (mes en curso, parcial)" if parcial else ""))
+    return ruta
+
+
+def cargar_instantanea(directorio, fecha_inicio):
+    """Instantánea del mes de `fecha_inicio` o None si no existe"""
+    ruta = ruta_instantanea(directorio, fecha_inicio)
+    if not os.path.exists(ruta):
+        return None
+    with open(ruta, encoding='utf-8') as f:
+        instantanea = json.load(f)
+    if instantanea.get('version') != VERSION_INSTANTANEA:
+        print(f"   ⚠️  {ruta}: versión de instantánea distinta, se ignora")
+        return None
+    return instantanea
+
+
+def _tabla(costos):
+    """{name: {servicio: µ¢}} -> DataFrame Name | Servicio | Costo (int64)"""
+    filas = [(name, servicio, costo) for name, servicios in costos.items() for servicio, costo in servicios.items()]
+    return pd.DataFrame(filas, columns=['Name', 'Servicio', 'Costo']).astype({'Costo': 'int64'})
+
+
+def _variacion_por(actual, anterior, columna):
+    df = pd.concat([anterior.groupby(columna)['Costo'].sum().rename('Anterior'),
+                    actual.groupby(columna)['Costo'].sum().rename('Actual')], axis=1)
+    df = df.fillna(0).astype('int64')
+    df = df[(df['Anterior'] != 0) | (df['Actual'] != 0)]
+    df['Variación'] = df['Actual'] - df['Anterior']
+    df['%'] = np.where(df['Anterior'] != 0, df['Variación'] / df['Anterior'].abs().replace(0, 1), np.nan)
+    df['Estado'] = np.select([df['Anterior'].eq(0), df['Actual'].eq(0)], ['Nuevo', 'Desaparecido'], '')
+    return df.sort_values('Variación', ascending=False, kind='stable')
+
+
+def calcular_variacion(costos_actual, costos_anterior):
+    """{'names': DataFrame, 'servicios': DataFrame} indexados por Name / Servicio
+
+    Columnas: Anterior, Actual, Variación (µ¢), % (fracción, NaN si antes era 0), Estado.
+    """
+    actual, anterior = _tabla(costos_actual), _tabla(costos_anterior)
+    return {
+        'names': _variacion_por(actual, anterior, 'Name'),
+        'servicios': _variacion_por(actual, anterior, 'Servicio'),
+    }
+
+
+def comparar_con_anterior(directorio, fecha_inicio, costos_base):
+    """Variación del periodo frente a la instantánea del mes anterior, o None si no hay"""
+    inicio_anterior = mes_anterior(fecha_inicio)
+    instantanea = cargar_instantanea(directorio, inicio_anterior)
+    if instantanea is None:
+        print(f"⚠️  No hay instantánea de {inicio_anterior[:7]} en {directorio}: sin hoja 'Variación' "
+              f"(genera el informe de ese mes con --instantaneas {directorio})")
+        return None
+    variacion = calcular_variacion(costos_base, instantanea['costos'])
+    variacion['periodos'] = (inicio_anterior[:7] + (' (parcial)' if instantanea['parcial'] else ''),
+                             fecha_inicio[:7])
+
+    names = variacion['names']
+    total_anterior, total_actual = int(names['Anterior'].sum()), int(names['Actual'].sum())
+    print(f"\n📈 Variación {variacion['periodos'][0]} → {variacion['periodos'][1]}: "
+          f"${a_dolares(total_anterior):,.2f} → ${a_dolares(total_actual):,.2f} "
+          f"({'+' if total_actual >= total_anterior else '-'}${a_dolares(abs(total_actual - total_anterior)):,.2f})")
+    print(f"   → {(names['Estado'] == 'Nuevo').sum()} Names nuevos, "
+          f"{(names['Estado'] == 'Desaparecido').sum()} desaparecidos")
+    for name, fila in names.head(5).iterrows():
+        if fila['Variación'] > 0:
+            print(f"   ↑ {name}: +${a_dolares(int(fila['Variación'])):,.2f}")
+    return variacion
+
+
+def escribir_hoja_variacion(wb, variacion):
+    """Hoja 'Variación' (openpyxl): Names a la izquierda, servicios a la derecha"""
+    from openpyxl.styles import Font, PatternFill
+    from openpyxl.utils import get_column_letter
+
+    fill_cabecera = PatternFill(start_color='FFA500', end_color='FFA500', fill_type='solid')
+    fill_subida = PatternFill(start_color='F8CBAD', end_color='F8CBAD', fill_type='solid')
+    fill_bajada = PatternFill(start_color='C6EFCE', end_color='C6EFCE', fill_type='solid')
+    fill_nuevo = PatternFill(start_color='FFD966', end_color='FFD966', fill_type='solid')
+    font_bold = Font(bold=True, size=11)
+
+    ws = wb.create_sheet('Variación')
+    anterior, actual = variacion['periodos']
+    ws['A1'] = f'Variación {anterior} → {actual}'
+    ws['A1'].font = Font(bold=True, size=14)
+
+    def tabla(df, columna_inicial, titulo):
+        cabeceras = [titulo, f'{anterior} (US$)', f'{actual} (US$)', 'Variación (US$)', '%', 'Estado']
+        for i, texto in enumerate(cabeceras):
+            cell = ws.cell(3, columna_inicial + i, texto)
+            cell.fill = fill_cabecera
+            cell.font = font_bold
+        total = ['*** TOTAL ***', df['Anterior'].sum(), df['Actual'].sum()]
+        filas = [total + [total[2] - total[1], None, '']]
+        for clave, fila in df.iterrows():
+            filas.append([clave, fila['Anterior'], fila['Actual'], fila['Variación'], fila['%'], fila['Estado']])
+        for r, fila in enumerate(filas, start=4):
+            for i, valor in enumerate(fila):
+                if i in (1, 2, 3):
+                    valor = a_dolares(int(valor))
+                elif i == 4 and valor is not None and not pd.isna(valor):
+                    valor = float(valor)
+                elif i == 4:
+                    valor = None
+                cell = ws.cell(r, columna_inicial + i, valor)
+                if i == 4:
+                    cell.number_format = '0.0%'
+                elif i in (1, 2, 3):
+                    cell.number_format = '#,##0.00'
+            fill = (fill_nuevo if fila[5] in ('Nuevo', 'Desaparecido')
+                    else fill_subida if fila[3] > 0 else fill_bajada if fila[3] < 0 else None)
+            if r == 4:
+                fill = None
+                for i in range(6):
+                    ws.cell(r, columna_inicial + i).font = font_bold
+            if fill:
+                ws.cell(r, columna_inicial + 3).fill = fill
+                ws.cell(r, columna_inicial + 5).fill = fill
+        anchos = [40, 16, 16, 17, 9, 14]
+        for i, ancho in enumerate(anchos):
+            ws.column_dimensions[get_column_letter(columna_inicial + i)].width = ancho
+
+    tabla(variacion['names'], 1, 'Name')
+    tabla(variacion['servicios'], 8, 'Servicio')
+    ws.freeze_panes = 'A4'
+    return ws
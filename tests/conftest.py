@@ -0,0 +1,6 @@
+"""Los scripts viven sueltos en scripts/ (no son un paquete): se importan desde ahí"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
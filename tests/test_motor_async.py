@@ -0,0 +1,121 @@
+"""El motor asyncio (--motor async) contra servidor_ce_simulado: mismas filas que el
+motor de hilos, reintentos con --limitacion y corte con --max-requests"""
+
+import threading
+
+import boto3
+import pytest
+
+import motor_async
+from aws_cost_report import NECESIDAD_BACKUP, NECESIDAD_BASE, NECESIDAD_EC2
+from consultas_ce import ClienteCEMedido, PresupuestoPeticionesAgotado
+from motor_async import ErrorCE, MotorCEAsync
+from planificador_consultas import _ejecutar_consultas, planificar
+from servidor_ce_simulado import CostExplorerSimulado, crear_dataset, crear_servidor
+
+METRICAS = ['UnblendedCost', 'AmortizedCost']
+INICIO, FIN = '2024-09-01', '2024-11-01'
+REGISTROS = crear_dataset(30)
+PAGINA = 20  # páginas pequeñas: muchas peticiones por consulta
+
+
+@pytest.fixture(autouse=True)
+def sin_proxy(monkeypatch):
+    for variable in ('HTTPS_PROXY', 'HTTP_PROXY', 'https_proxy', 'http_proxy', 'NO_PROXY', 'no_proxy'):
+        monkeypatch.delenv(variable, raising=False)
+    monkeypatch.setattr(motor_async, 'ESPERA_BASE', 0.01)
+
+
+@pytest.fixture
+def lanzar_servidor():
+    """Arranca el servidor simulado en un puerto libre (en un hilo); devuelve (endpoint, servidor)"""
+    servidores = []
+
+    def lanzar(limitacion=0.0):
+        servidor = crear_servidor(0, CostExplorerSimulado(REGISTROS, PAGINA), limitacion=limitacion)
+        threading.Thread(target=servidor.serve_forever, daemon=True).start()
+        servidores.append(servidor)
+        return f'http://127.0.0.1:{servidor.server_address[1]}', servidor
+
+    yield lanzar
+    for servidor in servidores:
+        servidor.shutdown()
+        servidor.server_close()
+
+
+@pytest.fixture
+def motores():
+    """Crea motores asyncio (como --motor async) y los cierra al terminar"""
+    creados = []
+
+    def crear(endpoint, max_peticiones=None):
+        sesion = boto3.Session(aws_access_key_id='prueba', aws_secret_access_key='prueba', region_name='us-east-1')
+        cliente = sesion.client('ce', endpoint_url=endpoint)
+        motor = MotorCEAsync.desde_sesion(sesion, cliente, ClienteCEMedido(cliente, max_peticiones), 8)
+        creados.append(motor)
+        return motor
+
+    yield crear
+    for motor in creados:
+        motor.cerrar()
+
+
+def _cliente_hilos(endpoint):
+    return ClienteCEMedido(boto3.client('ce', region_name='us-east-1', endpoint_url=endpoint,
+                                        aws_access_key_id='prueba', aws_secret_access_key='prueba'))
+
+
+def _trabajos():
+    consultas, _ = planificar([NECESIDAD_BASE, NECESIDAD_EC2, NECESIDAD_BACKUP])
+    return [(consulta, None) for consulta in consultas]
+
+
+def _ejecutar(cliente):
+    return _ejecutar_consultas(cliente, _trabajos(), INICIO, FIN, METRICAS, 'MONTHLY', hilos=4)
+
+
+def test_mismas_filas_que_el_motor_de_hilos(lanzar_servidor, motores):
+    endpoint, _ = lanzar_servidor()
+    hilos = _ejecutar(_cliente_hilos(endpoint))
+    motor = motores(endpoint)
+
+    filas = _ejecutar(motor)
+
+    assert all(f for f in hilos)
+    assert filas == hilos
+    assert motor.total_peticiones() > len(filas)  # ha paginado
+
+
+def test_limitacion_se_reintenta(lanzar_servidor, motores):
+    esperado = _ejecutar(_cliente_hilos(lanzar_servidor()[0]))
+    endpoint, servidor = lanzar_servidor(limitacion=0.3)
+    motor = motores(endpoint)
+
+    filas = _ejecutar(motor)
+
+    assert filas == esperado
+    assert servidor.estadisticas['limitadas'] > 0
+    assert motor.reintentos == servidor.estadisticas['limitadas']
+
+
+def test_max_requests_corta_con_limitacion(lanzar_servidor, motores):
+    endpoint, servidor = lanzar_servidor(limitacion=0.3)
+    motor = motores(endpoint, max_peticiones=3)
+
+    with pytest.raises(PresupuestoPeticionesAgotado):
+        _ejecutar(motor)
+
+    assert motor.total_peticiones() == 3
+    # Las peticiones que llegan bien al servidor son las registradas; las limitadas se reintentan
+    assert servidor.estadisticas['peticiones'] - servidor.estadisticas['limitadas'] <= 3
+
+
+def test_se_niega_con_proxy(lanzar_servidor, motores, monkeypatch):
+    endpoint, _ = lanzar_servidor()
+    monkeypatch.setenv('HTTP_PROXY', 'http://proxy.invalid:3128')
+
+    with pytest.raises(ErrorCE, match='ProxyNoSoportado'):
+        motores(endpoint)
+
+    monkeypatch.setenv('NO_PROXY', '127.0.0.1')
+    assert _ejecutar(motores(endpoint))[0]
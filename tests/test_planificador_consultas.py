@@ -0,0 +1,174 @@
+"""El planificador cubre base, desglose EC2 y Backup con 2 consultas y los totales
+son los mismos que con el flujo anterior de 5 consultas (una por agregación y
+servicio EC2)"""
+
+from collections import defaultdict
+
+from aws_cost_report import NECESIDAD_BACKUP, NECESIDAD_BASE, NECESIDAD_EC2, SERVICIOS_EC2
+from consultas_ce import periodos_ce
+from dinero import importe
+from planificador_consultas import Consulta, demultiplexar, ejecutar_plan, planificar
+
+METRICAS = ['UnblendedCost', 'AmortizedCost']
+INICIO, FIN = '2024-09-01', '2024-11-01'
+
+# (periodo, servicio, usage type, Name, UnblendedCost): dos meses, créditos negativos,
+# instancias a 0 (Savings Plans) y recursos sin etiqueta Name
+REGISTROS = [
+    ('2024-09-01', 'Amazon Elastic Compute Cloud - Compute', 'EUW1-BoxUsage:t3.large', 'web-1', '120.12345678'),
+    ('2024-09-01', 'Amazon Elastic Compute Cloud - Compute', 'EUW1-BoxUsage:t3.micro', 'web-2', '0'),
+    ('2024-09-01', 'EC2 - Other', 'EUW1-EBS:VolumeUsage.gp3', 'web-1', '8.5'),
+    ('2024-09-01', 'EC2 - Other', 'EUW1-NatGateway-Hours', '', '32.4'),
+    ('2024-09-01', 'Amazon Elastic Block Store', 'EUW1-EBS:SnapshotUsage', 'db-1', '3.33333333'),
+    ('2024-09-01', 'AWS Backup', 'EUW1-WarmStorage-ByteHrs', 'db-1', '11.1'),
+    ('2024-09-01', 'AWS Backup', 'EUW1-WarmStorage-ByteHrs', '', '2.05'),
+    ('2024-09-01', 'Amazon Simple Storage Service', 'EUW1-TimedStorage-ByteHrs', 'web-1', '4.2'),
+    ('2024-09-01', 'Tax', 'Tax', 'web-1', '-1.75'),
+    ('2024-10-01', 'Amazon Elastic Compute Cloud - Compute', 'EUW1-BoxUsage:t3.large', 'web-1', '118.9'),
+    ('2024-10-01', 'Amazon Elastic Compute Cloud - Compute', 'EUW1-BoxUsage:t3.large', 'web-2', '7.00000001'),
+    ('2024-10-01', 'EC2 - Other', 'EUW1-EBS:VolumeUsage.gp3', 'db-1', '19.99'),
+    ('2024-10-01', 'Amazon Elastic Block Store', 'EUW1-EBS:VolumeUsage.gp2', 'db-1', '6.1'),
+    ('2024-10-01', 'AWS Backup', 'EUW1-WarmStorage-ByteHrs', 'db-1', '12.9'),
+    ('2024-10-01', 'Amazon Relational Database Service', 'EUW1-InstanceUsage:db.t3.medium', 'db-1', '61.2'),
+    ('2024-10-01', 'Amazon Simple Storage Service', 'EUW1-Requests-Tier1', '', '0.37'),
+]
+
+
+def _cumple(registro, filtro):
+    if not filtro:
+        return True
+    _, servicio, _, name, _ = registro
+    if 'And' in filtro:
+        return all(_cumple(registro, f) for f in filtro['And'])
+    if 'Dimensions' in filtro:
+        return servicio in filtro['Dimensions']['Values']
+    if 'ABSENT' in filtro['Tags'].get('MatchOptions', []):
+        return name == ''
+    return name in filtro['Tags']['Values']
+
+
+def _clave(registro, grupo):
+    _, servicio, usage_type, name, _ = registro
+    if grupo['Type'] == 'TAG':
+        return f"Name${name}"
+    return {'SERVICE': servicio, 'USAGE_TYPE': usage_type}[grupo['Key']]
+
+
+class ClienteEnlatado:
+    """get_cost_and_usage con páginas precalculadas de REGISTROS (PAGINA grupos por página)"""
+
+    PAGINA = 2
+
+    def __init__(self):
+        self.peticiones = []
+
+    def get_cost_and_usage(self, **params):
+        self.peticiones.append(params)
+        grupos = defaultdict(int)
+        for registro in REGISTROS:
+            if _cumple(registro, params.get('Filter')):
+                claves = (registro[0], tuple(_clave(registro, g) for g in params['GroupBy']))
+                grupos[claves] += importe(registro[4])
+        filas = sorted(grupos.items())
+        inicio = int(params.get('NextPageToken', 0))
+        pagina = filas[inicio:inicio + self.PAGINA]
+        resultados = defaultdict(list)
+        for (periodo, claves), micro in pagina:
+            # AmortizedCost: la misma cifra con otro valor, para comprobar que cada métrica va por separado
+            valores = {'UnblendedCost': micro, 'AmortizedCost': micro * 2}
+            resultados[periodo].append({'Keys': list(claves), 'Metrics': {
+                m: {'Amount': f"{valores[m] / 10 ** 8:.8f}", 'Unit': 'USD'} for m in params['Metrics']}})
+        respuesta = {'ResultsByTime': [{'TimePeriod': {'Start': p}, 'Groups': g} for p, g in resultados.items()]}
+        if inicio + self.PAGINA < len(filas):
+            respuesta['NextPageToken'] = str(inicio + self.PAGINA)
+        return respuesta
+
+
+def _consulta(cliente, agrupar, filtro=None):
+    """Una consulta del flujo anterior -> {(periodo, claves): {metrica: µ¢}}"""
+    params = {'TimePeriod': {'Start': INICIO, 'End': FIN}, 'Granularity': 'MONTHLY', 'Metrics': METRICAS,
+              'GroupBy': [{'Type': 'TAG', 'Key': 'Name'} if k == 'TAG:Name' else {'Type': 'DIMENSION', 'Key': k}
+                          for k in agrupar]}
+    if filtro:
+        params['Filter'] = filtro
+    resultado = defaultdict(lambda: dict.fromkeys(METRICAS, 0))
+    for periodo in periodos_ce(cliente, **params):
+        for grupo in periodo['Groups']:
+            for m in METRICAS:
+                resultado[(periodo['TimePeriod']['Start'], tuple(grupo['Keys']))][m] += importe(
+                    grupo['Metrics'][m]['Amount'])
+    return resultado
+
+
+def _flujo_cinco_consultas(cliente):
+    """Base SERVICE × Name, USAGE_TYPE × Name por cada servicio EC2 y Name filtrado a AWS Backup"""
+    base = _consulta(cliente, ('SERVICE', 'TAG:Name'))
+    ec2 = defaultdict(lambda: dict.fromkeys(METRICAS, 0))
+    for servicio in SERVICIOS_EC2:
+        for clave, valores in _consulta(cliente, ('USAGE_TYPE', 'TAG:Name'),
+                                        {'Dimensions': {'Key': 'SERVICE', 'Values': [servicio]}}).items():
+            for m in METRICAS:
+                ec2[clave][m] += valores[m]
+    backup = _consulta(cliente, ('TAG:Name',), {'Dimensions': {'Key': 'SERVICE', 'Values': ['AWS Backup']}})
+    return {'base': base, 'ec2': ec2, 'backup': backup}
+
+
+def _totales(filas):
+    """Filas del planificador -> {(periodo, claves): {metrica: µ¢}}"""
+    totales = defaultdict(lambda: dict.fromkeys(METRICAS, 0))
+    for periodo, claves, valores in filas:
+        for m in METRICAS:
+            totales[(periodo, claves)][m] += valores[m]
+    return totales
+
+
+def test_plan_de_dos_consultas():
+    consultas, asignacion = planificar([NECESIDAD_BASE, NECESIDAD_EC2, NECESIDAD_BACKUP])
+    assert consultas == [Consulta(('SERVICE', 'TAG:Name'), None),
+                         Consulta(('USAGE_TYPE', 'TAG:Name'), frozenset(SERVICIOS_EC2))]
+    assert asignacion == {'base': 0, 'ec2': 1, 'backup': 0}
+
+
+def test_totales_iguales_al_flujo_de_cinco_consultas():
+    anterior = _flujo_cinco_consultas(ClienteEnlatado())
+
+    cliente = ClienteEnlatado()
+    filas = ejecutar_plan(cliente, [NECESIDAD_BASE, NECESIDAD_EC2, NECESIDAD_BACKUP], INICIO, FIN, METRICAS)
+
+    assert len({str(p.get('GroupBy')) + str(p.get('Filter')) for p in cliente.peticiones}) == 2
+    for nombre in ('base', 'ec2', 'backup'):
+        assert _totales(filas[nombre]) == anterior[nombre], nombre
+    # Y los totales por métrica de cada agregación cuadran con los del flujo anterior
+    for nombre in ('base', 'ec2', 'backup'):
+        for m in METRICAS:
+            assert (sum(v[m] for _, _, v in filas[nombre])
+                    == sum(v[m] for v in anterior[nombre].values())), (nombre, m)
+
+
+def test_backup_derivado_de_la_consulta_base():
+    consulta = Consulta(('SERVICE', 'TAG:Name'), None)
+    filas = [('2024-10-01', ('AWS Backup', 'Name$db-1'), {'UnblendedCost': 5, 'AmortizedCost': 6}),
+             ('2024-10-01', ('Amazon Simple Storage Service', 'Name$db-1'), {'UnblendedCost': 7, 'AmortizedCost': 8}),
+             ('2024-10-01', ('AWS Backup', 'Name$'), {'UnblendedCost': -2, 'AmortizedCost': 1}),
+             ('2024-11-01', ('AWS Backup', 'Name$db-1'), {'UnblendedCost': 3, 'AmortizedCost': 3})]
+
+    backup = demultiplexar(consulta, NECESIDAD_BACKUP, filas, METRICAS)
+
+    assert sorted(backup) == [('2024-10-01', ('Name$',), {'UnblendedCost': -2, 'AmortizedCost': 1}),
+                              ('2024-10-01', ('Name$db-1',), {'UnblendedCost': 5, 'AmortizedCost': 6}),
+                              ('2024-11-01', ('Name$db-1',), {'UnblendedCost': 3, 'AmortizedCost': 3})]
+    assert demultiplexar(consulta, NECESIDAD_BACKUP, None, METRICAS) is None
+
+
+def test_consulta_fallida_deja_sus_necesidades_a_none():
+    class ClienteFallaEC2(ClienteEnlatado):
+        def get_cost_and_usage(self, **params):
+            if 'Filter' in params:
+                raise RuntimeError('LimitExceededException')
+            return super().get_cost_and_usage(**params)
+
+    filas = ejecutar_plan(ClienteFallaEC2(), [NECESIDAD_BASE, NECESIDAD_EC2, NECESIDAD_BACKUP],
+                          INICIO, FIN, METRICAS)
+
+    assert filas['ec2'] is None
+    assert _totales(filas['base']) == _flujo_cinco_consultas(ClienteEnlatado())['base']